@@ -0,0 +1,190 @@
+# AsyncHelpers.py implements awaitable versions of the UserHelpers and DonationHelpers functions for asyncio callers
+
+import asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+from Schema import createSchema, openDatabase
+import UserHelpers, DonationHelpers
+
+# Helpers run on the read lane, on read-only connections
+readFunctions = [
+	(UserHelpers, 'validUser'),
+	(UserHelpers, 'isAncestor'),
+	(UserHelpers, 'listOrgUsers'),
+	(UserHelpers, 'createSession'),
+	(DonationHelpers, 'listProviderDonations'),
+	(DonationHelpers, 'listProviderDonationsWithItems'),
+	(DonationHelpers, 'listProviderDonationsPage'),
+	(DonationHelpers, 'searchPendingDonations'),
+	(DonationHelpers, 'getDonationItems'),
+	(DonationHelpers, 'getInventoryRollup'),
+	(DonationHelpers, 'verifyInventoryRollup'),
+	(DonationHelpers, 'existDonation'),
+	(DonationHelpers, 'existItem'),
+	(DonationHelpers, 'existBarcode'),
+	(DonationHelpers, 'getBarcode'),
+	(DonationHelpers, 'barcodeCache'),
+	(DonationHelpers, 'barcodeFilter')
+]
+
+# Helpers run on the write lane, one at a time on the single writer connection
+writeFunctions = [
+	(UserHelpers, 'writeUser'),
+	(UserHelpers, 'writeUsersBulk'),
+	(DonationHelpers, 'addBarcode'),
+	(DonationHelpers, 'importBarcodes'),
+	(DonationHelpers, 'addDonation'),
+	(DonationHelpers, 'addItemByManual'),
+	(DonationHelpers, 'addItemByBarcode'),
+	(DonationHelpers, 'claimDonation'),
+	(DonationHelpers, 'completeDonations'),
+	(DonationHelpers, 'archiveDonations'),
+	(DonationHelpers, 'rebuildInventoryRollup'),
+	(DonationHelpers, 'enableBarcodeFilter')
+]
+
+
+# Class AsyncDatabase
+# Purpose: run helpers off the event loop on a small dedicated set of database threads
+# Syntax: adb = AsyncDatabase(<database_path>, <readers>, <queue_size>, <timeout_seconds>)
+#	await adb.listProviderDonations(<pid>, <types>)	# any helper in readFunctions/writeFunctions, minus the connection argument
+#	await adb.read(<function>, <args>...) / await adb.write(<function>, <args>...)	# any other function taking a connection first
+#	async for row in adb.iterProviderDonations(<pid>, <types>, <page_size>)
+#	adb.close()
+# Note: the write lane is one thread holding the only writer connection; the read lane is <readers> threads, each
+#	with its own read-only connection. An in-memory database cannot be shared between connections, so there both
+#	lanes run on the writer's thread.
+# Note: each lane admits queue_size calls at a time; further callers wait on the event loop rather than piling up
+#	work in the executor.
+# Note: cancelling a call (including by its timeout) drops it if it has not started, and interrupts its SQL if it has,
+#	which rolls back the statement's transaction. A call that already committed stays committed.
+# Note: validUser() runs on a read-only connection, so legacy hash upgrades wait for a synchronous login
+class AsyncDatabase:
+
+	def __init__(self, path=':memory:', readers=4, queueSize=64, timeout=None):
+		self.path = path
+		self.timeout = timeout
+		self.local = threading.local()
+		self.connections = []
+		self.connectionsLock = threading.Lock()
+
+		# Open (and migrate) the writer first so readers see the current schema
+		self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dbWrite')
+		self.writer.submit(self._connect, False).result()
+		if path == ':memory:':
+			self.reader = self.writer
+		else:
+			self.reader = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='dbRead', initializer=self._connect, initargs=(True,))
+
+		self.readSlots = asyncio.Semaphore(queueSize)
+		self.writeSlots = asyncio.Semaphore(queueSize) if self.reader is not self.writer else self.readSlots
+
+	# Executor thread initializer: open this thread's connection
+	def _connect(self, readOnly):
+		db = openDatabase(self.path, readOnly=True) if readOnly else createSchema(self.path)
+		self.local.db = db
+		with self.connectionsLock:
+			self.connections.append(db)
+
+	# Runs on an executor thread; call records which connection to interrupt while the call is running
+	def _call(self, call, fn, args, kwargs):
+		db = self.local.db
+		with call['lock']:
+			if call['cancelled']:
+				return None
+			call['db'] = db
+		try:
+			return fn(db, *args, **kwargs)
+		except BaseException:
+			# Do not leave a failed or interrupted helper's transaction open for the next caller
+			if db.in_transaction and db.depth == 0:
+				db.rollback()
+			raise
+		finally:
+			with call['lock']:
+				call['db'] = None
+
+	async def _run(self, executor, slots, fn, args, kwargs):
+
+		await slots.acquire()
+		loop = asyncio.get_running_loop()
+		call = {'lock': threading.Lock(), 'db': None, 'cancelled': False}
+		try:
+			future = executor.submit(self._call, call, fn, args, kwargs)
+		except BaseException:
+			slots.release()
+			raise
+
+		# The slot is freed when the thread is done with the call, not when the caller stops waiting
+		future.add_done_callback(lambda f: loop.call_soon_threadsafe(slots.release))
+		try:
+			return await asyncio.wrap_future(future)
+		except asyncio.CancelledError:
+			with call['lock']:
+				call['cancelled'] = True
+				if call['db'] is not None:
+					call['db'].interrupt()
+			raise
+
+	async def _timed(self, executor, slots, fn, args, kwargs, timeout):
+		timeout = self.timeout if timeout is None else timeout
+		if timeout is None:
+			return await self._run(executor, slots, fn, args, kwargs)
+		return await asyncio.wait_for(self._run(executor, slots, fn, args, kwargs), timeout)
+
+	# Run fn(<reader connection>, *args) on the read lane
+	async def read(self, fn, *args, timeout=None, **kwargs):
+		return await self._timed(self.reader, self.readSlots, fn, args, kwargs, timeout)
+
+	# Run fn(<writer connection>, *args) on the write lane
+	async def write(self, fn, *args, timeout=None, **kwargs):
+		return await self._timed(self.writer, self.writeSlots, fn, args, kwargs, timeout)
+
+	# Async counterpart of iterProviderDonations(): one read-lane call per page
+	async def iterProviderDonations(self, pid, types, pageSize=500):
+		cursor = None
+		while True:
+			rows, cursor = await self.listProviderDonationsPage(pid, types, pageSize, cursor)
+			for row in rows:
+				yield row
+			if cursor is None:
+				return
+
+	# Session lookups touch only process memory, so they run directly on the event loop
+	async def sessionUser(self, token):
+		return UserHelpers.sessionUser(token)
+
+	async def sessionHasPerms(self, token, perms):
+		return UserHelpers.sessionHasPerms(token, perms)
+
+	async def endSession(self, token):
+		return UserHelpers.endSession(token)
+
+	# Finish queued calls, then close every connection
+	def close(self):
+		self.writer.shutdown(wait=True)
+		if self.reader is not self.writer:
+			self.reader.shutdown(wait=True)
+		with self.connectionsLock:
+			for db in self.connections:
+				db.close()
+			self.connections = []
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, excType, exc, tb):
+		await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+# The helper is looked up at call time, so wrappers installed later (e.g. by Instrumentation.py) apply
+def _lane(lane, module, name):
+	async def method(self, *args, timeout=None, **kwargs):
+		return await getattr(self, lane)(getattr(module, name), *args, timeout=timeout, **kwargs)
+	method.__name__ = name
+	method.__doc__ = 'Awaitable {0}() on the {1} lane'.format(name, lane)
+	return method
+
+for module, name in readFunctions:
+	setattr(AsyncDatabase, name, _lane('read', module, name))
+for module, name in writeFunctions:
+	setattr(AsyncDatabase, name, _lane('write', module, name))
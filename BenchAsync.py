@@ -0,0 +1,102 @@
+# BenchAsync.py compares requests per second and event-loop responsiveness when an asyncio server calls the
+# synchronous helpers directly versus through AsyncHelpers.AsyncDatabase
+#
+# Run with "python3 BenchAsync.py [--clients N] [--seconds S] [--readers N] [--writes F]"
+
+import sys, os, time, random, asyncio, argparse, tempfile
+from Schema import createSchema, transaction
+from DonationHelpers import addBarcode, addDonation, addItemByBarcode, listProviderDonations, getDonationItems
+from AsyncHelpers import AsyncDatabase
+
+providers = ['provider{0}'.format(n) for n in range(20)]
+codes = ['code{0}'.format(n) for n in range(500)]
+
+
+def populate(path, donations=2000):
+	db = createSchema(path)
+	with transaction(db):
+		for n, code in enumerate(codes):
+			addBarcode(db, code, 'title{0}'.format(n % 100), n % 3)
+		dids = [addDonation(db, random.choice(providers), None) for _ in range(donations)]
+		for did in dids:
+			for _ in range(3):
+				addItemByBarcode(db, did, random.choice(codes), random.randint(1, 5))
+	db.close()
+	return dids
+
+
+# Run clients for a fixed time; call(kind, *args) performs one request. Returns (requests/s, worst loop lag in ms).
+async def measure(call, dids, clients, seconds, writes):
+
+	count = [0]
+	stop = time.monotonic() + seconds
+
+	# A ticker that should wake every 5ms; its lateness is how long the loop was blocked
+	async def ticker():
+		worst = 0.0
+		while time.monotonic() < stop:
+			start = time.monotonic()
+			await asyncio.sleep(0.005)
+			worst = max(worst, time.monotonic() - start - 0.005)
+		return worst
+
+	async def client():
+		while time.monotonic() < stop:
+			r = random.random()
+			if r < writes:
+				await call(addItemByBarcode, random.choice(dids), random.choice(codes), 1)
+			elif r < (1 + writes) / 2:
+				await call(listProviderDonations, random.choice(providers), 0b01)
+			else:
+				await call(getDonationItems, random.choice(dids))
+			count[0] += 1
+
+	start = time.monotonic()
+	results = await asyncio.gather(ticker(), *[client() for _ in range(clients)])
+	return count[0] / (time.monotonic() - start), results[0] * 1000
+
+
+async def runDirect(path, dids, args):
+	db = createSchema(path)
+
+	async def call(fn, *a):
+		return fn(db, *a)
+
+	result = await measure(call, dids, args.clients, args.seconds, args.writes)
+	db.close()
+	return result
+
+
+async def runAsync(path, dids, args):
+	adb = AsyncDatabase(path, readers=args.readers)
+	writers = {addItemByBarcode}
+
+	async def call(fn, *a):
+		return await (adb.write(fn, *a) if fn in writers else adb.read(fn, *a))
+
+	result = await measure(call, dids, args.clients, args.seconds, args.writes)
+	adb.close()
+	return result
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='BenchAsync.py')
+	parser.add_argument('--clients', type=int, default=50, help='concurrent asyncio clients')
+	parser.add_argument('--seconds', type=float, default=3.0, help='duration per mode')
+	parser.add_argument('--readers', type=int, default=4, help='read lane threads for AsyncDatabase')
+	parser.add_argument('--writes', type=float, default=0.2, help='fraction of requests that write')
+	args = parser.parse_args(argv)
+
+	print('{0} clients, {1:.0%} writes, {2} reader threads'.format(args.clients, args.writes, args.readers))
+	print('mode\t\trequests/s\tworst loop lag (ms)')
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'bench.db')
+		dids = populate(path)
+		for name, run in (('direct', runDirect), ('AsyncDatabase', runAsync)):
+			rate, lag = asyncio.run(run(path, dids, args))
+			print('{0:16}{1:10.0f}\t{2:10.1f}'.format(name, rate, lag))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
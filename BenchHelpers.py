@@ -0,0 +1,301 @@
+# BenchHelpers.py times every user and donation helper against synthetic databases of increasing size
+#
+# Run with "python3 BenchHelpers.py [--scales 1000,10000,100000] [--calls N] [--output results.json]
+#	[--baseline baseline.json] [--tolerance F] [--path file.db] [--only helper,...]"
+# A scale is the number of item rows; users, barcodes and donations are generated in proportion.
+# With --baseline, exits non-zero if a helper now runs more SQL statements per call, got slower than
+# tolerance x its baseline time, or if checkQueryPlans() reports a full table scan.
+
+import sys, os, csv, json, time, random, sqlite3, argparse, datetime, tempfile, platform
+from Schema import createSchema, checkQueryPlans, transaction
+from Passwords import hashPassword
+import UserHelpers, DonationHelpers
+from UserHelpers import (validUser, writeUser, writeUsersBulk, isAncestor, listOrgUsers, createSession)
+from DonationHelpers import (addBarcode, importBarcodes, addDonation, addItemByManual, addItemByBarcode,
+	listProviderDonations, listProviderDonationsWithItems, listProviderDonationsPage, iterProviderDonations,
+	searchPendingDonations, getDonationItems, claimDonation, completeDonations, archiveDonations,
+	getInventoryRollup, verifyInventoryRollup, rebuildInventoryRollup, existDonation, existItem, existBarcode,
+	getBarcode, enableBarcodeFilter)
+
+itemsPerDonation = 5
+benchPassword = 'benchmark'
+
+
+# Class Dataset
+# Purpose: sizes and id ranges of one synthetic database, used to pick realistic helper arguments
+class Dataset:
+
+	def __init__(self, scale):
+		self.scale = scale
+		self.donations = max(scale // itemsPerDonation, 1)
+		self.barcodes = max(scale // 10, itemsPerDonation)
+		self.users = max(scale // 100, 10)
+		self.orgs = max(self.users // 50, 1)
+		self.providers = max(self.users // 2, 1)
+		self.added = 0	# counter for unique names created by write helpers
+
+	def org(self, rng):
+		return 'org{0}'.format(rng.randrange(self.orgs))
+
+	def user(self, rng):
+		return 'user{0}'.format(rng.randrange(self.users))
+
+	def provider(self, rng):
+		return 'user{0}'.format(rng.randrange(self.providers))
+
+	def donation(self, rng):
+		return rng.randrange(1, self.donations + 1)
+
+	def code(self, rng):
+		return 'code{0}'.format(rng.randrange(self.barcodes))
+
+	def title(self, n):
+		return 'title {0} word{1}'.format(n, n % 997)
+
+	def unique(self, prefix):
+		self.added += 1
+		return '{0}{1}'.format(prefix, self.added)
+
+
+# Function populate()
+# Purpose: fill a fresh database with synthetic users, barcodes, donations and items in bulk
+# Note: rows are inserted directly, in one transaction, rather than through the helpers, so 10M rows take minutes not days.
+#	Every user shares one password hash. Triggers still maintain userTree, inventoryRollup and itemSearch.
+def populate(db, data, rng):
+
+	start = time.monotonic()
+	hashed = hashPassword(benchPassword)
+	now = datetime.datetime.now()
+	c = db.cursor()
+	with transaction(db):
+		c.execute('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''', ('admin', 0b1111, 'admin', hashed))
+		c.executemany('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''',
+			(('admin', 0b0110, 'org{0}'.format(n), hashed) for n in range(data.orgs)))
+		c.executemany('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''',
+			((data.org(rng), 0b0010 if n < data.providers else 0b0001, 'user{0}'.format(n), hashed) for n in range(data.users)))
+
+		c.executemany('''INSERT INTO barcodes(code, title, units) VALUES(?,?,?)''',
+			(('code{0}'.format(n), data.title(n), n % 3) for n in range(data.barcodes)))
+
+		# A third pending, a third claimed, a third completed; created over the last year
+		def donation(n):
+			created = now - datetime.timedelta(minutes=rng.randrange(525600))
+			state = n % 3
+			return (data.provider(rng), 'pending' if state == 0 else data.user(rng), created, created if state == 2 else 0)
+		c.executemany('''INSERT INTO donations(provider, receiver, created, completed) VALUES(?,?,?,?)''',
+			(donation(n) for n in range(data.donations)))
+
+		# Distinct titles within a donation keep (did, title, units) unique
+		def item(n):
+			did = n // itemsPerDonation + 1
+			code = (did * 7919 + n % itemsPerDonation) % data.barcodes
+			return (did, 'code{0}'.format(code), data.title(code), rng.randint(1, 20), str(code % 3))
+		c.executemany('''INSERT INTO items(did, barcode, title, count, units) VALUES(?,?,?,?,?)''',
+			(item(n) for n in range(data.donations * itemsPerDonation)))
+	c.close()
+	return time.monotonic() - start
+
+
+# One entry per helper: (name, call(db, data, rng), calls). calls None uses --calls; 1 marks maintenance helpers timed once.
+# Calls and arguments are fixed per helper, so two runs at the same scale do exactly the same work.
+def _catalog(tmp):
+
+	catalogPath = os.path.join(tmp, 'catalog.csv')
+
+	def importCatalog(db, data, rng):
+		with open(catalogPath, 'w', newline='') as f:
+			writer = csv.writer(f)
+			for _ in range(1000):
+				writer.writerow((data.unique('import'), 'imported', 1))
+		return importBarcodes(db, catalogPath)
+
+	def bulkUsers(db, data, rng):
+		org = data.org(rng)
+		return writeUsersBulk(db, [(org, data.unique('bulk'), 0b0001, benchPassword) for _ in range(10)])
+
+	return [
+		('validUser', lambda db, data, rng: validUser(db, data.user(rng), benchPassword), 10),
+		('createSession', lambda db, data, rng: createSession(db, data.user(rng), benchPassword), 10),
+		('writeUser', lambda db, data, rng: writeUser(db, 'admin', data.user(rng), rng.choice((0b0001, 0b0010)), None), None),
+		('writeUsersBulk', bulkUsers, 5),
+		('isAncestor', lambda db, data, rng: isAncestor(db, data.org(rng), data.user(rng)), None),
+		('listOrgUsers', lambda db, data, rng: listOrgUsers(db, data.org(rng)), None),
+		('addBarcode', lambda db, data, rng: addBarcode(db, data.unique('new'), 'new title', 1), None),
+		('importBarcodes', importCatalog, 1),
+		('addDonation', lambda db, data, rng: addDonation(db, data.provider(rng), None), None),
+		('addItemByManual', lambda db, data, rng: addItemByManual(db, data.donation(rng), 'manual {0}'.format(rng.randrange(50)), 1, 'lb'), None),
+		('addItemByBarcode', lambda db, data, rng: addItemByBarcode(db, data.donation(rng), data.code(rng), 1), None),
+		('listProviderDonations', lambda db, data, rng: listProviderDonations(db, data.provider(rng), 0b01), None),
+		('listProviderDonationsWithItems', lambda db, data, rng: listProviderDonationsWithItems(db, data.provider(rng), 0b11), None),
+		('listProviderDonationsPage', lambda db, data, rng: listProviderDonationsPage(db, data.provider(rng), 0b11, 50), None),
+		('iterProviderDonations', lambda db, data, rng: sum(1 for _ in iterProviderDonations(db, data.provider(rng), 0b11, 50)), None),
+		('searchPendingDonations', lambda db, data, rng: searchPendingDonations(db, 'word{0}'.format(rng.randrange(997))), None),
+		('getDonationItems', lambda db, data, rng: getDonationItems(db, data.donation(rng)), None),
+		('claimDonation', lambda db, data, rng: claimDonation(db, data.donation(rng), data.user(rng)), None),
+		('completeDonations', lambda db, data, rng: completeDonations(db, [data.donation(rng)]), None),
+		('getInventoryRollup', lambda db, data, rng: getInventoryRollup(db, data.provider(rng)), None),
+		('existDonation', lambda db, data, rng: existDonation(db, data.donation(rng)), None),
+		('existItem', lambda db, data, rng: existItem(db, rng.randrange(1, data.scale + 1)), None),
+		('existBarcode', lambda db, data, rng: existBarcode(db, data.code(rng)), None),
+		('getBarcode', lambda db, data, rng: getBarcode(db, data.code(rng)), None),
+		('enableBarcodeFilter', lambda db, data, rng: enableBarcodeFilter(db), 1),
+		('verifyInventoryRollup', lambda db, data, rng: verifyInventoryRollup(db), 1),
+		('rebuildInventoryRollup', lambda db, data, rng: rebuildInventoryRollup(db), 1),
+		('archiveDonations', lambda db, data, rng: archiveDonations(db, datetime.datetime.now() - datetime.timedelta(days=300), 500, 1), 1)
+	]
+
+
+# Public helpers with no entry in the catalog, so a new helper cannot go unmeasured unnoticed
+def uncovered(catalog):
+	covered = {name for name, call, calls in catalog}
+	missing = []
+	for module in (UserHelpers, DonationHelpers):
+		for name, fn in vars(module).items():
+			if callable(fn) and not isinstance(fn, type) and getattr(fn, '__module__', None) == module.__name__ \
+				and not name.startswith('_') and fn.__code__.co_varnames[:1] == ('db',) and name not in covered \
+				and name not in ('donationStore', 'userStore', 'barcodeCache', 'barcodeFilter'):
+				missing.append(name)
+	return missing
+
+
+# Time a fixed number of calls to one helper, then count the SQL statements of a few more
+def measure(db, data, name, call, calls):
+
+	rng = random.Random(name)
+	samples = []
+	for _ in range(calls):
+		start = time.perf_counter()
+		call(db, data, rng)
+		samples.append(time.perf_counter() - start)
+
+	# Statements per call, trigger runs included, as Instrumentation.py counts them
+	statements = None
+	if calls > 1:
+		count = [0]
+		def trace(sql):
+			if not sql.startswith('--'):
+				count[0] += 1
+		counted = min(calls, 10)
+		db.set_trace_callback(trace)
+		for _ in range(counted):
+			call(db, data, rng)
+		db.set_trace_callback(None)
+		statements = count[0] / counted
+
+	samples.sort()
+	pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1e6
+	return {
+		'helper': name,
+		'scale': data.scale,
+		'calls': len(samples),
+		'meanUs': sum(samples) / len(samples) * 1e6,
+		'p50Us': pick(0.5),
+		'p99Us': pick(0.99),
+		'statements': statements
+	}
+
+
+# Function compare()
+# Purpose: find regressions of a run against a baseline run
+# Returns: a list of messages; empty if nothing regressed
+# Note: statements per call may not grow by a whole statement; time may not grow beyond tolerance x baseline.
+#	Maintenance helpers timed once are only checked for time.
+def compare(results, baseline, tolerance):
+
+	problems = []
+	before = {(r['helper'], r['scale']): r for r in baseline['results']}
+	for r in results['results']:
+		old = before.get((r['helper'], r['scale']))
+		if old is None:
+			continue
+		if r['statements'] is not None and old['statements'] is not None and r['statements'] >= old['statements'] + 1:
+			problems.append('{0} at {1}: {2:.1f} statements per call, baseline {3:.1f}'.format(
+				r['helper'], r['scale'], r['statements'], old['statements']))
+		if r['p50Us'] > old['p50Us'] * tolerance:
+			problems.append('{0} at {1}: p50 {2:.1f}us, baseline {3:.1f}us'.format(r['helper'], r['scale'], r['p50Us'], old['p50Us']))
+	for scan in results['scans']:
+		problems.append('full table scan: {0}'.format(scan))
+	return problems
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='BenchHelpers.py')
+	parser.add_argument('--scales', default='1000,10000,100000', help='comma-separated item counts, e.g. 1000,100000,10000000')
+	parser.add_argument('--calls', type=int, default=500, help='timed calls per helper and scale (password helpers make 10)')
+	parser.add_argument('--output', help='write results as JSON to this file')
+	parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+	parser.add_argument('--tolerance', type=float, default=2.0, help='allowed slowdown factor against the baseline')
+	parser.add_argument('--path', help='build databases in this file instead of in memory (replaced for each scale)')
+	parser.add_argument('--only', help='comma-separated helpers to run')
+	args = parser.parse_args(argv)
+
+	results = {
+		'meta': {
+			'date': datetime.datetime.now().isoformat(timespec='seconds'),
+			'python': platform.python_version(),
+			'sqlite': sqlite3.sqlite_version,
+			'machine': platform.machine(),
+			'calls': args.calls
+		},
+		'populate': {},
+		'results': [],
+		'scans': []
+	}
+
+	with tempfile.TemporaryDirectory() as tmp:
+		catalog = _catalog(tmp)
+		if args.only:
+			wanted = set(args.only.split(','))
+			catalog = [entry for entry in catalog if entry[0] in wanted]
+		for name in uncovered(_catalog(tmp)):
+			print('warning: {0}() has no benchmark'.format(name))
+
+		for scale in (int(s) for s in args.scales.split(',')):
+			path = args.path or ':memory:'
+			for suffix in ('', '-wal', '-shm'):
+				if path != ':memory:' and os.path.exists(path + suffix):
+					os.remove(path + suffix)
+			db = createSchema(path)
+			data = Dataset(scale)
+			seconds = populate(db, data, random.Random(scale))
+			results['populate'][str(scale)] = seconds
+			print('scale {0}: populated {1} items, {2} donations, {3} barcodes, {4} users in {5:.1f}s'.format(
+				scale, data.donations * itemsPerDonation, data.donations, data.barcodes, data.users, seconds))
+			if not results['scans']:
+				results['scans'] = checkQueryPlans(db)
+
+			print('{0:32}{1:>8}{2:>12}{3:>12}{4:>12}'.format('helper', 'calls', 'p50 us', 'p99 us', 'stmts'))
+			for name, call, calls in catalog:
+				r = measure(db, data, name, call, calls or args.calls)
+				results['results'].append(r)
+				print('{0:32}{1:8d}{2:12.1f}{3:12.1f}{4:>12}'.format(name, r['calls'], r['p50Us'], r['p99Us'],
+					'-' if r['statements'] is None else '{0:.1f}'.format(r['statements'])))
+			db.close()
+
+	# Growth of p50 from the smallest to the largest scale: near 1 for indexed lookups, near the scale ratio for scans
+	scales = sorted({r['scale'] for r in results['results']})
+	if len(scales) > 1:
+		print('\np50 growth from scale {0} to {1}:'.format(scales[0], scales[-1]))
+		byKey = {(r['helper'], r['scale']): r for r in results['results']}
+		for name, call, calls in catalog:
+			low, high = byKey.get((name, scales[0])), byKey.get((name, scales[-1]))
+			if low and high and low['p50Us']:
+				print('{0:32}{1:8.1f}x'.format(name, high['p50Us'] / low['p50Us']))
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			problems = compare(results, json.load(f), args.tolerance)
+		for problem in problems:
+			print('FAIL: ' + problem)
+		if problems:
+			return 1
+		print('PASS: no regressions against ' + args.baseline)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,69 @@
+# BenchPasswords.py measures validUser() login throughput for each password KDF setting
+#
+# Run with "python3 BenchPasswords.py [--threads N] [--seconds S]"
+
+import sys, os, time, argparse, tempfile, threading
+import Passwords
+from Passwords import ScryptHasher, Pbkdf2Hasher
+from Schema import createSchema
+from ConnectionPool import ConnectionPool
+from UserHelpers import validUser, writeUser
+
+settings = [
+	ScryptHasher(n=2 ** 14, r=8, p=1),
+	ScryptHasher(n=2 ** 15, r=8, p=1),
+	Pbkdf2Hasher(iterations=100000),
+	Pbkdf2Hasher(iterations=600000)
+]
+
+
+# Run validUser() from many request threads for a fixed time; returns logins per second
+def measure(pool, users, threads, seconds):
+
+	count = [0] * threads
+	stop = time.monotonic() + seconds
+
+	def worker(n):
+		uid, pwd = users[n % len(users)]
+		while time.monotonic() < stop:
+			with pool.reader() as db:
+				if not validUser(db, uid, pwd):
+					raise RuntimeError('login failed for {0}'.format(uid))
+			count[n] += 1
+
+	start = time.monotonic()
+	workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+	for w in workers:
+		w.start()
+	for w in workers:
+		w.join()
+	return sum(count) / (time.monotonic() - start)
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='BenchPasswords.py')
+	parser.add_argument('--threads', type=int, default=4 * Passwords.poolWorkers, help='concurrent login threads')
+	parser.add_argument('--seconds', type=float, default=3.0, help='duration per setting')
+	args = parser.parse_args(argv)
+
+	print('{0} request threads, {1} KDF workers'.format(args.threads, Passwords.poolWorkers))
+	print('setting\t\t\t\t\tlogins/s')
+	with tempfile.TemporaryDirectory() as tmp:
+		for n, setting in enumerate(settings):
+			Passwords.setHasher(setting)
+			path = os.path.join(tmp, 'bench{0}.db'.format(n))
+			db = createSchema(path)
+			users = [('admin', 'admin')] + [('user{0}'.format(i), 'pw{0}'.format(i)) for i in range(15)]
+			for uid, pwd in users:
+				writeUser(db, 'admin', uid, 0b0011, pwd)
+			db.close()
+
+			pool = ConnectionPool(path, maxReaders=args.threads)
+			rate = measure(pool, users, args.threads, args.seconds)
+			pool.close()
+			print('{0:40}{1:8.1f}'.format(repr(setting), rate))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,81 @@
+# BloomFilter.py implements a Bloom filter for fast definite-miss membership tests
+
+import math, hashlib, threading
+
+# Class BloomFilter
+# Purpose: answer "definitely absent" or "possibly present" for string keys in constant time
+# Syntax: bloom = BloomFilter(<capacity>, <false_positive_rate>)
+#	bloom.add(<key>); <key> in bloom
+# Note: sized for capacity keys at the requested false-positive rate; beyond capacity the rate climbs,
+#	which stats()['estimatedFpRate'] reports so the owner can rebuild larger.
+# Note: keys are hashed once with BLAKE2b and the k probe positions derived by double hashing.
+class BloomFilter:
+
+	def __init__(self, capacity, fpRate=0.01):
+		if not 0 < fpRate < 1:
+			raise ValueError('fpRate must be between 0 and 1')
+		self.capacity = max(int(capacity), 1)
+		self.fpRate = fpRate
+		self.bitCount = max(int(math.ceil(-self.capacity * math.log(fpRate) / (math.log(2) ** 2))), 8)
+		self.hashCount = max(int(round(self.bitCount / self.capacity * math.log(2))), 1)
+		self.bits = bytearray((self.bitCount + 7) // 8)
+		self.count = 0
+		self.version = None	# owner's tag for the data the filter holds, e.g. DonationHelpers' barcodeVersion
+		self.lock = threading.Lock()
+
+	def _positions(self, key):
+		digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		m = self.bitCount
+		return [(h1 + i * h2) % m for i in range(self.hashCount)]
+
+	def add(self, key):
+		positions = self._positions(key)
+		with self.lock:
+			for p in positions:
+				self.bits[p >> 3] |= 1 << (p & 7)
+			self.count += 1
+
+	# Add many keys under one lock; used to rebuild from a table quickly
+	def update(self, keys):
+		bits = self.bits
+		m = self.bitCount
+		k = self.hashCount
+		blake2b = hashlib.blake2b
+		added = 0
+		with self.lock:
+			for key in keys:
+				digest = blake2b(str(key).encode(), digest_size=16).digest()
+				h1 = int.from_bytes(digest[:8], 'little')
+				h2 = int.from_bytes(digest[8:], 'little') | 1
+				for i in range(k):
+					p = (h1 + i * h2) % m
+					bits[p >> 3] |= 1 << (p & 7)
+				added += 1
+			self.count += added
+
+	def __contains__(self, key):
+		bits = self.bits
+		for p in self._positions(key):
+			if not bits[p >> 3] & (1 << (p & 7)):
+				return False
+		return True
+
+	# Memory used by the bit array, in bytes
+	@property
+	def nbytes(self):
+		return len(self.bits)
+
+	# Returns: dict of capacity, count, bits, hashes, nbytes, target and estimated false-positive rate
+	def stats(self):
+		n = self.count
+		return {
+			'capacity': self.capacity,
+			'count': n,
+			'bits': self.bitCount,
+			'hashes': self.hashCount,
+			'nbytes': self.nbytes,
+			'fpRate': self.fpRate,
+			'estimatedFpRate': (1 - math.exp(-self.hashCount * n / self.bitCount)) ** self.hashCount
+		}
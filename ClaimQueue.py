@@ -0,0 +1,103 @@
+# ClaimQueue.py implements fair, batched distribution of pending donations to waiting receivers
+
+import threading
+from collections import deque
+from Schema import transaction
+from DonationHelpers import claimDonation
+
+# Oldest pending donations first; Schema.checkQueryPlans() explains this statement
+candidatesQuery = '''SELECT id FROM donations WHERE receiver = 'pending' AND completed = 0 ORDER BY created, id LIMIT ?'''
+
+# Class ClaimQueue
+# Purpose: let receivers register interest and hand out pending donations to them in turn
+# Syntax: queue = ClaimQueue()
+#	queue.register(<receiver_uid>, <wanted>)
+#	queue.distribute(<connection>, <batch_size>)	# returns ([(donation_id, receiver_uid), ...], <no_pending_left>)
+# Note: receivers are served round-robin in registration order, one donation per turn, oldest donation
+#	first; a receiver whose wish is filled leaves the queue. Each claim is claimDonation()'s conditional
+#	UPDATE, so donations claimed directly by someone else in the meantime are skipped, never double-claimed.
+# Note: a batch is one transaction. It can claim nothing while donations remain, when every candidate it
+#	selected was claimed elsewhere first; no_pending_left is True only when the SELECT found no pending donation.
+# Note: the queue lock is held only to plan a batch and to record its claims, not across the SELECT and the
+#	transaction, so register()/unregister() never wait on the database and distributors run side by side.
+#	Each planned turn reserves one of its receiver's wanted donations, so concurrent batches cannot serve a
+#	receiver more than it asked for; turns a batch does not use are released when it ends.
+class ClaimQueue:
+
+	def __init__(self):
+		self.waiting = deque()	# [receiver_uid, donations still wanted, donations reserved by running batches]
+		self.lock = threading.Lock()
+
+	# Add a receiver to the back of the queue, or raise the count of one already waiting
+	def register(self, rid, wanted=1):
+		with self.lock:
+			for entry in self.waiting:
+				if entry[0] == rid:
+					entry[1] += wanted
+					return
+			self.waiting.append([rid, wanted, 0])
+
+	def unregister(self, rid):
+		with self.lock:
+			self.waiting = deque(entry for entry in self.waiting if entry[0] != rid)
+
+	# Claim up to batchSize pending donations for waiting receivers
+	def distribute(self, db, batchSize=100):
+
+		# Plan the batch's turns round-robin, reserving each one
+		with self.lock:
+			turns = []
+			waiting = deque(entry for entry in self.waiting if entry[1] > entry[2])
+			while waiting and len(turns) < batchSize:
+				entry = waiting.popleft()
+				entry[2] += 1
+				turns.append(entry)
+				if entry[1] > entry[2]:
+					waiting.append(entry)
+		if not turns:
+			return [], False
+
+		claimed = []
+		served = 0
+		try:
+			# Selected under the write lock, so a batch never picks donations another batch just claimed
+			with transaction(db):
+				c = db.cursor()
+				c.execute(candidatesQuery, (batchSize,))
+				candidates = [row[0] for row in c.fetchall()]
+				c.close()
+
+				for did in candidates:
+					if served == len(turns):
+						break
+					if claimDonation(db, did, turns[served][0]):
+						claimed.append((did, turns[served][0]))
+						served += 1
+		except BaseException:
+			# A rolled-back batch served nobody
+			served = 0
+			raise
+		finally:
+			with self.lock:
+				for entry in turns:
+					entry[2] -= 1
+				self._record(turns[:served])
+
+		return claimed, not candidates
+
+	# Count served turns against their receivers; served receivers move to the back in the order they were served
+	#	and leave once filled. The caller holds self.lock.
+	def _record(self, turns):
+
+		if not turns:
+			return
+		last = {}
+		for n, entry in enumerate(turns):
+			entry[1] -= 1
+			last[id(entry)] = n
+		rest = [entry for entry in self.waiting if id(entry) not in last]
+		back = sorted((entry for entry in self.waiting if id(entry) in last and entry[1] > 0), key=lambda entry: last[id(entry)])
+		self.waiting = deque(rest + back)
+
+	def __len__(self):
+		return len(self.waiting)
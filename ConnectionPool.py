@@ -0,0 +1,91 @@
+# ConnectionPool.py implements a thread-safe pool of connections to a file-backed database
+
+import queue, threading
+from contextlib import contextmanager
+from Schema import openDatabase
+
+# Class ConnectionPool
+# Purpose: share one database file between many reader threads and a single writer
+# Syntax: pool = ConnectionPool(<path>, <max_readers>)
+#	with pool.reader() as db: validUser(db, ...)
+#	with pool.writer() as db: addItemByBarcode(db, ...)
+# Note: WAL mode lets every reader run while the writer holds its lock; SQLite permits only one
+#	writer per database, so writes are serialized here instead of failing with "database is locked".
+# Note: the schema must already exist: call createSchema(<path>) once before building a pool.
+class ConnectionPool:
+
+	def __init__(self, path, maxReaders=8):
+		if path == ':memory:':
+			raise ValueError('ConnectionPool needs a database file; :memory: is private to one connection')
+		self.path = path
+		self.maxReaders = maxReaders
+		self.idle = queue.LifoQueue()	# LIFO keeps recently used connections (and their caches) warm
+		self.opened = 0
+		self.lock = threading.Lock()
+		self.writeLock = threading.Lock()
+		self.writeDb = openDatabase(path)
+		self.closed = False
+
+	# Borrow a read-only connection, opening a new one while under maxReaders
+	@contextmanager
+	def reader(self, timeout=None):
+		db = self._acquireReader(timeout)
+		try:
+			yield db
+		finally:
+			# End any read transaction so the WAL can be checkpointed past it
+			if db.in_transaction:
+				db.rollback()
+			if self.closed:
+				db.close()
+			else:
+				self.idle.put(db)
+
+	# Borrow the single writer connection; uncommitted work is rolled back on error
+	@contextmanager
+	def writer(self, timeout=-1):
+		if not self.writeLock.acquire(timeout=timeout):
+			raise TimeoutError('timed out waiting for the writer connection')
+		try:
+			yield self.writeDb
+			if self.writeDb.in_transaction:
+				self.writeDb.commit()
+		except BaseException:
+			if self.writeDb.in_transaction:
+				self.writeDb.rollback()
+			raise
+		finally:
+			self.writeLock.release()
+
+	def _acquireReader(self, timeout):
+		if self.closed:
+			raise ValueError('pool is closed')
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			pass
+		with self.lock:
+			if self.opened < self.maxReaders:
+				self.opened += 1
+				return openDatabase(self.path, readOnly=True)
+		try:
+			return self.idle.get(timeout=timeout)
+		except queue.Empty:
+			raise TimeoutError('timed out waiting for a reader connection')
+
+	# Close every idle connection and the writer; borrowed readers are closed as they come back
+	def close(self):
+		self.closed = True
+		with self.writeLock:
+			self.writeDb.close()
+		while True:
+			try:
+				self.idle.get_nowait().close()
+			except queue.Empty:
+				break
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
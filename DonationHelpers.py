@@ -1,45 +1,204 @@
 # DonationHelpers.py implements helper functions for manipulating the donation/item/barcode tables
 
 import datetime # For creation/completed donation timestamps
+import csv, json # For barcode catalog import
+import base64 # For opaque page cursors
+import re # For search query tokenizing
+import threading # For the background archiver
+import sqlite3 # For the archiver's sqlite3.Error
+from Schema import commit, afterCommit, transaction, donationState, openDatabase
+from LRUCache import LRUCache
+from BloomFilter import BloomFilter
+
+# Entries kept by each database's barcode cache (see barcodeCache())
+barcodeCacheSize = 4096
+
+# Helper queries. Schema.checkQueryPlans() explains these same statements, so keep every read here.
+# Donation filters, by listing type bits: 11 all, 01 pending, 10 completed
+donationFilters = {
+	0b11: '''donations.provider = ?''',
+	0b01: '''donations.provider = ? AND donations.completed = 0''',
+	0b10: '''donations.provider = ? AND donations.completed != 0'''
+}
+providerDonationsQueries = {
+	0b11: '''SELECT * FROM donations WHERE provider = ?
+		UNION ALL SELECT * FROM donationsArchive WHERE provider = ?''',
+	0b01: '''SELECT * FROM donations WHERE provider = ? AND completed = ?''',
+	0b10: '''SELECT * FROM donations WHERE provider = ? AND completed != ?
+		UNION ALL SELECT * FROM donationsArchive WHERE provider = ?'''
+}
+filteredDonationsQuery = '''SELECT * FROM donations WHERE {0} ORDER BY id'''
+archivedDonationsQuery = '''SELECT * FROM donationsArchive WHERE provider = ? ORDER BY id'''
+filteredItemsQuery = '''SELECT items.* FROM donations JOIN items ON items.did = donations.id
+	WHERE {0}
+	ORDER BY items.did, items.id'''
+archivedItemsQuery = '''SELECT itemsArchive.* FROM donationsArchive JOIN itemsArchive ON itemsArchive.did = donationsArchive.id
+	WHERE donationsArchive.provider = ? ORDER BY itemsArchive.did, itemsArchive.id'''
+donationsPageQuery = '''SELECT * FROM donations WHERE {0} AND (created, id) > (?, ?)
+	ORDER BY created, id LIMIT ?'''
+archivedPageQuery = '''SELECT * FROM donationsArchive WHERE provider = ? AND (created, id) > (?, ?)
+	ORDER BY created, id LIMIT ?'''
+pendingSearchQuery = '''SELECT donations.*, MIN(itemSearch.rank) AS score
+	FROM itemSearch JOIN items ON items.id = itemSearch.rowid JOIN donations ON donations.id = items.did
+	WHERE itemSearch MATCH ? AND donations.receiver = 'pending' AND donations.completed = 0
+	GROUP BY donations.id ORDER BY score, donations.id LIMIT ? OFFSET ?'''
+matchingItemsQuery = '''SELECT items.* FROM itemSearch JOIN items ON items.id = itemSearch.rowid
+	WHERE itemSearch MATCH ? AND items.did IN ({0}) ORDER BY itemSearch.rank'''
+archiveBatchQuery = '''SELECT id FROM donations WHERE completed > 0 AND completed < ?
+	AND id < (SELECT MAX(id) FROM donations) ORDER BY completed LIMIT ?'''
+rollupQuery = '''SELECT provider, title, units, state, items, quantity FROM inventoryRollup
+	ORDER BY provider, title, units'''
+providerRollupQuery = '''SELECT provider, title, units, state, items, quantity FROM inventoryRollup
+	WHERE provider = ? ORDER BY title, units'''
+itemByKeyQuery = '''SELECT id, count FROM items WHERE did=? AND title=? AND units=?'''
+donationItemsQuery = '''SELECT * from items WHERE did = ?
+	UNION ALL SELECT * FROM itemsArchive WHERE did = ?'''
+claimQuery = '''UPDATE donations SET receiver = ? WHERE id = ? AND receiver = 'pending' AND completed = 0'''
+donationExistsQuery = '''SELECT id FROM donations WHERE id=?'''
+itemExistsQuery = '''SELECT id FROM items WHERE id=?'''
+barcodeQuery = '''SELECT title, units FROM barcodes WHERE code = ?'''
+barcodeVersionQuery = '''SELECT version FROM barcodeVersion WHERE id = 1'''
+
+# Guards the barcode versions kept in each database's shared state (see barcodeCache())
+barcodeStateLock = threading.Lock()
 
 # Functions:
 # addBarcode()
+# importBarcodes()
 # addDonation()
 # addItemByManual()
 # addItemByBarcode()
 # listProviderDonations
+# listProviderDonationsWithItems()
+# listProviderDonationsPage()
+# iterProviderDonations()
+# searchPendingDonations()
 # getDonationItems()
 # claimDonation()
+# completeDonations()
+# archiveDonations()
+# getInventoryRollup()
+# verifyInventoryRollup()
+# rebuildInventoryRollup()
 # existDonation()
 # existItem()
 # existBarcode()
+# getBarcode()
+# barcodeCache()
+# enableBarcodeFilter()
+# barcodeFilter()
+# donationStore()
 
 # Function addBarcode()
 # Purpose: insert a new barcode entry into the barcodes table
 # Syntax: addBarcode(<connection>, <barcode>, <title>, <units>)
 # Returns: True if item inserted, else False
 def addBarcode(db, code, title, units):
+	return donationStore(db).addBarcode(code, title, units)
 
-	# Check for existing barcode
+
+# Function importBarcodes()
+# Purpose: stream a barcode catalog file into the barcodes table in chunked transactions
+# Syntax: importBarcodes(<connection>, <file_path>, <on_conflict>, <chunk_size>)
+# Returns: dict of counts {'inserted', 'skipped', 'conflicting'}
+# Note: file is CSV (code,title,units with optional header row) or JSONL ({"code":..,"title":..,"units":..} per line),
+#	chosen by a .jsonl/.ndjson extension. Only one chunk is held in memory at a time.
+# Note: on_conflict is 'ignore' (keep existing row) or 'replace' (overwrite title/units of existing row).
+#	skipped counts exact duplicates of existing rows, repeats within a chunk and malformed rows;
+#	conflicting counts codes already present with a different title or units.
+def importBarcodes(db, path, onConflict='ignore', chunkSize=10000):
+
+	if onConflict not in ('ignore', 'replace'):
+		raise ValueError('onConflict must be "ignore" or "replace"')
+
+	counts = {'inserted': 0, 'skipped': 0, 'conflicting': 0}
 	c = db.cursor()
-	c.execute('''SELECT * FROM barcodes WHERE code = ?''', (code,))
-	if c.fetchone() is not None:
-		c.close()
-		return False
-
-	# Add barcode 
-	c.execute('''INSERT into barcodes(code, title, units) VALUES(?,?,?)''', (code, title, units))
-	
-	# Test success
-	c.execute('''SELECT * FROM barcodes WHERE code = ?''', (code,))
-	result = c.fetchone()
-	db.commit
-	c.close()
 
-	if result is not None:
-		return True
+	# Each chunk is staged in a temp table so conflicts are classified with set-based joins
+	c.execute('''CREATE TEMP TABLE IF NOT EXISTS barcodeStage(
+		code TEXT PRIMARY KEY,
+		title TEXT NOT NULL,
+		units NOT NULL)''')
+
+	chunk = []
+	for row in _readBarcodeRows(path, counts):
+		chunk.append(row)
+		if len(chunk) >= chunkSize:
+			_importBarcodeChunk(db, c, chunk, onConflict, counts)
+			chunk = []
+	if chunk:
+		_importBarcodeChunk(db, c, chunk, onConflict, counts)
+
+	c.execute('''DROP TABLE barcodeStage''')
+	c.close()
+	return counts
+
+
+# Yield (code, title, units) tuples from a CSV or JSONL file, counting malformed rows as skipped
+def _readBarcodeRows(path, counts):
+
+	with open(path, newline='', encoding='utf-8') as f:
+		if path.endswith(('.jsonl', '.ndjson')):
+			for line in f:
+				if not line.strip():
+					continue
+				try:
+					record = json.loads(line)
+					yield (str(record['code']), record['title'], record['units'])
+				except (ValueError, KeyError, TypeError):
+					counts['skipped'] += 1
+		else:
+			for record in csv.reader(f):
+				if len(record) != 3 or not record[0]:
+					if record:
+						counts['skipped'] += 1
+					continue
+				if record == ['code', 'title', 'units']:
+					continue
+				yield (record[0], record[1], record[2])
+
+
+# Apply one staged chunk in a single transaction
+def _importBarcodeChunk(db, c, chunk, onConflict, counts):
+
+	c.execute('''DELETE FROM barcodeStage''')
+	c.executemany('''INSERT OR IGNORE INTO barcodeStage(code, title, units) VALUES(?,?,?)''', chunk)
+	staged = c.rowcount
+	counts['skipped'] += len(chunk) - staged
+
+	c.execute('''SELECT
+		COUNT(*),
+		COALESCE(SUM(b.title != s.title OR b.units != s.units), 0)
+		FROM barcodeStage s JOIN barcodes b ON b.code = s.code''')
+	existing, conflicting = c.fetchone()
+	counts['skipped'] += existing - conflicting
+	counts['conflicting'] += conflicting
+
+	# Codes this chunk adds, so the Bloom filter counts only real insertions toward its capacity
+	added = []
+	if staged > existing and barcodeFilter(db) is not None:
+		c.execute('''SELECT code FROM barcodeStage s WHERE NOT EXISTS (SELECT 1 FROM barcodes b WHERE b.code = s.code)''')
+		added = [row[0] for row in c.fetchall()]
+
+	if onConflict == 'replace':
+		c.execute('''INSERT INTO barcodes(code, title, units) SELECT code, title, units FROM barcodeStage WHERE true
+			ON CONFLICT(code) DO UPDATE SET title = excluded.title, units = excluded.units
+			WHERE title != excluded.title OR units != excluded.units''')
 	else:
-		return False
+		c.execute('''INSERT OR IGNORE INTO barcodes(code, title, units) SELECT code, title, units FROM barcodeStage''')
+	counts['inserted'] += staged - existing
+
+	# The Bloom filter must learn new codes before they become visible
+	changed = _barcodesChanged(db, staged - existing + (conflicting if onConflict == 'replace' else 0), added)
+	commit(db)
+
+	# Replaced rows change title/units of cached codes; drop them once the new values are visible
+	if onConflict == 'replace' and conflicting:
+		cache = barcodeCache(db)
+		if cache is not None:
+			codes = [row[0] for row in chunk]
+			afterCommit(db, lambda: cache.invalidate(codes))
+	afterCommit(db, changed)
 
 
 # Function addDonation()
@@ -48,166 +207,345 @@ def addBarcode(db, code, title, units):
 # Returns: donation.id if donation is successfully created, else -1
 # Note: receiver should be None unless receiver is known in advance
 def addDonation(db, provider, receiver):
-	
-	c = db.cursor()
-	
-	if receiver is None:	
-		# If no receiver specified
-		c.execute('''INSERT INTO donations(provider, created) VALUES(?,?)''', (provider, datetime.datetime.now()))
-	else:	
-		# If receiver specified
-		c.execute('''INSERT INTO donations(provider, receiver, created) VALUES(?,?,?)''', (provider, receiver, datetime.datetime.now))
-	result = c.lastrowid
-	db.commit()
-	c.close()
-
-	if result is not None:	# Per https://www.python.org/dev/peps/pep-0249/#lastrowid no insert returns None
-		return result
-	else: 
-		return -1
+	return donationStore(db).addDonation(provider, receiver)
 
 # Function addItemByManual()
 # Purpose: add a new item to the items table without barcode
 # Syntax: addItemByManual(<connection>, <donation_id>, <title>, <count>, <unit_type>)
-# Returns: item.id if item is successfully created, else -1
+# Returns: item.id if item is successfully created or merged into an existing item, else -1
 # Note: Fails if invalid donation_id
 def addItemByManual(db, did, title, count, unit):
-
-	if not existDonation(db, did):
-		return -1
-
-	# Test for matching item in table
-	c = db.cursor()
-	c.execute('''SELECT id, count FROM items WHERE did=? AND title=? AND units=?''', (did, title, unit))
-	result = c.fetchone()
-
-	# Item in table: add count to existing item
-	if result is not None: 
-		newCount = result[1] + count
-		c.execute('''UPDATE items SET count = ? WHERE id = ?''', (newCount, result[0]))
-
-	# Item not in table: add new item to table
-	else:
-		c.execute('''INSERT INTO items(did, title, count, units) VALUES(?,?,?,?)''', (did, title, count, unit))
-
-	result = c.lastrowid
-	db.commit()
-	c.close()
-
-	if result is not None:	# Per https://www.python.org/dev/peps/pep-0249/#lastrowid no insert returns None
-		return result
-	else: 
-		return -1
+	return donationStore(db).addItemByManual(did, title, count, unit)
 
 # Function addItemByBarcode()
 # Purpose: add a new item to the items table using barcode
 # Syntax: addItemByBarcode(<connection>, <donation_id>, <barcode>, <count>)
-# Returns: item.id if item is successfully created, else -1
+# Returns: item.id if item is successfully created or merged into an existing item, else -1
 # Note: Fails if invalid donation_id or barcode. Defaults to 1 if arg count < 1 for autoscan.
 def addItemByBarcode(db, did, code, count):
-
-	if not existDonation(db, did):
-		return -1
-
-	if not existBarcode(db, code):
-		return -1
-
-	# Permit negative count for quick scanning: 1 code == 1 count
-	if count < 1:
-		count = 1
-
-	# Get barcode data
-	c = db.cursor()
-	c.execute('''SELECT title, units FROM barcodes WHERE code = ?''', (code,))
-	codeData = c.fetchone()
-
-	# Test for matching item in table
-	c.execute('''SELECT id, count FROM items WHERE did=? AND title=? AND units=?''', (did, codeData[0], codeData[1]))
-	result = c.fetchone()
-
-	# Item in table: add count to existing item
-	if result is not None: 
-		newCount = result[1] + count
-		c.execute('''UPDATE items SET count = ?, barcode = ? WHERE id = ?''', (newCount, code, result[0]))
-
-	# Item not in table: add new item to table
-	else:
-		c.execute('''INSERT INTO items(did, barcode, title, count, units) VALUES(?,?,?,?,?)''', (did, code, codeData[0], count, codeData[1]))
-
-	result = c.lastrowid
-	db.commit()
-	c.close()
-
-	if result is not None:	# Per https://www.python.org/dev/peps/pep-0249/#lastrowid no insert returns None
-		return result
-	else: 
-		return -1
+	return donationStore(db).addItemByBarcode(did, code, count)
 
 # Function listProviderDonations()
 # Purpose: returns a list of donations by uid
 # Syntax: listProviderDonations(<connection>, <provider_id>, <donation_filter)
 # Returns: A list of all matching donations or an empty list if no types selected or donations found
 # Note: donation filter is two bit binary selection filter s.t. 00:none, 01:pending, 10:completed, 11:both
+# Note: completed donations include those moved to donationsArchive by archiveDonations()
 def listProviderDonations(db, pid, types):
+	return donationStore(db).listProviderDonations(pid, types)
 
-	c = db.cursor()
+# Function listProviderDonationsWithItems()
+# Purpose: returns a provider's donations together with their items in two queries
+# Syntax: listProviderDonationsWithItems(<connection>, <provider_id>, <donation_filter>)
+# Returns: A list of (donation, [items]) pairs, donations in id order, or an empty list if no types selected or donations found
+# Note: donation filter matches listProviderDonations(); rows match listProviderDonations() and getDonationItems()
+def listProviderDonationsWithItems(db, pid, types):
 
 	# Case no donations
 	if (0b11 & types == 0b00):
 		return []
+	where = donationFilters[0b11 & types]
+
+	# Archived donations are all completed
+	archived = (0b10 & types == 0b10)
+
+	c = db.cursor()
+	c.execute(filteredDonationsQuery.format(where), (pid,))
+	result = [(d, []) for d in c.fetchall()]
+	if archived:
+		c.execute(archivedDonationsQuery, (pid,))
+		result = sorted(result + [(d, []) for d in c.fetchall()])
+	byId = {d[0]: items for d, items in result}
+
+	# Items for every matching donation in one pass, driven by the same donation predicate
+	c.execute(filteredItemsQuery.format(where), (pid,))
+	for item in c.fetchall():
+		# Items of a donation that started matching between the two queries have no donation row; skip them
+		if item[1] in byId:
+			byId[item[1]].append(item)
+	if archived:
+		c.execute(archivedItemsQuery, (pid,))
+		for item in c.fetchall():
+			if item[1] in byId:
+				byId[item[1]].append(item)
+	c.close()
+	return result
+
 
-	# Case all donations
-	elif (0b11 & types == 0b11):
-		c.execute('''SELECT * FROM donations WHERE provider = ?''', (pid,))
+# Function listProviderDonationsPage()
+# Purpose: returns one page of a provider's donations in (created, id) order
+# Syntax: listProviderDonationsPage(<connection>, <provider_id>, <donation_filter>, <page_size>, <cursor>)
+# Returns: (donations, next_cursor); next_cursor is None on the last page
+# Note: donation filter matches listProviderDonations(). Pass cursor None for the first page, then the returned
+#	next_cursor. Cursors are opaque strings that seek straight to the next row, so deep pages cost the same as the first.
+# Note: raises ValueError for a malformed cursor or a page_size below 1
+def listProviderDonationsPage(db, pid, types, pageSize, cursor=None):
 
-	# Case pending donations
-	elif (0b01 & types == 0b01):
-		c.execute('''SELECT * FROM donations WHERE provider = ? AND completed = ?''', (pid, 0))
+	if pageSize < 1:
+		raise ValueError('pageSize must be at least 1')
+
+	# Case no donations
+	if (0b11 & types == 0b00):
+		return [], None
+	where = donationFilters[0b11 & types]
 
-	# Case completed donations
-	elif (0b10 & types == 0b10):
-		c.execute('''SELECT * FROM donations WHERE provider = ? AND completed != ?''', (pid, 0))
+	created, did = _decodePageCursor(cursor)
 
+	# Fetch one extra row to learn whether another page follows
+	c = db.cursor()
+	c.execute(donationsPageQuery.format(where), (pid, created, did, pageSize + 1))
 	result = c.fetchall()
+
+	# Archived donations are all completed: merge the archive's next rows in key order
+	if (0b10 & types == 0b10):
+		c.execute(archivedPageQuery, (pid, created, did, pageSize + 1))
+		result = sorted(result + c.fetchall(), key=lambda row: (row[3], row[0]))[:pageSize + 1]
+	c.close()
+
+	if len(result) > pageSize:
+		result = result[:pageSize]
+		return result, _encodePageCursor(result[-1][3], result[-1][0])
+	return result, None
+
+
+# Function iterProviderDonations()
+# Purpose: yields a provider's donations in (created, id) order without building the full list
+# Syntax: iterProviderDonations(<connection>, <provider_id>, <donation_filter>, <page_size>)
+# Returns: a generator of donation rows
+# Note: reads one page at a time, so no read transaction is held open while the caller works between pages
+def iterProviderDonations(db, pid, types, pageSize=500):
+
+	cursor = None
+	while True:
+		result, cursor = listProviderDonationsPage(db, pid, types, pageSize, cursor)
+		for row in result:
+			yield row
+		if cursor is None:
+			return
+
+
+# Page cursors carry the last (created, id) seen
+def _encodePageCursor(created, did):
+	return base64.urlsafe_b64encode(json.dumps([created, did]).encode()).decode()
+
+def _decodePageCursor(cursor):
+	# Every created timestamp sorts after the empty string
+	if cursor is None:
+		return '', 0
+	try:
+		created, did = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+	except (ValueError, TypeError):
+		raise ValueError('invalid page cursor')
+	return created, did
+
+
+# Function searchPendingDonations()
+# Purpose: find unclaimed, uncompleted donations containing items that match a text query
+# Syntax: searchPendingDonations(<connection>, <query_text>, <page_size>, <page>)
+# Returns: A list of (donation, [matching items]) pairs, best match first, or an empty list if none found
+# Note: every word of query_text must appear in an item title or its barcode title ("ground beef" matches
+#	"Ground Beef 80/20"). Matching runs on the itemSearch FTS5 index; items are only read by id.
+# Note: page counts from 0
+def searchPendingDonations(db, text, pageSize=20, page=0):
+
+	# Quote each word so user text is never parsed as FTS5 query syntax
+	words = re.findall(r'\w+', text)
+	if not words:
+		return []
+	match = ' '.join('"{0}"'.format(word) for word in words)
+
+	c = db.cursor()
+	c.execute(pendingSearchQuery, (match, pageSize, page * pageSize))
+	result = [(row[:-1], []) for row in c.fetchall()]
+	if not result:
+		c.close()
+		return []
+
+	# Matching items for this page's donations only
+	byId = {d[0]: items for d, items in result}
+	c.execute(matchingItemsQuery.format(','.join('?' * len(byId))), [match] + list(byId))
+	for item in c.fetchall():
+		byId[item[1]].append(item)
 	c.close()
-	return result		
-	
+	return result
+
 
 # Function getDonationItems()
 # Purpose: returns a list of items by did
 # Syntax: getDonationItems(<connection>, <donation_id>)
 # Returns: A list of all matching items, or an empty list if none found.
+# Note: finds the items of archived donations too
 def getDonationItems(db, did):
-
-	c = db.cursor()
-	c.execute('''SELECT * from items WHERE did = ?''', (did,))
-	result = c.fetchall()
-	c.close()
-	return result
+	return donationStore(db).getDonationItems(did)
 
 
 # Function claimDonation()
 # Purpose: assign a receiver to an unclaimed donation
 # Syntax: claimDonation(<connection>, <donation_id>, <recevier_uid>)
 # Returns: On successful update to donation receiver field returns True, else False
+# Note: one conditional UPDATE checks and claims atomically, so of any number of racing receivers
+#	on any number of connections exactly one sees its row change
 def claimDonation(db, did, rid):
+	return donationStore(db).claimDonation(did, rid)
+
+
+# Function completeDonations()
+# Purpose: mark many donations completed at once
+# Syntax: completeDonations(<connection>, <donation_id_list>, <completed_time>)
+# Returns: the number of donations completed; already completed or unknown ids are skipped
+# Note: completed_time defaults to now. All ids are completed in one statement batch and one commit.
+def completeDonations(db, dids, when=None):
+
+	if when is None:
+		when = datetime.datetime.now()
 
-	final = False
 	c = db.cursor()
-	c.execute('''SELECT receiver, completed FROM donations WHERE id = ?''', (did,))
-	result = c.fetchone()
-
-	if result is not None:
-		if (result[0] == 'pending') and (result[1] == 0):
-			c.execute('''UPDATE donations SET receiver = ? WHERE id = ?''', (rid, did))
-			c.execute('''SELECT receiver, completed FROM donations WHERE id = ?''', (did,))
-			result = c.fetchone()
-			if result is not None:
-				if (result[0] == rid) and (result[1] == 0):
-					final = True
-	db.commit
+	c.executemany('''UPDATE donations SET completed = ? WHERE id = ? AND completed = 0''', [(when, did) for did in dids])
+	result = c.rowcount
+	commit(db)
+	c.close()
+	return result
+
+
+# Function archiveDonations()
+# Purpose: move donations completed before a cutoff, with their items, into donationsArchive/itemsArchive
+# Syntax: archiveDonations(<connection>, <cutoff_time>, <batch_size>, <max_batches>)
+# Returns: the number of donations archived
+# Note: each batch of at most batch_size donations is its own short transaction, so writers are never stalled
+#	for long. max_batches None runs until nothing older than the cutoff remains.
+# Note: the newest donation is never archived, so SQLite cannot hand its id out again to a new donation
+def archiveDonations(db, cutoff, batchSize=500, maxBatches=None):
+
+	total = 0
+	batches = 0
+	c = db.cursor()
+	while maxBatches is None or batches < maxBatches:
+		with transaction(db):
+			c.execute(archiveBatchQuery, (cutoff, batchSize))
+			dids = [row[0] for row in c.fetchall()]
+			if not dids:
+				break
+			marks = ','.join('?' * len(dids))
+
+			# Copy before deleting, items before donations: the rollup triggers rely on this order
+			c.execute('''INSERT INTO donationsArchive SELECT * FROM donations WHERE id IN ({0})'''.format(marks), dids)
+			c.execute('''INSERT INTO itemsArchive SELECT * FROM items WHERE did IN ({0})'''.format(marks), dids)
+			c.execute('''DELETE FROM items WHERE did IN ({0})'''.format(marks), dids)
+			c.execute('''DELETE FROM donations WHERE id IN ({0})'''.format(marks), dids)
+		total += len(dids)
+		batches += 1
+	c.close()
+	return total
+
+
+# Class Archiver
+# Purpose: background thread that archives donations completed more than age ago, every interval seconds
+# Syntax: archiver = Archiver(<database_path>, <age_timedelta>, <interval_seconds>, <batch_size>); archiver.start(); ... archiver.stop()
+# Note: uses its own connection; each batch is a separate transaction, so it interleaves with request writers
+# Note: a pass that fails with any sqlite3.Error (e.g. "database is locked" past the busy timeout, or an integrity
+#	error) is rolled back and retried at the next interval. failures counts them and lastError holds the most recent
+#	exception, None once a pass succeeds.
+class Archiver(threading.Thread):
+
+	def __init__(self, path, age=datetime.timedelta(days=30), interval=60.0, batchSize=500):
+		threading.Thread.__init__(self, name='archiver', daemon=True)
+		self.path = path
+		self.age = age
+		self.interval = interval
+		self.batchSize = batchSize
+		self.stopping = threading.Event()
+		self.archived = 0
+		self.failures = 0
+		self.lastError = None
+
+	def run(self):
+		db = openDatabase(self.path)
+		try:
+			while not self.stopping.is_set():
+				try:
+					self.archived += archiveDonations(db, datetime.datetime.now() - self.age, self.batchSize)
+					self.lastError = None
+				except sqlite3.Error as e:
+					if db.in_transaction:
+						db.rollback()
+					self.failures += 1
+					self.lastError = e
+				self.stopping.wait(self.interval)
+		finally:
+			db.close()
+
+	def stop(self):
+		self.stopping.set()
+		self.join()
+
+
+# Function getInventoryRollup()
+# Purpose: returns item totals per provider, title and units, split by donation state
+# Syntax: getInventoryRollup(<connection>, <provider_id>)
+# Returns: A list of (provider, title, units, state, items, quantity), or an empty list if none
+# Note: state is 'pending' (unclaimed), 'claimed' or 'completed'; items counts item rows and quantity sums their counts.
+#	Totals come from the trigger-maintained inventoryRollup table, not from scanning items.
+# Note: provider None returns every provider
+def getInventoryRollup(db, pid=None):
+
+	c = db.cursor()
+	if pid is None:
+		c.execute(rollupQuery)
+	else:
+		c.execute(providerRollupQuery, (pid,))
+	result = c.fetchall()
+	c.close()
+	return result
+
+
+# Recompute every rollup row from items and donations, hot and archived
+rollupFromScratch = '''SELECT provider, title, units, state, COUNT(*) AS items, SUM(count) AS quantity FROM (
+	SELECT donations.provider, items.title, items.units, {0} AS state, items.count
+		FROM items JOIN donations ON donations.id = items.did
+	UNION ALL
+	SELECT donationsArchive.provider, itemsArchive.title, itemsArchive.units, 'completed', itemsArchive.count
+		FROM itemsArchive JOIN donationsArchive ON donationsArchive.id = itemsArchive.did)
+	GROUP BY 1, 2, 3, 4'''.format(donationState.format('donations'))
+
+
+# Function verifyInventoryRollup()
+# Purpose: compare the maintained rollup against totals recomputed from scratch
+# Syntax: verifyInventoryRollup(<connection>)
+# Returns: A list of (provider, title, units, state, expected_items, expected_quantity, actual_items, actual_quantity)
+#	for every row that drifted (missing rows report None), or an empty list if the rollup is exact
+# Note: reads every item; meant for maintenance, not request paths
+def verifyInventoryRollup(db):
+
+	c = db.cursor()
+	c.execute('''WITH expected AS (''' + rollupFromScratch + ''')
+		SELECT e.provider, e.title, e.units, e.state, e.items, e.quantity, r.items, r.quantity
+		FROM expected e LEFT JOIN inventoryRollup r
+		ON r.provider = e.provider AND r.title = e.title AND r.units = e.units AND r.state = e.state
+		WHERE r.items IS NOT e.items OR r.quantity IS NOT e.quantity
+		UNION ALL
+		SELECT r.provider, r.title, r.units, r.state, NULL, NULL, r.items, r.quantity
+		FROM inventoryRollup r LEFT JOIN expected e
+		ON r.provider = e.provider AND r.title = e.title AND r.units = e.units AND r.state = e.state
+		WHERE e.provider IS NULL''')
+	result = c.fetchall()
 	c.close()
-	return final
+	return result
+
+
+# Function rebuildInventoryRollup()
+# Purpose: replace the rollup with totals recomputed from scratch
+# Syntax: rebuildInventoryRollup(<connection>)
+# Returns: the drift found before rebuilding, as verifyInventoryRollup() reports it
+def rebuildInventoryRollup(db):
+
+	with transaction(db):
+		drift = verifyInventoryRollup(db)
+		if drift:
+			c = db.cursor()
+			c.execute('''DELETE FROM inventoryRollup''')
+			c.execute('''INSERT INTO inventoryRollup(provider, title, units, state, items, quantity) ''' + rollupFromScratch)
+			c.close()
+	return drift
 
 
 # Function existDonation() 
@@ -216,16 +554,7 @@ def claimDonation(db, did, rid):
 # Returns: True if donation exists / False if donation does not exist
 # Note: id is primary key, so 0 and 1 are only lengths possible
 def existDonation(db, did):
-	
-	c = db.cursor()
-	c.execute('''SELECT id FROM donations WHERE id=?''', (did,))
-	result = c.fetchone()
-	c.close()
-
-	if result is not None:
-		return True
-	else:
-		return False
+	return donationStore(db).existDonation(did)
 
 
 # Function existItem() 
@@ -234,16 +563,7 @@ def existDonation(db, did):
 # Returns: True if item exists / False if item does not exist
 # Note: id is primary key, so 0 and 1 are only lengths possible
 def existItem(db, iid):
-	
-	c = db.cursor()
-	c.execute('''SELECT id FROM items WHERE id=?''', (iid,))
-	result = c.fetchone()
-	c.close()
-
-	if result is not None:
-		return True
-	else:
-		return False
+	return donationStore(db).existItem(iid)
 
 
 # Function existBarcode() 
@@ -252,13 +572,424 @@ def existItem(db, iid):
 # Returns: True if barcode exists / False if barcode does not exist
 # Note: code is unique column, so 0 and 1 are only lengths possible
 def existBarcode(db, code):
-	
+	return donationStore(db).existBarcode(code)
+
+
+# Function getBarcode()
+# Purpose: Look up a barcode's title and units, reading through the barcode cache
+# Syntax: getBarcode(<connection>, <barcode>)
+# Returns: (title, units) if barcode exists, else None
+def getBarcode(db, code):
+	return donationStore(db).getBarcode(code)
+
+
+# Function barcodeCache()
+# Purpose: Get the LRU cache of barcode records shared by all connections to this database
+# Syntax: barcodeCache(<connection>)
+# Returns: the LRUCache, or None for connections not opened by Schema.openDatabase()
+# Note: cache.stats() reports hits, misses and evictions
+# Note: barcodeVersion counts every barcode change. getBarcode() reads it whenever PRAGMA data_version shows another
+#	connection committed, and clears the cache if it moved past what this process's own writes account for, so
+#	changes from other processes (e.g. Manage.py importBarcodes --replace) are seen without a restart.
+def barcodeCache(db):
+
+	shared = getattr(db, 'shared', None)
+	if shared is None:
+		return None
+	cache = shared.get('barcodeCache')
+	if cache is None:
+		cache = shared.setdefault('barcodeCache', LRUCache(barcodeCacheSize))
+	return cache
+
+
+# Function enableBarcodeFilter()
+# Purpose: Build a Bloom filter over barcodes.code so getBarcode() rejects unknown codes without SQL
+# Syntax: enableBarcodeFilter(<connection>, <false_positive_rate>)
+# Returns: the BloomFilter, shared by all connections to this database, or None if connection not from Schema.openDatabase()
+# Note: sized at twice the current catalog so addBarcode()/importBarcodes() can grow it in place; it is rebuilt
+#	at double size once it fills. The filter is tagged with the barcodeVersion it holds (see barcodeCache()): once
+#	another process changes barcodes, getBarcode() bypasses it until it is rebuilt from a read snapshot.
+# Note: calling again rebuilds from the table, e.g. with a different false-positive rate
+# Note: the rebuild holds the database write lock, so needs a writable connection. Writers add a code to the filter
+#	while holding that lock, so no code can be committed between reading the table and swapping in the new filter.
+def enableBarcodeFilter(db, fpRate=0.01):
+
+	shared = getattr(db, 'shared', None)
+	if shared is None:
+		return None
+
+	with transaction(db):
+		bloom = _buildBarcodeFilter(db, fpRate)
+		version = db.execute(barcodeVersionQuery).fetchone()[0]
+		afterCommit(db, lambda: _tagBarcodeFilter(db, bloom, None, version))
+	return bloom
+
+
+# Read every code into a new filter and make it current; the caller holds the write lock
+# Note: the new filter has no version until the caller commits and tags it
+def _buildBarcodeFilter(db, fpRate):
+
+	c = db.cursor()
+	bloom = _readBarcodeFilter(c, fpRate)
+	c.close()
+
+	db.shared['barcodeFilter'] = bloom
+	return bloom
+
+
+# A new filter holding every code the cursor can see
+def _readBarcodeFilter(c, fpRate):
+
+	c.execute('''SELECT COUNT(*) FROM barcodes''')
+	bloom = BloomFilter(max(2 * c.fetchone()[0], 1024), fpRate)
+	c.execute('''SELECT code FROM barcodes''')
+	bloom.update(row[0] for row in c)
+	return bloom
+
+
+# Mark a filter as holding every code up to barcodeVersion after, if it held every code up to before
+def _tagBarcodeFilter(db, bloom, before, after):
+
+	with barcodeStateLock:
+		db.shared['barcodeVersion'] = max(db.shared.get('barcodeVersion', after), after)
+		if bloom.version == before:
+			bloom.version = after
+
+
+# The Bloom filter, if it holds every code up to the latest barcodeVersion this process knows of
+# Returns: the filter, or None to bypass it for this call: filter disabled, or stale and not rebuilt (see below)
+# Note: a stale filter (another process changed barcodes) is rebuilt from a read snapshot, so reader connections can
+#	do it without the write lock. A writer committing meanwhile tags only the filter it added its codes to, which
+#	leaves the new one behind barcodeVersion, to be rebuilt again.
+def _currentBarcodeFilter(db):
+
+	shared = db.shared
+	bloom = shared.get('barcodeFilter')
+	if bloom is None or bloom.version == shared.get('barcodeVersion'):
+		return bloom
+
+	# One rebuild at a time; other threads, and calls inside a transaction, bypass the filter meanwhile
+	lock = shared.setdefault('barcodeFilterLock', threading.Lock())
+	if db.in_transaction or not lock.acquire(blocking=False):
+		return None
+	try:
+		c = db.cursor()
+		c.execute('''BEGIN''')
+		try:
+			fresh = _readBarcodeFilter(c, bloom.fpRate)
+			c.execute(barcodeVersionQuery)
+			version = c.fetchone()[0]
+		finally:
+			c.execute('''COMMIT''')
+			c.close()
+
+		with barcodeStateLock:
+			fresh.version = version
+			shared['barcodeVersion'] = max(shared.get('barcodeVersion', version), version)
+			if shared.get('barcodeFilter') is bloom:
+				shared['barcodeFilter'] = fresh
+			bloom = shared['barcodeFilter']
+			return bloom if bloom.version == shared['barcodeVersion'] else None
+	finally:
+		lock.release()
+
+
+# Function barcodeFilter()
+# Purpose: Get the Bloom filter built by enableBarcodeFilter()
+# Syntax: barcodeFilter(<connection>)
+# Returns: the BloomFilter, or None if not enabled. stats() reports nbytes and the estimated false-positive rate
+def barcodeFilter(db):
+
+	shared = getattr(db, 'shared', None)
+	if shared is None:
+		return None
+	return shared.get('barcodeFilter')
+
+
+# Account for this connection's own barcode writes: add new codes to the Bloom filter (rebuilding it larger once it
+#	reaches capacity), and keep other connections from taking the writes for an outside change
+# Syntax: changed = _barcodesChanged(<connection>, <rows_changed>, <new_codes>); commit(<connection>); afterCommit(<connection>, changed)
+# Returns: a callback to run once the writes commit
+# Note: called after the writes and before their commit, so the caller holds the write lock and no rebuild can be
+#	reading the table; a rebuild here already sees the caller's uncommitted rows.
+# Note: the callback advances the cache and the filter past the writes only if they were current just before them,
+#	so any write they do not account for still clears the cache and makes the filter stale.
+def _barcodesChanged(db, changes, added=()):
+
+	shared = getattr(db, 'shared', None)
+	if shared is None or changes == 0:
+		return lambda: None
+
+	bloom = shared.get('barcodeFilter')
+	rebuilt = False
+	if bloom is not None and added:
+		bloom.update(added)
+		if bloom.count > bloom.capacity:
+			bloom = _buildBarcodeFilter(db, bloom.fpRate)
+			rebuilt = True
+
 	c = db.cursor()
-	c.execute('''SELECT code FROM barcodes WHERE code=?''', (code,))
-	result = c.fetchone()
+	c.execute(barcodeVersionQuery)
+	after = c.fetchone()[0]
 	c.close()
+	before = after - changes
+
+	def changed():
+		if bloom is not None:
+			_tagBarcodeFilter(db, bloom, None if rebuilt else before, after)
+		with barcodeStateLock:
+			shared['barcodeVersion'] = max(shared.get('barcodeVersion', after), after)
+			if shared.get('cacheVersion') == before:
+				shared['cacheVersion'] = after
+	return changed
+
+
+# Function donationStore()
+# Purpose: Get the DonationStore bound to a connection, creating it on first use
+# Syntax: donationStore(<connection>)
+# Returns: the connection's DonationStore; connections not opened by Schema.openDatabase() get a new, unshared one
+def donationStore(db):
+
+	stores = getattr(db, 'stores', None)
+	if stores is None:
+		return DonationStore(db)
+	store = stores.get('donations')
+	if store is None:
+		store = stores['donations'] = DonationStore(db)
+	return store
+
+
+# Class DonationStore
+# Purpose: the per-request donation/item/barcode helpers, bound to one connection
+# Syntax: store = donationStore(<connection>)
+#	store.addItemByBarcode(<donation_id>, <barcode>, <count>)	# and the other methods below, minus the connection argument
+# Note: the free functions above are thin wrappers over the connection's store. The store keeps one cursor for all
+#	its calls, and its SQL is fixed text, so every statement is prepared once and then served from the connection's
+#	statement cache (Schema.statementCacheSize).
+# Note: each method reads its whole result before returning. Like its connection, a store serves one thread at a time.
+class DonationStore:
+
+	def __init__(self, db):
+		self.db = db
+		self.cursor = db.cursor()
+
+	def addBarcode(self, code, title, units):
+
+		# Insert unless code already present; rowcount is 0 when the existing row wins
+		c = self.cursor
+		c.execute('''INSERT OR IGNORE INTO barcodes(code, title, units) VALUES(?,?,?)''', (code, title, units))
+		result = c.rowcount
+
+		# The Bloom filter must learn the code before it becomes visible; false positives are harmless
+		changed = _barcodesChanged(self.db, result, (code,))
+		commit(self.db)
+
+		# A new code is never cached, but drop any entry so the cache cannot outlive a direct table edit
+		cache = barcodeCache(self.db)
+		if cache is not None:
+			afterCommit(self.db, lambda: cache.invalidate((code,)))
+		afterCommit(self.db, changed)
+
+		if result == 1:
+			return True
+		else:
+			return False
+
+	def addDonation(self, provider, receiver):
+
+		c = self.cursor
+		if receiver is None:
+			# If no receiver specified
+			c.execute('''INSERT INTO donations(provider, created) VALUES(?,?)''', (provider, datetime.datetime.now()))
+		else:
+			# If receiver specified
+			c.execute('''INSERT INTO donations(provider, receiver, created) VALUES(?,?,?)''', (provider, receiver, datetime.datetime.now()))
+		result = c.lastrowid
+		commit(self.db)
+
+		if result is not None:	# Per https://www.python.org/dev/peps/pep-0249/#lastrowid no insert returns None
+			return result
+		else:
+			return -1
+
+	def addItemByManual(self, did, title, count, unit):
+
+		if not self.existDonation(did):
+			return -1
+
+		# Test for matching item in table
+		c = self.cursor
+		c.execute(itemByKeyQuery, (did, title, unit))
+		result = c.fetchone()
+
+		# Item in table: add count to existing item
+		if result is not None:
+			newCount = result[1] + count
+			c.execute('''UPDATE items SET count = ? WHERE id = ?''', (newCount, result[0]))
+			result = result[0]
+
+		# Item not in table: add new item to table
+		else:
+			c.execute('''INSERT INTO items(did, title, count, units) VALUES(?,?,?,?)''', (did, title, count, unit))
+			result = c.lastrowid
+
+		commit(self.db)
+
+		if result is not None:	# Per https://www.python.org/dev/peps/pep-0249/#lastrowid no insert returns None
+			return result
+		else:
+			return -1
+
+	def addItemByBarcode(self, did, code, count):
+
+		if not self.existDonation(did):
+			return -1
+
+		# Get barcode data
+		codeData = self.getBarcode(code)
+		if codeData is None:
+			return -1
+
+		# Permit negative count for quick scanning: 1 code == 1 count
+		if count < 1:
+			count = 1
+
+		# Test for matching item in table
+		c = self.cursor
+		c.execute(itemByKeyQuery, (did, codeData[0], codeData[1]))
+		result = c.fetchone()
+
+		# Item in table: add count to existing item
+		if result is not None:
+			newCount = result[1] + count
+			c.execute('''UPDATE items SET count = ?, barcode = ? WHERE id = ?''', (newCount, code, result[0]))
+			result = result[0]
+
+		# Item not in table: add new item to table
+		else:
+			c.execute('''INSERT INTO items(did, barcode, title, count, units) VALUES(?,?,?,?,?)''', (did, code, codeData[0], count, codeData[1]))
+			result = c.lastrowid
+
+		commit(self.db)
+
+		if result is not None:	# Per https://www.python.org/dev/peps/pep-0249/#lastrowid no insert returns None
+			return result
+		else:
+			return -1
+
+	def listProviderDonations(self, pid, types):
+
+		c = self.cursor
+
+		# Case no donations
+		if (0b11 & types == 0b00):
+			return []
+
+		# Case all donations
+		elif (0b11 & types == 0b11):
+			c.execute(providerDonationsQueries[0b11], (pid, pid))
+
+		# Case pending donations
+		elif (0b01 & types == 0b01):
+			c.execute(providerDonationsQueries[0b01], (pid, 0))
+
+		# Case completed donations
+		elif (0b10 & types == 0b10):
+			c.execute(providerDonationsQueries[0b10], (pid, 0, pid))
+
+		return c.fetchall()
+
+	def getDonationItems(self, did):
+
+		c = self.cursor
+		c.execute(donationItemsQuery, (did, did))
+		return c.fetchall()
 
-	if result is not None:
+	def claimDonation(self, did, rid):
+
+		c = self.cursor
+		c.execute(claimQuery, (rid, did))
+		final = (c.rowcount == 1)
+		commit(self.db)
+		return final
+
+	def existDonation(self, did):
+
+		c = self.cursor
+		c.execute(donationExistsQuery, (did,))
+		if c.fetchone() is not None:
+			return True
+		else:
+			return False
+
+	def existItem(self, iid):
+
+		c = self.cursor
+		c.execute(itemExistsQuery, (iid,))
+		if c.fetchone() is not None:
+			return True
+		else:
+			return False
+
+	def existBarcode(self, code):
+
+		if self.getBarcode(code) is not None:
+			return True
+		else:
+			return False
+
+	def getBarcode(self, code):
+
+		# A miss in a current Bloom filter is definite: skip the cache and the query
+		current = self._syncBarcodes()
+		bloom = _currentBarcodeFilter(self.db) if current and self.db.shared is not None else None
+		if bloom is not None and code not in bloom:
+			return None
+
+		cache = barcodeCache(self.db) if current else None
+		if cache is not None:
+			result = cache.get(code)
+			if result is not None:
+				return result
+			token = cache.generation
+
+		c = self.cursor
+		c.execute(barcodeQuery, (code,))
+		result = c.fetchone()
+
+		# Only hits are cached: a later addBarcode() must be visible immediately.
+		# Inside a transaction the row may be our own uncommitted write, which a rollback would orphan.
+		if result is not None and cache is not None and not self.db.in_transaction:
+			cache.put(code, result, token)
+		return result
+
+	# Catch up with barcode writes committed by other connections, including other processes, and clear the cache if
+	#	any are not accounted for (see barcodeCache())
+	# Returns: True if the cache is current, or False to bypass it and the Bloom filter for this call
+	# Note: PRAGMA data_version changes only when another connection commits, so barcodeVersion is read only then.
+	#	Inside a transaction it could include this connection's uncommitted writes, so it waits until the commit.
+	def _syncBarcodes(self):
+
+		db = self.db
+		shared = getattr(db, 'shared', None)
+		if shared is None:
+			return True
+
+		c = self.cursor
+		c.execute('''PRAGMA data_version''')
+		dataVersion = c.fetchone()[0]
+		if dataVersion != db.dataVersion:
+			if db.in_transaction:
+				return False
+			c.execute(barcodeVersionQuery)
+			version = c.fetchone()[0]
+			db.dataVersion = dataVersion
+			with barcodeStateLock:
+				shared['barcodeVersion'] = max(shared.get('barcodeVersion', version), version)
+
+		if shared.get('cacheVersion') != shared.get('barcodeVersion'):
+			with barcodeStateLock:
+				if shared.get('cacheVersion') != shared.get('barcodeVersion'):
+					barcodeCache(db).invalidate()
+					shared['cacheVersion'] = shared.get('barcodeVersion')
 		return True
-	else:
-		return False
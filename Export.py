@@ -0,0 +1,177 @@
+# Export.py implements a columnar export of items and donations for reporting, and aggregations over it
+#
+# Requires NumPy ("pip install numpy"); the rest of the project does not.
+
+import os, json
+
+try:
+	import numpy
+	from numpy.lib.format import open_memmap
+except ImportError:
+	numpy = None
+
+# Functions:
+# exportColumns()
+# loadColumns()
+# quantityByUnit()
+# quantityByTitle()
+# donationsPerProviderPerDay()
+
+# Rows fetched from SQLite per step while filling the column files
+exportChunkSize = 100000
+
+# Columns written by exportColumns(): file name -> dtype. Strings are dictionary-encoded into int32 codes.
+itemColumns = [
+	('itemId', 'int64'),
+	('itemDonation', 'int64'),
+	('itemTitle', 'int32'),
+	('itemUnits', 'int32'),
+	('itemCount', 'int64')
+]
+donationColumns = [
+	('donationId', 'int64'),
+	('donationProvider', 'int32'),
+	('donationCreated', 'datetime64[D]'),
+	('donationCompleted', 'datetime64[D]')	# NaT while pending
+]
+
+
+def _requireNumpy():
+	if numpy is None:
+		raise ImportError('Export.py requires NumPy: pip install numpy')
+
+
+# Write one table's query result into memory-mapped .npy column files, one chunk at a time
+# Note: the caller holds a read transaction, so the count and the rows come from the same snapshot
+def _exportTable(db, directory, columns, countQuery, query, encoders):
+
+	c = db.cursor()
+	c.execute(countQuery)
+	total = c.fetchone()[0]
+	arrays = [open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype, shape=(total,)) for name, dtype in columns]
+
+	c.execute(query)
+	at = 0
+	while True:
+		rows = c.fetchmany(exportChunkSize)
+		if not rows:
+			break
+		for n, values in enumerate(zip(*rows)):
+			if n in encoders:
+				codes = encoders[n]
+				values = [codes.setdefault(v, len(codes)) for v in values]
+			arrays[n][at:at + len(rows)] = values
+		at += len(rows)
+	c.close()
+
+	for a in arrays:
+		a.flush()
+	return at
+
+
+# Function exportColumns()
+# Purpose: stream items and donations, hot and archived, into memory-mappable NumPy column files
+# Syntax: exportColumns(<connection>, <directory>)
+# Returns: a dict with the number of items and donations exported
+# Note: writes one <column>.npy file per entry of itemColumns/donationColumns, plus dictionary.json holding the
+#	strings behind the title, units and provider codes. Memory use is bounded by exportChunkSize, not table size.
+# Note: both tables are read in one read transaction, a consistent cut that concurrent writers and the archiver
+#	cannot change between the row counts and the rows. Inside a caller's transaction, that transaction is the cut.
+def exportColumns(db, directory):
+
+	_requireNumpy()
+	os.makedirs(directory, exist_ok=True)
+
+	snapshot = not db.in_transaction
+	if snapshot:
+		db.execute('''BEGIN''')
+	try:
+		return _exportColumns(db, directory)
+	finally:
+		if snapshot:
+			db.rollback()	# Nothing was written
+
+
+def _exportColumns(db, directory):
+
+	titles, units, providers = {}, {}, {}
+	items = _exportTable(db, directory, itemColumns,
+		'''SELECT (SELECT COUNT(*) FROM items) + (SELECT COUNT(*) FROM itemsArchive)''',
+		'''SELECT id, did, title, units, count FROM items
+			UNION ALL SELECT id, did, title, units, count FROM itemsArchive''',
+		{2: titles, 3: units})
+
+	donations = _exportTable(db, directory, donationColumns,
+		'''SELECT (SELECT COUNT(*) FROM donations) + (SELECT COUNT(*) FROM donationsArchive)''',
+		'''SELECT id, provider, substr(created, 1, 10), CASE WHEN completed = 0 THEN NULL ELSE substr(completed, 1, 10) END FROM donations
+			UNION ALL SELECT id, provider, substr(created, 1, 10), substr(completed, 1, 10) FROM donationsArchive''',
+		{1: providers})
+
+	with open(os.path.join(directory, 'dictionary.json'), 'w') as f:
+		json.dump({'itemTitle': list(titles), 'itemUnits': list(units), 'donationProvider': list(providers)}, f)
+
+	return {'items': items, 'donations': donations}
+
+
+# Function loadColumns()
+# Purpose: open an export written by exportColumns()
+# Syntax: loadColumns(<directory>, <memory_map>)
+# Returns: a dict of column name -> array, plus 'dictionary': column name -> list of strings indexed by code
+# Note: with memory_map True (the default) columns are paged in from disk on demand rather than read up front
+def loadColumns(directory, mmap=True):
+
+	_requireNumpy()
+	result = {}
+	for name, dtype in itemColumns + donationColumns:
+		result[name] = numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+	with open(os.path.join(directory, 'dictionary.json')) as f:
+		result['dictionary'] = json.load(f)
+	return result
+
+
+# Function quantityByUnit()
+# Purpose: total item count per unit type
+# Syntax: quantityByUnit(<columns>)
+# Returns: a dict of units -> total count
+def quantityByUnit(columns):
+
+	_requireNumpy()
+	names = columns['dictionary']['itemUnits']
+	totals = numpy.bincount(columns['itemUnits'], weights=columns['itemCount'], minlength=len(names))
+	return {names[n]: int(total) for n, total in enumerate(totals)}
+
+
+# Function quantityByTitle()
+# Purpose: total item count and number of item rows per (title, units)
+# Syntax: quantityByTitle(<columns>)
+# Returns: a dict of (title, units) -> (items, quantity)
+def quantityByTitle(columns):
+
+	_requireNumpy()
+	titles = columns['dictionary']['itemTitle']
+	units = columns['dictionary']['itemUnits']
+	key = columns['itemTitle'].astype('int64') * len(units) + columns['itemUnits']
+	keys, inverse, counts = numpy.unique(key, return_inverse=True, return_counts=True)
+	quantities = numpy.bincount(inverse, weights=columns['itemCount'], minlength=len(keys))
+	return {(titles[k // len(units)], units[k % len(units)]): (int(n), int(q)) for k, n, q in zip(keys, counts, quantities)}
+
+
+# Function donationsPerProviderPerDay()
+# Purpose: number of donations each provider created on each day
+# Syntax: donationsPerProviderPerDay(<columns>)
+# Returns: a list of (provider, 'YYYY-MM-DD', donations) ordered by provider, then day
+# Note: donations without a created date are left out
+def donationsPerProviderPerDay(columns):
+
+	_requireNumpy()
+	providers = columns['dictionary']['donationProvider']
+	created = columns['donationCreated']
+	dated = ~numpy.isnat(created)
+	if not dated.any():
+		return []
+	days = created[dated].astype('int64')
+	first = days.min()
+	span = days.max() - first + 1
+	key = columns['donationProvider'][dated].astype('int64') * span + (days - first)
+	keys, counts = numpy.unique(key, return_counts=True)
+	return sorted((providers[k // span], str(numpy.datetime64(int(first + k % span), 'D')), int(n)) for k, n in zip(keys, counts))
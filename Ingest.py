@@ -0,0 +1,198 @@
+# Ingest.py implements parallel ingestion of warehouse scan manifests into items
+#
+# A manifest is a CSV file of (did, barcode, count) rows, optionally with that header, or a JSONL file of
+# {"did": ..., "barcode": ..., "count": ...} records. Each row means addItemByBarcode(db, did, barcode, count).
+
+import os, csv, json, time, queue, threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from Schema import transaction, openDatabase
+
+# Functions:
+# ingestManifest()
+
+# Lines handed to a parser process at a time
+ingestChunkRows = 20000
+
+# Merged item rows the writer collects before applying them in one transaction
+ingestWriteRows = 200000
+
+# SQLite's default limit on bound parameters is 999; stay well below it per IN list
+lookupChunk = 500
+
+# Catalog of the parser process: a read-only connection, or a dict copied from an in-memory database
+workerCatalog = None
+workerCodes = {}
+
+
+def _initWorker(path, catalog):
+	global workerCatalog, workerCodes
+	workerCatalog = openDatabase(path, readOnly=True) if catalog is None else None
+	workerCodes = {} if catalog is None else catalog
+
+
+# Resolve codes not yet seen by this process; unknown codes are remembered as None
+def _resolveCodes(codes):
+	missing = [code for code in codes if code not in workerCodes]
+	if workerCatalog is None:
+		for code in missing:
+			workerCodes[code] = None
+		return
+	c = workerCatalog.cursor()
+	for i in range(0, len(missing), lookupChunk):
+		part = missing[i:i + lookupChunk]
+		for code in part:
+			workerCodes[code] = None
+		c.execute('''SELECT code, title, units FROM barcodes WHERE code IN ({0})'''.format(','.join('?' * len(part))), part)
+		for code, title, units in c.fetchall():
+			workerCodes[code] = (title, units)
+	c.close()
+
+
+# Parse, validate and resolve one chunk of manifest lines in a parser process
+# Returns: ([(did, code, title, count, units), ...] merged per (did, title, units), stats dict)
+def _parseChunk(lines, jsonl):
+
+	start = time.process_time()
+	stats = {'rows': 0, 'skipped': 0, 'unknownBarcode': 0}
+	rows = []
+	if jsonl:
+		for line in lines:
+			if not line.strip():
+				continue
+			stats['rows'] += 1
+			try:
+				record = json.loads(line)
+				rows.append((int(record['did']), str(record['barcode']), int(record.get('count', 1))))
+			except (ValueError, KeyError, TypeError, AttributeError):
+				stats['skipped'] += 1
+	else:
+		for record in csv.reader(lines):
+			if not record or record == ['did', 'barcode', 'count']:
+				continue
+			stats['rows'] += 1
+			try:
+				rows.append((int(record[0]), record[1], int(record[2]) if len(record) > 2 and record[2] else 1))
+			except (ValueError, IndexError):
+				stats['skipped'] += 1
+
+	_resolveCodes(list({code for did, code, count in rows}))
+
+	# Like addItemByBarcode(), a count below 1 counts as 1 and the last code scanned is recorded
+	merged = {}
+	for did, code, count in rows:
+		codeData = workerCodes[code]
+		if codeData is None:
+			stats['unknownBarcode'] += 1
+			continue
+		key = (did, codeData[0], str(codeData[1]))
+		total = merged[key][1] if key in merged else 0
+		merged[key] = (code, total + max(count, 1))
+
+	stats['parseSeconds'] = time.process_time() - start
+	return [(did, code, title, count, units) for (did, title, units), (code, count) in merged.items()], stats
+
+
+# Read the manifest in line chunks and submit them to the pool, at most maxInFlight at a time;
+# completed chunks go to the writer's bounded queue in file order
+def _readManifest(path, pool, results, maxInFlight, chunkRows, stats):
+
+	jsonl = path.endswith(('.jsonl', '.ndjson'))
+	inFlight = deque()
+	try:
+		with open(path, newline='', encoding='utf-8') as f:
+			while True:
+				start = time.monotonic()
+				lines = [line for _, line in zip(range(chunkRows), f)]
+				stats['readSeconds'] += time.monotonic() - start
+				if not lines:
+					break
+				stats['chunks'] += 1
+
+				# Backpressure: wait for the oldest chunk, and for room in the writer's queue, before reading on
+				if len(inFlight) >= maxInFlight:
+					start = time.monotonic()
+					results.put(inFlight.popleft().result())
+					stats['stallSeconds'] += time.monotonic() - start
+				inFlight.append(pool.submit(_parseChunk, lines, jsonl))
+
+		while inFlight:
+			results.put(inFlight.popleft().result())
+		results.put(None)
+	except BaseException as e:
+		for future in inFlight:
+			future.cancel()
+		results.put(e)
+
+
+# Apply merged rows in one transaction; rows for unknown donations are dropped
+def _writeBatch(db, batch, stats):
+
+	start = time.monotonic()
+	with transaction(db):
+		c = db.cursor()
+		c.executemany('''INSERT INTO items(did, barcode, title, count, units)
+			SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM donations WHERE id = ?)
+			ON CONFLICT(did, title, units) DO UPDATE SET count = count + excluded.count, barcode = excluded.barcode''',
+			[(did, code, title, count, units, did) for (did, title, units), (code, count) in batch.items()])
+		written = c.rowcount
+		c.close()
+	stats['items'] += written
+	stats['unknownDonation'] += len(batch) - written
+	stats['transactions'] += 1
+	stats['writeSeconds'] += time.monotonic() - start
+
+
+# Function ingestManifest()
+# Purpose: add every row of a scan manifest to items, parsing in parallel and writing from one connection
+# Syntax: ingestManifest(<connection>, <manifest_path>, <workers>, <chunk_rows>, <write_rows>)
+# Returns: a stats dict: rows, skipped (malformed), unknownBarcode, unknownDonation (merged rows dropped),
+#	items (item rows inserted or merged), chunks, transactions, and readSeconds/parseSeconds/writeSeconds/
+#	stallSeconds/seconds for per-stage throughput
+# Note: parser processes resolve barcodes against the catalog (a read-only connection to the same file, or a
+#	copy of the barcodes table for an in-memory database) and merge counts per (did, title, units). The caller's
+#	connection is the only writer; it upserts merged rows in transactions of about write_rows rows.
+# Note: memory is bounded: at most 2 * workers chunks are being parsed and 2 parsed chunks wait for the writer,
+#	so a slow writer stalls reading instead of buffering the manifest.
+# Note: totals match calling addItemByBarcode() for each row, except that counts are merged before writing
+def ingestManifest(db, path, workers=None, chunkRows=None, writeRows=None):
+
+	workers = workers or os.cpu_count() or 1
+	chunkRows = chunkRows or ingestChunkRows
+	writeRows = writeRows or ingestWriteRows
+	stats = {'rows': 0, 'skipped': 0, 'unknownBarcode': 0, 'unknownDonation': 0, 'items': 0, 'chunks': 0,
+		'transactions': 0, 'readSeconds': 0.0, 'parseSeconds': 0.0, 'writeSeconds': 0.0, 'stallSeconds': 0.0}
+	start = time.monotonic()
+
+	catalog = None
+	if db.path == ':memory:':
+		catalog = {code: (title, units) for code, title, units in db.execute('''SELECT code, title, units FROM barcodes''')}
+
+	results = queue.Queue(maxsize=2)
+	with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(db.path, catalog)) as pool:
+		reader = threading.Thread(target=_readManifest, args=(path, pool, results, 2 * workers, chunkRows, stats), daemon=True)
+		reader.start()
+
+		batch = {}
+		while True:
+			result = results.get()
+			if result is None:
+				break
+			if isinstance(result, BaseException):
+				raise result
+			merged, chunkStats = result
+			for key in ('rows', 'skipped', 'unknownBarcode', 'parseSeconds'):
+				stats[key] += chunkStats[key]
+			for did, code, title, count, units in merged:
+				key = (did, title, units)
+				total = batch[key][1] if key in batch else 0
+				batch[key] = (code, total + count)
+			if len(batch) >= writeRows:
+				_writeBatch(db, batch, stats)
+				batch = {}
+		if batch:
+			_writeBatch(db, batch, stats)
+		reader.join()
+
+	stats['seconds'] = time.monotonic() - start
+	return stats
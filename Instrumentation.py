@@ -0,0 +1,262 @@
+# Instrumentation.py implements opt-in per-helper metrics: call counts, latency histograms, SQL statements
+# per call and a sampled slow-call log, exported in Prometheus text format
+#
+# Nothing is wrapped until enableInstrumentation() is called, and disableInstrumentation() puts the original
+# functions back, so a disabled build runs exactly the uninstrumented code.
+
+import sys, time, random, inspect, threading, weakref
+from collections import deque
+import UserHelpers, DonationHelpers
+
+# Functions:
+# enableInstrumentation()
+# disableInstrumentation()
+# helperStats()
+# slowCalls()
+# exportPrometheus()
+# resetInstrumentation()
+
+# Modules whose public helpers (functions taking a connection first) are wrapped
+instrumentedModules = [UserHelpers, DonationHelpers]
+
+# Accessors that take a connection but do no SQL work of their own
+uninstrumented = {'donationStore', 'userStore', 'barcodeCache', 'barcodeFilter'}
+
+# Latency bucket upper bounds in seconds: 10us doubling up to about 10s
+latencyBuckets = [0.00001 * 2 ** n for n in range(21)]
+
+# Settings, changed by enableInstrumentation()
+slowThreshold = 0.1	# Seconds above which a call is a slow call
+slowSampleRate = 1.0	# Fraction of slow calls recorded in the log
+slowLogSize = 1000	# Slow calls kept, newest last
+slowStatements = 20	# Statements kept per slow call
+
+metrics = {}		# helper name -> HelperMetrics
+slowLog = deque(maxlen=slowLogSize)
+metricsLock = threading.Lock()
+originals = {}		# (module, name) -> original function, while enabled
+traced = weakref.WeakSet()	# connections with the statement trace installed
+active = threading.local()	# .calls: stack of statement lists for this thread's instrumented calls
+
+
+# Class HelperMetrics
+# Purpose: counters and a latency histogram for one helper
+class HelperMetrics:
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.seconds = 0.0
+		self.statements = 0
+		self.slow = 0
+		self.buckets = [0] * (len(latencyBuckets) + 1)	# last bucket is +Inf
+
+	def record(self, seconds, statements, failed):
+		self.calls += 1
+		self.seconds += seconds
+		self.statements += statements
+		if failed:
+			self.errors += 1
+		if seconds > slowThreshold:
+			self.slow += 1
+		for n, bound in enumerate(latencyBuckets):
+			if seconds <= bound:
+				self.buckets[n] += 1
+				return
+		self.buckets[-1] += 1
+
+	# Estimate a quantile by linear interpolation inside its bucket, as Prometheus' histogram_quantile() does
+	def quantile(self, q):
+		if self.calls == 0:
+			return None
+		rank = q * self.calls
+		seen = 0
+		for n, count in enumerate(self.buckets):
+			if seen + count >= rank and count:
+				if n == len(latencyBuckets):
+					return latencyBuckets[-1]
+				low = latencyBuckets[n - 1] if n else 0.0
+				return low + (latencyBuckets[n] - low) * (rank - seen) / count
+			seen += count
+		return latencyBuckets[-1]
+
+
+# Trace callback: records every statement run for the calls in progress. SQLite reports a trigger program as
+# another run of the statement that fired it; statements it runs internally (e.g. FTS5 index upkeep) start with "--".
+def _trace(sql):
+	calls = getattr(active, 'calls', None)
+	if calls and not sql.startswith('--'):
+		for statements in calls:
+			statements.append(sql)
+
+
+def _wrap(name, fn):
+
+	def instrumented(db, *args, **kwargs):
+		if db not in traced:
+			try:
+				db.set_trace_callback(_trace)
+				traced.add(db)
+			except (AttributeError, TypeError):
+				pass
+
+		calls = getattr(active, 'calls', None)
+		if calls is None:
+			calls = active.calls = []
+		statements = []
+		calls.append(statements)
+		failed = True
+		start = time.perf_counter()
+		try:
+			result = fn(db, *args, **kwargs)
+			failed = False
+			return result
+		finally:
+			seconds = time.perf_counter() - start
+			calls.pop()
+			with metricsLock:
+				m = metrics.get(name)
+				if m is None:
+					m = metrics[name] = HelperMetrics()
+				m.record(seconds, len(statements), failed)
+				if seconds > slowThreshold and random.random() < slowSampleRate:
+					slowLog.append((time.time(), name, seconds, len(statements), statements[:slowStatements]))
+
+	instrumented.__name__ = fn.__name__
+	instrumented.__doc__ = fn.__doc__
+	instrumented.__wrapped__ = fn
+	return instrumented
+
+
+# Public helpers of a module: functions defined there whose first parameter is the connection.
+# Generators are left alone: wrapping one would time only its creation.
+def _helpers(module):
+	for name, fn in list(vars(module).items()):
+		if name.startswith('_') or name in uninstrumented or not inspect.isfunction(fn) or fn.__module__ != module.__name__:
+			continue
+		if inspect.isgeneratorfunction(fn):
+			continue
+		params = list(inspect.signature(fn).parameters)
+		if params and params[0] == 'db':
+			yield name, fn
+
+
+# Point every loaded module's reference to a function (e.g. from "from DonationHelpers import ...") at another
+def _rebind(old, new):
+	for module in list(sys.modules.values()):
+		names = getattr(module, '__dict__', None)
+		if not names:
+			continue
+		for attr, value in list(names.items()):
+			if value is old:
+				setattr(module, attr, new)
+
+
+# Function enableInstrumentation()
+# Purpose: start recording metrics for every public helper in UserHelpers and DonationHelpers
+# Syntax: enableInstrumentation(<slow_threshold_seconds>, <slow_sample_rate>, <slow_log_size>)
+# Note: the wrappers replace the helpers in their modules and in every module that imported them by name.
+#	Statements are counted with the connection's set_trace_callback(), installed on first use of each connection.
+# Note: a helper calling another wrapped helper records both; the outer call's statements include the inner's
+def enableInstrumentation(threshold=0.1, sampleRate=1.0, logSize=1000):
+
+	global slowThreshold, slowSampleRate, slowLogSize, slowLog
+	with metricsLock:
+		slowThreshold = threshold
+		slowSampleRate = sampleRate
+		slowLogSize = logSize
+		if slowLog.maxlen != logSize:
+			slowLog = deque(slowLog, maxlen=logSize)
+
+	if originals:
+		return
+	for module in instrumentedModules:
+		for name, fn in _helpers(module):
+			originals[(module, name)] = fn
+			_rebind(fn, _wrap(name, fn))
+
+
+# Function disableInstrumentation()
+# Purpose: restore the original helpers and remove the statement trace; recorded metrics are kept
+# Syntax: disableInstrumentation()
+def disableInstrumentation():
+
+	for (module, name), fn in originals.items():
+		_rebind(getattr(module, name), fn)
+	originals.clear()
+	for db in list(traced):
+		try:
+			db.set_trace_callback(None)
+		except Exception:
+			pass	# Closed connection
+	traced.clear()
+
+
+# Function resetInstrumentation()
+# Purpose: forget recorded metrics and slow calls
+def resetInstrumentation():
+	with metricsLock:
+		metrics.clear()
+		slowLog.clear()
+
+
+# Function helperStats()
+# Purpose: summarize the metrics of every helper called so far
+# Syntax: helperStats()
+# Returns: a dict of helper name -> {'calls', 'errors', 'seconds', 'p50', 'p95', 'p99', 'statementsPerCall', 'slow'}
+# Note: percentiles are estimated from the histogram, so they are exact to within one bucket (a factor of 2)
+def helperStats():
+	with metricsLock:
+		return {name: {
+			'calls': m.calls,
+			'errors': m.errors,
+			'seconds': m.seconds,
+			'p50': m.quantile(0.5),
+			'p95': m.quantile(0.95),
+			'p99': m.quantile(0.99),
+			'statementsPerCall': m.statements / m.calls if m.calls else 0.0,
+			'slow': m.slow
+		} for name, m in metrics.items()}
+
+
+# Function slowCalls()
+# Purpose: read the sampled slow-call log
+# Returns: a list of (unix_time, helper, seconds, statements, [first statements' SQL]), oldest first
+def slowCalls():
+	with metricsLock:
+		return list(slowLog)
+
+
+# Function exportPrometheus()
+# Purpose: render all metrics in the Prometheus text exposition format
+# Syntax: exportPrometheus(<metric_prefix>)
+# Returns: the exposition text, ending in a newline
+def exportPrometheus(prefix='foodbank'):
+
+	lines = []
+	def family(name, kind, text):
+		lines.append('# HELP {0}_{1} {2}'.format(prefix, name, text))
+		lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+
+	with metricsLock:
+		items = sorted(metrics.items())
+
+		family('helper_seconds', 'histogram', 'Helper call latency in seconds.')
+		for name, m in items:
+			seen = 0
+			for bound, count in zip(latencyBuckets + ['+Inf'], m.buckets):
+				seen += count
+				le = bound if bound == '+Inf' else '{0:g}'.format(bound)
+				lines.append('{0}_helper_seconds_bucket{{helper="{1}",le="{2}"}} {3}'.format(prefix, name, le, seen))
+			lines.append('{0}_helper_seconds_sum{{helper="{1}"}} {2!r}'.format(prefix, name, m.seconds))
+			lines.append('{0}_helper_seconds_count{{helper="{1}"}} {2}'.format(prefix, name, m.calls))
+
+		for metric, attr, text in (
+			('helper_errors_total', 'errors', 'Helper calls that raised.'),
+			('helper_statements_total', 'statements', 'SQL statements run by helper calls, trigger runs included.'),
+			('helper_slow_calls_total', 'slow', 'Helper calls slower than the slow-call threshold.')):
+			family(metric, 'counter', text)
+			for name, m in items:
+				lines.append('{0}_{1}{{helper="{2}"}} {3}'.format(prefix, metric, name, getattr(m, attr)))
+
+	return '\n'.join(lines) + '\n'
@@ -0,0 +1,70 @@
+# LRUCache.py implements a bounded, thread-safe least-recently-used cache with statistics
+
+import threading
+from collections import OrderedDict
+
+# Class LRUCache
+# Purpose: keep the most recently used maxSize entries in memory
+# Syntax: cache = LRUCache(<max_size>)
+#	token = cache.generation; value = <read from database>; cache.put(<key>, value, token)
+#	cache.get(<key>)	# returns value or None
+# Note: invalidate()/clear() bump generation. put() with a token taken before an invalidation is dropped,
+#	so a reader that raced a writer cannot reinsert the value the writer just replaced.
+class LRUCache:
+
+	def __init__(self, maxSize=4096):
+		self.maxSize = maxSize
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		with self.lock:
+			try:
+				value = self.entries[key]
+			except KeyError:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def put(self, key, value, token=None):
+		with self.lock:
+			if token is not None and token != self.generation:
+				return
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxSize:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	# Drop the given keys (all keys if none given)
+	def invalidate(self, keys=None):
+		with self.lock:
+			self.generation += 1
+			if keys is None:
+				self.entries.clear()
+			else:
+				for key in keys:
+					self.entries.pop(key, None)
+
+	def clear(self):
+		self.invalidate()
+
+	# Returns: dict of hits, misses, evictions, size and maxSize
+	def stats(self):
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'size': len(self.entries),
+				'maxSize': self.maxSize
+			}
+
+	def __len__(self):
+		return len(self.entries)
@@ -0,0 +1,339 @@
+# LoadTest.py drives the week-one stories concurrently against a file-backed database and checks the results
+#
+# Run with "python3 LoadTest.py [--workers N] [--processes] [--seconds S] [--rate R] [--mix op=weight,...]
+#	[--providers N] [--receivers N] [--busy-timeout S] [--path file.db]"
+# Operations (default weights): scan=50 (addItemByBarcode), manual=5 (addItemByManual), donate=5 (addDonation),
+#	pending=10 and past=5 (listProviderDonationsWithItems), poll=10 (listProviderDonations), claim=10 (claimDonation),
+#	complete=3 (completeDonations), login=2 (validUser)
+# Exits non-zero if an invariant fails: a donation claimed twice or by a loser, item counts differing from the
+# successful scans, inventory rollups drifting, or a valid login rejected; or if a worker crashed.
+# An operation that raises is counted under busy (locked/busy errors) or errors and the worker carries on.
+
+import sys, os, time, queue, random, sqlite3, argparse, tempfile, threading, traceback, multiprocessing
+import Schema
+from Schema import createSchema, openDatabase
+from UserHelpers import validUser, writeUsersBulk
+from DonationHelpers import (addDonation, addItemByManual, addItemByBarcode, listProviderDonations,
+	listProviderDonationsWithItems, claimDonation, completeDonations, verifyInventoryRollup)
+import StoriesWeekOne
+from StoriesWeekOne import populateUsers, populateBarcodes
+
+defaultMix = 'scan=50,manual=5,donate=5,pending=10,past=5,poll=10,claim=10,complete=3,login=2'
+
+
+# Function setup()
+# Purpose: create the stories' users and barcodes, plus extra providers and receivers under the stories' orgs
+# Returns: (providers, receivers, credentials) where credentials maps uid -> password
+def setup(path, providers, receivers):
+
+	db = createSchema(path)
+	populateUsers(db, StoriesWeekOne.parents, StoriesWeekOne.users0, StoriesWeekOne.perms, StoriesWeekOne.pwd0)
+	populateUsers(db, StoriesWeekOne.parents, StoriesWeekOne.users1, StoriesWeekOne.perms, StoriesWeekOne.pwd1)
+	populateBarcodes(db, StoriesWeekOne.items)
+
+	# The stories' provider and receiver accounts come first; more are added as their siblings
+	credentials = dict(zip(StoriesWeekOne.users0 + StoriesWeekOne.users1, StoriesWeekOne.pwd0 + StoriesWeekOne.pwd1))
+	providerList = ['Pearl', 'Opal'] + ['Pearl{0}'.format(n) for n in range(max(providers - 2, 0))]
+	receiverList = ['Ruby', 'Quartz'] + ['Ruby{0}'.format(n) for n in range(max(receivers - 2, 0))]
+	extra = [('P_Org', uid, 0b0010, 'carol') for uid in providerList[2:]] + [('R_Org', uid, 0b0001, 'david') for uid in receiverList[2:]]
+	writeUsersBulk(db, extra)
+	for pid, uid, perms, pwd in extra:
+		credentials[uid] = pwd
+
+	# Every provider starts with one open donation so receivers have something to claim
+	for provider in providerList[:providers]:
+		addDonation(db, provider, None)
+	db.close()
+	return providerList[:providers], receiverList[:receivers], credentials
+
+
+# Class Worker
+# Purpose: one simulated client: picks operations by weight at its share of the arrival rate and records outcomes
+# Note: latency is measured from when an operation was due, so time spent waiting behind a slow call counts
+class Worker:
+
+	def __init__(self, n, config):
+		self.n = n
+		self.config = config
+		self.rng = random.Random(n)
+		self.provider = config['providers'][n % len(config['providers'])]
+		self.receiver = config['receivers'][n % len(config['receivers'])]
+		self.latencies = {op: [] for op in config['mix']}
+		self.busy = {op: 0 for op in config['mix']}
+		self.errors = {op: 0 for op in config['mix']}
+		self.scans = {}		# (did, title, units) -> count this worker added successfully
+		self.claims = []	# donation ids this worker's claimDonation() won
+		self.badLogins = 0
+		self.open = None	# this worker's current donation
+		self.started = self.finished = None	# time.monotonic() bounds of the run, comparable across processes
+		self.crash = None	# traceback if run() itself failed
+
+	def scan(self, db):
+		code, title, units, _ = self.rng.choice(StoriesWeekOne.items)
+		count = self.rng.randint(1, 5)
+		if addItemByBarcode(db, self.did(db), code, count) > 0:
+			key = (self.open, title, str(units))
+			self.scans[key] = self.scans.get(key, 0) + count
+
+	def manual(self, db):
+		code, title, units, _ = self.rng.choice(StoriesWeekOne.items)
+		count = self.rng.randint(1, 5)
+		if addItemByManual(db, self.did(db), title, count, units) > 0:
+			key = (self.open, title, str(units))
+			self.scans[key] = self.scans.get(key, 0) + count
+
+	def donate(self, db):
+		self.open = addDonation(db, self.provider, None)
+
+	def did(self, db):
+		if self.open is None:
+			self.donate(db)
+		return self.open
+
+	def pending(self, db):
+		listProviderDonationsWithItems(db, self.provider, 0b01)
+
+	def past(self, db):
+		listProviderDonationsWithItems(db, self.provider, 0b10)
+
+	def poll(self, db):
+		listProviderDonations(db, self.rng.choice(self.config['providers']), 0b01)
+
+	# Receivers race for the oldest unclaimed donations of a random provider
+	def claim(self, db):
+		for d in listProviderDonations(db, self.rng.choice(self.config['providers']), 0b01)[:3]:
+			if d[2] == 'pending' and claimDonation(db, d[0], self.receiver):
+				self.claims.append(d[0])
+				return
+
+	def complete(self, db):
+		claimed = [d[0] for d in listProviderDonations(db, self.provider, 0b01) if d[2] != 'pending']
+		if claimed:
+			completeDonations(db, claimed[:1])
+
+	def login(self, db):
+		uid = self.rng.choice(list(self.config['credentials']))
+		if not validUser(db, uid, self.config['credentials'][uid]):
+			self.badLogins += 1
+
+	def run(self):
+		config = self.config
+		Schema.busyTimeout = config['busyTimeout']
+		db = openDatabase(config['path'])
+		ops = list(config['mix'])
+		weights = [config['mix'][op] for op in ops]
+		rate = config['rate'] / config['workers'] if config['rate'] else 0
+
+		start = self.started = time.monotonic()
+		stop = start + config['seconds']
+		due = start
+		while True:
+			if rate:
+				due += self.rng.expovariate(rate)
+				wait = due - time.monotonic()
+				if wait > 0:
+					time.sleep(wait)
+			else:
+				due = time.monotonic()
+			if due >= stop:
+				break
+
+			op = self.rng.choices(ops, weights)[0]
+			try:
+				getattr(self, op)(db)
+			except Exception as e:
+				# A helper failed: drop its transaction, as a real client would before retrying
+				if db.in_transaction:
+					db.rollback()
+				if isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e)):
+					self.busy[op] += 1
+				else:
+					self.errors[op] += 1
+				continue
+			self.latencies[op].append(time.monotonic() - due)
+		self.finished = time.monotonic()
+		db.close()
+
+	def result(self):
+		return {
+			'latencies': self.latencies, 'busy': self.busy, 'errors': self.errors,
+			'scans': self.scans, 'claims': self.claims, 'badLogins': self.badLogins,
+			'started': self.started, 'finished': self.finished, 'crash': self.crash
+		}
+
+
+# Run one worker and always hand back its result, with what it recorded before any crash
+def _runWorker(n, config, deliver):
+	worker = Worker(n, config)
+	try:
+		worker.run()
+	except Exception:
+		worker.crash = traceback.format_exc()
+	finally:
+		deliver(worker.result())
+
+
+# Run every worker as a thread, or as its own process, and collect their results
+def runWorkers(config, processes):
+
+	# Spawned, not forked: a forked child would inherit setup()'s password hashing pool without its threads
+	if processes:
+		context = multiprocessing.get_context('spawn')
+		results = context.Queue()
+		workers = [context.Process(target=_runWorker, args=(n, config, results.put)) for n in range(config['workers'])]
+		for w in workers:
+			w.start()
+
+		# A process killed outright (e.g. by a signal) never delivers; stop waiting once all have exited
+		collected = []
+		while len(collected) < len(workers):
+			try:
+				collected.append(results.get(timeout=1.0))
+			except queue.Empty:
+				if not any(w.is_alive() for w in workers):
+					try:
+						collected.append(results.get(timeout=1.0))
+					except queue.Empty:
+						break
+		for w in workers:
+			w.join()
+		return collected
+
+	collected = []
+	lock = threading.Lock()
+	def deliver(result):
+		with lock:
+			collected.append(result)
+	workers = [threading.Thread(target=_runWorker, args=(n, config, deliver)) for n in range(config['workers'])]
+	for w in workers:
+		w.start()
+	for w in workers:
+		w.join()
+	return collected
+
+
+# Function checkInvariants()
+# Purpose: compare the database with what the workers saw succeed
+# Returns: a list of problems, empty when every invariant holds
+def checkInvariants(path, results):
+
+	problems = []
+
+	# Each donation won at most once, and the table records exactly the winners
+	winner = {}
+	for n, result in enumerate(results):
+		for did in result['claims']:
+			if did in winner:
+				problems.append('donation {0} claimed by workers {1} and {2}'.format(did, winner[did], n))
+			winner[did] = n
+	db = openDatabase(path, readOnly=True)
+	c = db.cursor()
+	c.execute('''SELECT id, receiver FROM donations WHERE receiver != 'pending'
+		UNION ALL SELECT id, receiver FROM donationsArchive WHERE receiver != 'pending' ''')
+	claimed = dict(c.fetchall())
+	if set(claimed) != set(winner):
+		problems.append('{0} donations claimed in the table, {1} claims won'.format(len(claimed), len(winner)))
+
+	# Item counts equal the sum of successful scans
+	scans = {}
+	for result in results:
+		for key, count in result['scans'].items():
+			scans[key] = scans.get(key, 0) + count
+	c.execute('''SELECT did, title, units, count FROM items UNION ALL SELECT did, title, units, count FROM itemsArchive''')
+	stored = {}
+	for did, title, units, count in c.fetchall():
+		key = (did, title, str(units))
+		stored[key] = stored.get(key, 0) + count
+	for key in set(scans) | set(stored):
+		if scans.get(key, 0) != stored.get(key, 0):
+			problems.append('item {0}: scanned {1}, stored {2}'.format(key, scans.get(key, 0), stored.get(key, 0)))
+	c.close()
+
+	drift = verifyInventoryRollup(db)
+	if drift:
+		problems.append('{0} inventory rollup rows drifted'.format(len(drift)))
+	db.close()
+
+	badLogins = sum(result['badLogins'] for result in results)
+	if badLogins:
+		problems.append('{0} valid logins rejected'.format(badLogins))
+	return problems
+
+
+def report(config, results, elapsed):
+
+	print('{0} workers ({1}), {2:.0f}s, {3}'.format(config['workers'], 'processes' if config['processes'] else 'threads',
+		elapsed, 'closed loop' if not config['rate'] else '{0:.0f} ops/s offered'.format(config['rate'])))
+	print('{0:10}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}{6:>8}{7:>8}'.format('op', 'ops', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'busy', 'errors'))
+	total = 0
+	for op in config['mix']:
+		samples = sorted(s for result in results for s in result['latencies'][op])
+		busy = sum(result['busy'][op] for result in results)
+		errors = sum(result['errors'][op] for result in results)
+		total += len(samples)
+		if not samples:
+			print('{0:10}{1:8d}{2:>10}{3:>10}{4:>10}{5:>10}{6:8d}{7:8d}'.format(op, 0, '-', '-', '-', '-', busy, errors))
+			continue
+		pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+		print('{0:10}{1:8d}{2:10.1f}{3:10.2f}{4:10.2f}{5:10.2f}{6:8d}{7:8d}'.format(
+			op, len(samples), len(samples) / elapsed, pick(0.5), pick(0.95), pick(0.99), busy, errors))
+	print('total {0} ops, {1:.1f} ops/s'.format(total, total / elapsed))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='LoadTest.py')
+	parser.add_argument('--workers', type=int, default=8, help='concurrent clients')
+	parser.add_argument('--processes', action='store_true', help='run each client in its own process instead of a thread')
+	parser.add_argument('--seconds', type=float, default=10.0, help='duration of the run')
+	parser.add_argument('--rate', type=float, default=0, help='total operations per second offered (Poisson arrivals); 0 runs closed loop')
+	parser.add_argument('--mix', default=defaultMix, help='operation weights, e.g. scan=50,claim=10')
+	parser.add_argument('--providers', type=int, default=4, help='provider accounts (the stories have 2)')
+	parser.add_argument('--receivers', type=int, default=4, help='receiver accounts (the stories have 2)')
+	parser.add_argument('--busy-timeout', type=float, default=Schema.busyTimeout, help='seconds a connection waits on a lock before a busy error')
+	parser.add_argument('--path', help='database file to create (default: a temporary file)')
+	args = parser.parse_args(argv)
+
+	mix = {}
+	for entry in args.mix.split(','):
+		op, weight = entry.split('=')
+		if not hasattr(Worker, op) or op in ('run', 'did'):
+			parser.error('unknown operation: ' + op)
+		mix[op] = float(weight)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = args.path or os.path.join(tmp, 'load.db')
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists(path + suffix):
+				os.remove(path + suffix)
+		providers, receivers, credentials = setup(path, args.providers, args.receivers)
+
+		config = {
+			'path': path, 'workers': args.workers, 'processes': args.processes, 'seconds': args.seconds,
+			'rate': args.rate, 'mix': mix, 'busyTimeout': args.busy_timeout,
+			'providers': providers, 'receivers': receivers, 'credentials': credentials
+		}
+		results = runWorkers(config, args.processes)
+
+		# Rates are over the measured run, from the first worker's start to the last one's finish;
+		# starting spawned processes is not part of it
+		started = [r['started'] for r in results if r['started'] is not None]
+		finished = [r['finished'] or r['started'] for r in results if r['started'] is not None]
+		elapsed = max(finished) - min(started) if started else 0.0
+		report(config, results, elapsed or args.seconds)
+		problems = checkInvariants(path, results)
+
+		if len(results) < args.workers:
+			problems.append('{0} of {1} workers returned no result'.format(args.workers - len(results), args.workers))
+		for r in results:
+			if r['crash']:
+				problems.append('worker crashed: ' + r['crash'].strip().splitlines()[-1])
+
+	for problem in problems:
+		print('FAIL: ' + problem)
+	if not problems:
+		print('PASS: no double claims, item counts match scans, rollups exact, all valid logins accepted')
+	return 1 if problems else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
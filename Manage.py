@@ -0,0 +1,83 @@
+# Manage.py implements command-line maintenance tasks against a file-backed database
+#
+# Run with "python3 Manage.py <database_file> <command> [options]"
+# Commands:
+#	importBarcodes <catalog.csv|catalog.jsonl> [--replace] [--chunk-size N]
+#	verifyRollup [--repair]
+#	archive [--days N] [--batch-size N]
+#	ingestManifest <manifest.csv|manifest.jsonl> [--workers N] [--chunk-rows N] [--write-rows N]
+
+import sys, argparse, datetime
+from Schema import createSchema
+from DonationHelpers import importBarcodes, verifyInventoryRollup, rebuildInventoryRollup, archiveDonations
+from Ingest import ingestManifest
+
+
+def cmdImportBarcodes(db, args):
+	counts = importBarcodes(db, args.file, 'replace' if args.replace else 'ignore', args.chunk_size)
+	print('inserted {0}, skipped {1}, conflicting {2}'.format(counts['inserted'], counts['skipped'], counts['conflicting']))
+	return 0
+
+
+def cmdVerifyRollup(db, args):
+	drift = rebuildInventoryRollup(db) if args.repair else verifyInventoryRollup(db)
+	for provider, title, units, state, eItems, eQuantity, aItems, aQuantity in drift:
+		print('{0}\t{1}\t{2}\t{3}\texpected {4}/{5}, found {6}/{7}'.format(provider, title, units, state, eItems, eQuantity, aItems, aQuantity))
+	print('{0} rollup rows drifted{1}'.format(len(drift), ', rebuilt' if args.repair and drift else ''))
+	return 1 if drift and not args.repair else 0
+
+
+def cmdArchive(db, args):
+	cutoff = datetime.datetime.now() - datetime.timedelta(days=args.days)
+	print('archived {0} donations completed before {1}'.format(archiveDonations(db, cutoff, args.batch_size), cutoff))
+	return 0
+
+
+def cmdIngestManifest(db, args):
+	stats = ingestManifest(db, args.file, args.workers, args.chunk_rows, args.write_rows)
+	print('{0} rows: {1} skipped, {2} unknown barcodes, {3} merged rows for unknown donations; {4} items written in {5} transactions'.format(
+		stats['rows'], stats['skipped'], stats['unknownBarcode'], stats['unknownDonation'], stats['items'], stats['transactions']))
+	for stage in ('read', 'parse', 'write'):
+		seconds = stats[stage + 'Seconds']
+		print('{0}\t{1:.2f}s\t{2:.0f} rows/s'.format(stage, seconds, stats['rows'] / seconds if seconds else 0))
+	print('stalled on backpressure {0:.2f}s, total {1:.2f}s, {2:.0f} rows/s'.format(stats['stallSeconds'], stats['seconds'], stats['rows'] / stats['seconds']))
+	return 0
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='Manage.py')
+	parser.add_argument('database', help='database file (created and migrated if needed)')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	p = commands.add_parser('importBarcodes', help='bulk load a barcode catalog')
+	p.add_argument('file', help='CSV (code,title,units) or JSONL catalog')
+	p.add_argument('--replace', action='store_true', help='overwrite title/units of existing codes')
+	p.add_argument('--chunk-size', type=int, default=10000, help='rows per transaction')
+	p.set_defaults(run=cmdImportBarcodes)
+
+	p = commands.add_parser('verifyRollup', help='compare inventory rollups with totals recomputed from items')
+	p.add_argument('--repair', action='store_true', help='rebuild the rollups if they drifted')
+	p.set_defaults(run=cmdVerifyRollup)
+
+	p = commands.add_parser('archive', help='move long-completed donations and their items to the archive tables')
+	p.add_argument('--days', type=float, default=30, help='archive donations completed more than this many days ago')
+	p.add_argument('--batch-size', type=int, default=500, help='donations per transaction')
+	p.set_defaults(run=cmdArchive)
+
+	p = commands.add_parser('ingestManifest', help='add a warehouse scan manifest of (did, barcode, count) rows to items')
+	p.add_argument('file', help='CSV (did,barcode,count) or JSONL manifest')
+	p.add_argument('--workers', type=int, default=None, help='parser processes (default: CPU count)')
+	p.add_argument('--chunk-rows', type=int, default=None, help='manifest lines per parser task')
+	p.add_argument('--write-rows', type=int, default=None, help='merged item rows per write transaction')
+	p.set_defaults(run=cmdIngestManifest)
+
+	args = parser.parse_args(argv)
+	db = createSchema(args.database)
+	try:
+		return args.run(db, args)
+	finally:
+		db.close()
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,185 @@
+# Passwords.py implements salted password hashing and a bounded verification worker pool
+
+import os, hmac, base64, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Functions:
+# hashPassword()
+# verifyPassword()
+# needsRehash()
+# setHasher()
+# submitHash()
+# submitVerify()
+
+# Stored hash formats:
+#	scrypt$<n>$<r>$<p>$<salt>$<key>		hashlib.scrypt
+#	pbkdf2_sha256$<iterations>$<salt>$<key>	hashlib.pbkdf2_hmac
+#	<64 hex digits>				legacy unsalted SHA-256, verified then rehashed on login
+# salt and key are unpadded urlsafe base64. Parameters travel with each hash, so changing the
+# configured hasher never invalidates stored passwords.
+
+saltBytes = 16
+keyBytes = 32
+
+
+def _b64(raw):
+	return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def _unb64(text):
+	return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+# Class ScryptHasher
+# Purpose: memory-hard KDF; memory per hash is 128 * n * r bytes (16 MiB at the defaults)
+class ScryptHasher:
+
+	def __init__(self, n=2 ** 14, r=8, p=1):
+		self.n = n
+		self.r = r
+		self.p = p
+
+	def _derive(self, pwd, salt, n, r, p):
+		return hashlib.scrypt(pwd.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=keyBytes)
+
+	def hash(self, pwd):
+		salt = os.urandom(saltBytes)
+		key = self._derive(pwd, salt, self.n, self.r, self.p)
+		return 'scrypt${0:d}${1:d}${2:d}${3}${4}'.format(self.n, self.r, self.p, _b64(salt), _b64(key))
+
+	def verify(self, pwd, fields):
+		n, r, p, salt, key = fields
+		return hmac.compare_digest(self._derive(pwd, _unb64(salt), int(n), int(r), int(p)), _unb64(key))
+
+	def current(self, fields):
+		return fields[:3] == [str(self.n), str(self.r), str(self.p)]
+
+	def __repr__(self):
+		return 'ScryptHasher(n={0}, r={1}, p={2})'.format(self.n, self.r, self.p)
+
+
+# Class Pbkdf2Hasher
+# Purpose: PBKDF2-HMAC-SHA256; CPU-hard only, for platforms without scrypt
+class Pbkdf2Hasher:
+
+	def __init__(self, iterations=600000):
+		self.iterations = iterations
+
+	def hash(self, pwd):
+		salt = os.urandom(saltBytes)
+		key = hashlib.pbkdf2_hmac('sha256', pwd.encode(), salt, self.iterations, keyBytes)
+		return 'pbkdf2_sha256${0:d}${1}${2}'.format(self.iterations, _b64(salt), _b64(key))
+
+	def verify(self, pwd, fields):
+		iterations, salt, key = fields
+		derived = hashlib.pbkdf2_hmac('sha256', pwd.encode(), _unb64(salt), int(iterations), len(_unb64(key)))
+		return hmac.compare_digest(derived, _unb64(key))
+
+	def current(self, fields):
+		return fields[0] == str(self.iterations)
+
+	def __repr__(self):
+		return 'Pbkdf2Hasher(iterations={0})'.format(self.iterations)
+
+
+# Hasher used for new and upgraded hashes
+hasher = ScryptHasher()
+
+# Verification pool: at most poolWorkers hashes run at once and at most poolQueue wait behind them.
+# Both KDFs release the GIL, so workers use every core; the bound keeps a login burst from
+# running hundreds of 16 MiB scrypt computations at once.
+poolWorkers = os.cpu_count() or 2
+poolQueue = 64
+_pool = None
+_poolSlots = None
+_poolLock = threading.Lock()
+
+
+# Function setHasher()
+# Purpose: choose the hasher for new hashes; stored hashes with other parameters are upgraded on next login
+# Syntax: setHasher(<ScryptHasher or Pbkdf2Hasher>)
+def setHasher(newHasher):
+	global hasher
+	hasher = newHasher
+
+
+# Split a stored hash into (scheme, fields); scheme is 'sha256' for legacy hashes
+def _parse(stored):
+	parts = stored.split('$')
+	if len(parts) == 1:
+		return 'sha256', parts
+	return parts[0], parts[1:]
+
+
+# Function hashPassword()
+# Purpose: hash a password with the configured hasher and a fresh salt
+# Syntax: hashPassword(<pwd>)
+# Returns: the string to store in users.hash
+def hashPassword(pwd):
+	return hasher.hash(pwd)
+
+
+# Function verifyPassword()
+# Purpose: check a password against a stored hash of any supported format
+# Syntax: verifyPassword(<pwd>, <stored_hash>)
+# Returns: True on match / False on mismatch or unrecognized hash
+def verifyPassword(pwd, stored):
+	if not stored:
+		return False
+	scheme, fields = _parse(stored)
+	try:
+		if scheme == 'sha256':
+			return hmac.compare_digest(hashlib.sha256(pwd.encode()).hexdigest(), stored)
+		elif scheme == 'scrypt' and len(fields) == 5:
+			return ScryptHasher().verify(pwd, fields)
+		elif scheme == 'pbkdf2_sha256' and len(fields) == 3:
+			return Pbkdf2Hasher().verify(pwd, fields)
+	except (ValueError, TypeError):
+		pass
+	return False
+
+
+# Function needsRehash()
+# Purpose: tell whether a stored hash was made by a different scheme or parameters than the configured hasher
+# Syntax: needsRehash(<stored_hash>)
+# Returns: True if the hash should be replaced after a successful login
+def needsRehash(stored):
+	scheme, fields = _parse(stored)
+	if isinstance(hasher, ScryptHasher) and scheme == 'scrypt':
+		return not hasher.current(fields)
+	if isinstance(hasher, Pbkdf2Hasher) and scheme == 'pbkdf2_sha256':
+		return not hasher.current(fields)
+	return True
+
+
+def _submit(fn, *args):
+	global _pool, _poolSlots
+	if _pool is None:
+		with _poolLock:
+			if _pool is None:
+				_poolSlots = threading.BoundedSemaphore(poolWorkers + poolQueue)
+				_pool = ThreadPoolExecutor(max_workers=poolWorkers, thread_name_prefix='kdf')
+	# Blocks the caller while the pool is saturated: backpressure instead of an unbounded queue
+	_poolSlots.acquire()
+	try:
+		future = _pool.submit(fn, *args)
+	except BaseException:
+		_poolSlots.release()
+		raise
+	future.add_done_callback(lambda f: _poolSlots.release())
+	return future
+
+
+# Function submitVerify()
+# Purpose: run verifyPassword() on the bounded worker pool
+# Syntax: submitVerify(<pwd>, <stored_hash>)
+# Returns: a concurrent.futures.Future resolving to True/False
+def submitVerify(pwd, stored):
+	return _submit(verifyPassword, pwd, stored)
+
+
+# Function submitHash()
+# Purpose: run hashPassword() on the bounded worker pool
+# Syntax: submitHash(<pwd>)
+# Returns: a concurrent.futures.Future resolving to the stored hash string
+def submitHash(pwd):
+	return _submit(hashPassword, pwd)
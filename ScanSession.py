@@ -0,0 +1,132 @@
+# ScanSession.py implements buffered barcode scanning into a single donation
+
+import time
+from collections import OrderedDict
+from Schema import transaction
+from DonationHelpers import existDonation
+
+# SQLite's default limit on bound parameters is 999; stay well below it per IN list
+lookupChunk = 500
+
+# Batch lookups; Schema.checkQueryPlans() explains these statements
+barcodesInQuery = '''SELECT code, title, units FROM barcodes WHERE code IN ({0})'''
+itemIdsInQuery = '''SELECT id, title, units FROM items WHERE did = ? AND title IN ({0})'''
+
+# Class ScanSession
+# Purpose: accept rapid scans for one donation and write them in batches
+# Syntax: session = ScanSession(<connection>, <donation_id>, <max_scans>, <max_delay_seconds>)
+#	session.scan(<barcode>, <count>)	# returns flush results when a threshold is hit, else None
+#	session.flush()			# returns {barcode: item.id or -1}
+# Note: repeated codes are summed in memory. A flush resolves every buffered code with one barcode query,
+#	merges them with one UPSERT batch and commits once (or joins the caller's transaction()), so a scanner costs one fsync per batch instead of per scan.
+# Note: per-code results match addItemByBarcode(): the merged item id, or -1 for an unknown donation or barcode.
+# Note: the time threshold is checked when scan() is called; call flush() or close() when the scanner goes idle.
+# Note: not thread-safe; use one session per scanner.
+class ScanSession:
+
+	def __init__(self, db, did, maxScans=50, maxDelay=1.0):
+		self.db = db
+		self.did = did
+		self.maxScans = maxScans
+		self.maxDelay = maxDelay
+		self.pending = OrderedDict()	# code -> summed count, in first-scan order
+		self.lastScan = {}		# code -> number of its latest scan in this batch
+		self.scans = 0
+		self.oldest = None
+
+	# Buffer one scan. Like addItemByBarcode(), a count below 1 counts as 1.
+	def scan(self, code, count=1):
+		if count < 1:
+			count = 1
+		self.pending[code] = self.pending.get(code, 0) + count
+		self.scans += 1
+		self.lastScan[code] = self.scans
+		if self.oldest is None:
+			self.oldest = time.monotonic()
+
+		if self.scans >= self.maxScans or self.due():
+			return self.flush()
+		return None
+
+	# True once the oldest buffered scan has waited maxDelay seconds
+	def due(self):
+		return self.oldest is not None and time.monotonic() - self.oldest >= self.maxDelay
+
+	# Empty the buffer once its scans are written (or can never be)
+	def _clear(self):
+		self.pending = OrderedDict()
+		self.lastScan = {}
+		self.scans = 0
+		self.oldest = None
+
+	# Write every buffered scan in one transaction
+	# Note: if the write raises (e.g. "database is locked"), the scans stay buffered for the next flush()
+	def flush(self):
+
+		pending = self.pending
+		if not pending:
+			return {}
+
+		results = dict.fromkeys(pending, -1)
+		if not existDonation(self.db, self.did):
+			self._clear()
+			return results
+
+		c = self.db.cursor()
+
+		# Resolve barcodes in bulk
+		codes = list(pending)
+		codeData = {}
+		for i in range(0, len(codes), lookupChunk):
+			part = codes[i:i + lookupChunk]
+			c.execute(barcodesInQuery.format(','.join('?' * len(part))), part)
+			for code, title, units in c.fetchall():
+				codeData[code] = (title, units)
+
+		# Different codes can describe the same item; the last code scanned is recorded, as addItemByBarcode() does
+		merged = OrderedDict()
+		for code, count in pending.items():
+			if code in codeData:
+				key = codeData[code]
+				if key in merged:
+					last, total = merged[key]
+					merged[key] = (code if self.lastScan[code] > self.lastScan[last] else last, total + count)
+				else:
+					merged[key] = (code, count)
+
+		# A savepoint when the caller already holds a transaction()
+		with transaction(self.db):
+			c.executemany('''INSERT INTO items(did, barcode, title, count, units) VALUES(?,?,?,?,?)
+				ON CONFLICT(did, title, units) DO UPDATE SET count = count + excluded.count, barcode = excluded.barcode''',
+				[(self.did, code, title, count, units) for (title, units), (code, count) in merged.items()])
+
+			# Map merged items back to their ids
+			itemIds = {}
+			titles = list({title for title, units in merged})
+			for i in range(0, len(titles), lookupChunk):
+				part = titles[i:i + lookupChunk]
+				c.execute(itemIdsInQuery.format(','.join('?' * len(part))), [self.did] + part)
+				# items.units has TEXT affinity while barcodes.units is INTEGER, so compare as text
+				for iid, title, units in c.fetchall():
+					itemIds[(title, str(units))] = iid
+
+		c.close()
+		self._clear()
+
+		for code in pending:
+			if code in codeData:
+				title, units = codeData[code]
+				results[code] = itemIds.get((title, str(units)), -1)
+		return results
+
+	# Flush anything left and return its results
+	def close(self):
+		return self.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, exc, tb):
+		# Do not write a partial batch if the scanning loop failed
+		if excType is None:
+			self.close()
@@ -1,53 +1,581 @@
 # Schema.py implements the database
 
-import sys, sqlite3, datetime
+import sys, os, sqlite3, datetime, threading
+from contextlib import contextmanager
 from sqlite3 import Error
+from Snapshot import restoreSnapshot
+
+# Functions:
+# createSchema()
+# openDatabase()
+# transaction()
+# commit()
+# afterCommit()
+# migrateSchema()
+# helperQueries()
+# checkQueryPlans()
+
+# Rollup state of a donation row; format with the row's name (a table, NEW or OLD)
+donationState = '''(CASE WHEN {0}.completed != 0 THEN 'completed' WHEN {0}.receiver != 'pending' THEN 'claimed' ELSE 'pending' END)'''
+
+# Migrations are applied in order and tracked by PRAGMA user_version.
+# Version N is reached by running every statement in migrations[N-1].
+# Never edit a released migration: append a new one instead.
+migrations = [
+
+	# Version 1: base tables
+	[
+		# pid is uid of parent account (authenticating Org or Admin)
+		# Perms: bit string of length 4 such that 0=F/1=T in order <wxyz>
+			# w: Admin Access (full access)
+			# x: Orgizational Access (create/delete accounts)
+			# y: Provider Access (create donations, et al.)
+			# z: Receiver Access (claim donations, et al.)
+		'''CREATE TABLE IF NOT EXISTS users(
+			pid TEXT NOT NULL,
+			perms INTEGER,
+			uid TEXT NOT NULL UNIQUE,
+			hash TEXT)''',
+
+		# barcodes contains title and unit type for barcoded items
+		'''CREATE TABLE IF NOT EXISTS barcodes(
+			code TEXT NOT NULL UNIQUE,
+			title TEXT NOT NULL,
+			units INTEGER NOT NULL)''',
+
+		# did is associated donation id
+		'''CREATE TABLE IF NOT EXISTS items(
+			id INTEGER PRIMARY KEY,
+			did INTEGER NOT NULL,
+			barcode TEXT,
+			title TEXT NOT NULL,
+			count INTEGER NOT NULL,
+			units TEXT NOT NULL)''',
+
+		'''CREATE TABLE IF NOT EXISTS donations(
+			id INTEGER PRIMARY KEY,
+			provider TEXT NOT NULL,
+			receiver TEXT DEFAULT "pending",
+			created TIMESTAMP,
+			completed TIMESTAMP DEFAULT 0)'''
+	],
+
+	# Version 2: indexes covering the helper predicates
+	[
+		# addItemByManual()/addItemByBarcode() merge lookup; prefix serves getDonationItems()
+		'''CREATE INDEX IF NOT EXISTS itemsByDonation ON items(did, title, units)''',
+
+		# listProviderDonations()
+		'''CREATE INDEX IF NOT EXISTS donationsByProvider ON donations(provider, completed)''',
+
+		# writeUser() ownership checks
+		'''CREATE INDEX IF NOT EXISTS usersByParent ON users(pid)'''
+	],
+
+	# Version 3: one item row per (did, title, units) so scans can be merged with UPSERT
+	[
+		# Fold any duplicate rows into the lowest id before enforcing uniqueness
+		'''UPDATE items SET count = (
+			SELECT SUM(count) FROM items dup
+			WHERE dup.did = items.did AND dup.title = items.title AND dup.units = items.units)
+			WHERE id IN (SELECT MIN(id) FROM items GROUP BY did, title, units HAVING COUNT(*) > 1)''',
+		'''DELETE FROM items WHERE id NOT IN (SELECT MIN(id) FROM items GROUP BY did, title, units)''',
+		'''DROP INDEX IF EXISTS itemsByDonation''',
+		'''CREATE UNIQUE INDEX itemsByDonation ON items(did, title, units)'''
+	],
+
+	# Version 4: keyset pagination over (created, id) per provider
+	[
+		# Pending pages seek on (provider, completed=0, created); the rowid completes the key
+		'''DROP INDEX IF EXISTS donationsByProvider''',
+		'''CREATE INDEX donationsByProvider ON donations(provider, completed, created)''',
+
+		# All/completed pages walk (provider, created) in order and filter completed
+		'''CREATE INDEX donationsByCreated ON donations(provider, created)'''
+	],
+
+	# Version 5: closure table over users.pid so subtree checks are single index lookups
+	[
+		# One row per (ancestor, descendant) pair, including each user as its own depth-0 ancestor
+		'''CREATE TABLE IF NOT EXISTS userTree(
+			ancestor TEXT NOT NULL,
+			descendant TEXT NOT NULL,
+			depth INTEGER NOT NULL,
+			PRIMARY KEY(ancestor, descendant)) WITHOUT ROWID''',
+		'''CREATE INDEX IF NOT EXISTS userTreeByDescendant ON userTree(descendant, depth)''',
+
+		# Backfill from existing users; the root admin is its own parent. Depth bound guards against pid cycles.
+		'''INSERT OR IGNORE INTO userTree(ancestor, descendant, depth)
+			WITH RECURSIVE tree(ancestor, descendant, depth) AS (
+				SELECT uid, uid, 0 FROM users
+				UNION ALL
+				SELECT users.pid, tree.descendant, tree.depth + 1 FROM tree JOIN users ON users.uid = tree.ancestor
+				WHERE users.pid != users.uid AND tree.depth < 64)
+			SELECT ancestor, descendant, MIN(depth) FROM tree GROUP BY ancestor, descendant''',
+
+		'''CREATE TRIGGER IF NOT EXISTS userTreeInsert AFTER INSERT ON users BEGIN
+			INSERT OR IGNORE INTO userTree(ancestor, descendant, depth) VALUES(NEW.uid, NEW.uid, 0);
+			INSERT OR IGNORE INTO userTree(ancestor, descendant, depth)
+				SELECT ancestor, NEW.uid, depth + 1 FROM userTree WHERE descendant = NEW.pid AND NEW.pid != NEW.uid;
+		END''',
+
+		# Re-parenting moves the whole subtree: unlink it from its old ancestors, link it under the new parent
+		'''CREATE TRIGGER IF NOT EXISTS userTreeMove AFTER UPDATE OF pid ON users WHEN NEW.pid != OLD.pid BEGIN
+			DELETE FROM userTree
+				WHERE descendant IN (SELECT descendant FROM userTree WHERE ancestor = NEW.uid)
+				AND ancestor NOT IN (SELECT descendant FROM userTree WHERE ancestor = NEW.uid);
+			INSERT OR IGNORE INTO userTree(ancestor, descendant, depth)
+				SELECT above.ancestor, below.descendant, above.depth + below.depth + 1
+				FROM userTree above, userTree below
+				WHERE above.descendant = NEW.pid AND below.ancestor = NEW.uid AND NEW.pid != NEW.uid;
+		END''',
+
+		'''CREATE TRIGGER IF NOT EXISTS userTreeDelete AFTER DELETE ON users BEGIN
+			DELETE FROM userTree WHERE descendant = OLD.uid OR ancestor = OLD.uid;
+		END'''
+	],
+
+	# Version 6: oldest-first lookup of unclaimed donations for the claim queue
+	[
+		'''CREATE INDEX IF NOT EXISTS donationsUnclaimed ON donations(receiver, completed, created)'''
+	],
+
+	# Version 7: full-text index over item titles and their barcode titles, rowid = items.id
+	[
+		'''CREATE VIRTUAL TABLE IF NOT EXISTS itemSearch USING fts5(title, barcodeTitle)''',
+		'''INSERT INTO itemSearch(rowid, title, barcodeTitle)
+			SELECT items.id, items.title, barcodes.title FROM items LEFT JOIN barcodes ON barcodes.code = items.barcode''',
+
+		'''CREATE TRIGGER IF NOT EXISTS itemSearchInsert AFTER INSERT ON items BEGIN
+			INSERT INTO itemSearch(rowid, title, barcodeTitle)
+				VALUES(NEW.id, NEW.title, (SELECT title FROM barcodes WHERE code = NEW.barcode));
+		END''',
+
+		# Count changes from repeated scans do not touch the index
+		'''CREATE TRIGGER IF NOT EXISTS itemSearchUpdate AFTER UPDATE OF title, barcode ON items
+			WHEN NEW.title IS NOT OLD.title OR NEW.barcode IS NOT OLD.barcode BEGIN
+			DELETE FROM itemSearch WHERE rowid = OLD.id;
+			INSERT INTO itemSearch(rowid, title, barcodeTitle)
+				VALUES(NEW.id, NEW.title, (SELECT title FROM barcodes WHERE code = NEW.barcode));
+		END''',
+
+		'''CREATE TRIGGER IF NOT EXISTS itemSearchDelete AFTER DELETE ON items BEGIN
+			DELETE FROM itemSearch WHERE rowid = OLD.id;
+		END'''
+	],
+
+	# Version 8: per (provider, title, units, state) item totals, maintained by triggers
+	# state is 'pending' (unclaimed), 'claimed' or 'completed'; see donationState
+	[
+		'''CREATE TABLE IF NOT EXISTS inventoryRollup(
+			provider TEXT NOT NULL,
+			title TEXT NOT NULL,
+			units TEXT NOT NULL,
+			state TEXT NOT NULL,
+			items INTEGER NOT NULL,
+			quantity INTEGER NOT NULL,
+			PRIMARY KEY(provider, title, units, state)) WITHOUT ROWID''',
+
+		'''INSERT OR REPLACE INTO inventoryRollup(provider, title, units, state, items, quantity)
+			SELECT donations.provider, items.title, items.units, {0}, COUNT(*), SUM(items.count)
+			FROM items JOIN donations ON donations.id = items.did
+			GROUP BY 1, 2, 3, 4'''.format(donationState.format('donations')),
+
+		'''CREATE TRIGGER IF NOT EXISTS rollupItemInsert AFTER INSERT ON items BEGIN
+			INSERT INTO inventoryRollup(provider, title, units, state, items, quantity)
+				SELECT provider, NEW.title, NEW.units, {0}, 1, NEW.count FROM donations WHERE id = NEW.did
+				ON CONFLICT(provider, title, units, state) DO UPDATE
+				SET items = items + excluded.items, quantity = quantity + excluded.quantity;
+		END'''.format(donationState.format('donations')),
+
+		# The scan hot path only changes count: adjust quantity in place
+		'''CREATE TRIGGER IF NOT EXISTS rollupItemCount AFTER UPDATE OF count ON items
+			WHEN NEW.did = OLD.did AND NEW.title = OLD.title AND NEW.units = OLD.units AND NEW.count != OLD.count BEGIN
+			UPDATE inventoryRollup SET quantity = quantity + NEW.count - OLD.count
+				WHERE (provider, title, units, state) =
+				(SELECT provider, NEW.title, NEW.units, {0} FROM donations WHERE id = NEW.did);
+		END'''.format(donationState.format('donations')),
+
+		'''CREATE TRIGGER IF NOT EXISTS rollupItemMove AFTER UPDATE OF did, title, units ON items
+			WHEN NEW.did != OLD.did OR NEW.title != OLD.title OR NEW.units != OLD.units BEGIN
+			UPDATE inventoryRollup SET items = items - 1, quantity = quantity - OLD.count
+				WHERE (provider, title, units, state) =
+				(SELECT provider, OLD.title, OLD.units, {0} FROM donations WHERE id = OLD.did);
+			DELETE FROM inventoryRollup WHERE items = 0 AND (provider, title, units, state) =
+				(SELECT provider, OLD.title, OLD.units, {0} FROM donations WHERE id = OLD.did);
+			INSERT INTO inventoryRollup(provider, title, units, state, items, quantity)
+				SELECT provider, NEW.title, NEW.units, {0}, 1, NEW.count FROM donations WHERE id = NEW.did
+				ON CONFLICT(provider, title, units, state) DO UPDATE
+				SET items = items + excluded.items, quantity = quantity + excluded.quantity;
+		END'''.format(donationState.format('donations')),
+
+		# Delete items before their donation, or the donation's state is gone and the totals drift
+		'''CREATE TRIGGER IF NOT EXISTS rollupItemDelete AFTER DELETE ON items BEGIN
+			UPDATE inventoryRollup SET items = items - 1, quantity = quantity - OLD.count
+				WHERE (provider, title, units, state) =
+				(SELECT provider, OLD.title, OLD.units, {0} FROM donations WHERE id = OLD.did);
+			DELETE FROM inventoryRollup WHERE items = 0 AND (provider, title, units, state) =
+				(SELECT provider, OLD.title, OLD.units, {0} FROM donations WHERE id = OLD.did);
+		END'''.format(donationState.format('donations')),
+
+		# Claiming or completing a donation moves all its items to the new state
+		'''CREATE TRIGGER IF NOT EXISTS rollupDonationState AFTER UPDATE OF provider, receiver, completed ON donations
+			WHEN NEW.provider != OLD.provider OR {0} != {1} BEGIN
+			INSERT INTO inventoryRollup(provider, title, units, state, items, quantity)
+				SELECT OLD.provider, title, units, {1}, -1, -count FROM items WHERE did = OLD.id
+				ON CONFLICT(provider, title, units, state) DO UPDATE
+				SET items = items + excluded.items, quantity = quantity + excluded.quantity;
+			DELETE FROM inventoryRollup WHERE provider = OLD.provider AND state = {1} AND items = 0;
+			INSERT INTO inventoryRollup(provider, title, units, state, items, quantity)
+				SELECT NEW.provider, title, units, {0}, 1, count FROM items WHERE did = NEW.id
+				ON CONFLICT(provider, title, units, state) DO UPDATE
+				SET items = items + excluded.items, quantity = quantity + excluded.quantity;
+		END'''.format(donationState.format('NEW'), donationState.format('OLD'))
+	],
+
+	# Version 9: archive tables for completed donations moved out of the hot tables
+	[
+		# Same columns as donations/items. Archived item ids are not unique: hot item ids can be reused.
+		'''CREATE TABLE IF NOT EXISTS donationsArchive(
+			id INTEGER PRIMARY KEY,
+			provider TEXT NOT NULL,
+			receiver TEXT DEFAULT "pending",
+			created TIMESTAMP,
+			completed TIMESTAMP DEFAULT 0)''',
+		'''CREATE INDEX IF NOT EXISTS donationsArchiveByProvider ON donationsArchive(provider, created)''',
+
+		'''CREATE TABLE IF NOT EXISTS itemsArchive(
+			id INTEGER NOT NULL,
+			did INTEGER NOT NULL,
+			barcode TEXT,
+			title TEXT NOT NULL,
+			count INTEGER NOT NULL,
+			units TEXT NOT NULL)''',
+		'''CREATE INDEX IF NOT EXISTS itemsArchiveByDonation ON itemsArchive(did)''',
+
+		# The archiver's oldest-completed-first lookup
+		'''CREATE INDEX IF NOT EXISTS donationsByCompleted ON donations(completed)''',
+
+		# Archived items stay in the completed rollup: the archiver copies items (added here) before
+		# deleting them from the hot table (subtracted by rollupItemDelete)
+		'''CREATE TRIGGER IF NOT EXISTS rollupItemArchive AFTER INSERT ON itemsArchive BEGIN
+			INSERT INTO inventoryRollup(provider, title, units, state, items, quantity)
+				SELECT provider, NEW.title, NEW.units, 'completed', 1, NEW.count FROM donationsArchive WHERE id = NEW.did
+				ON CONFLICT(provider, title, units, state) DO UPDATE
+				SET items = items + excluded.items, quantity = quantity + excluded.quantity;
+		END'''
+	],
+
+	# Version 10: keep itemSearch.barcodeTitle in step with barcodes, not only with items
+	[
+		'''CREATE INDEX IF NOT EXISTS itemsByBarcode ON items(barcode)''',
+
+		# Repair rows left stale by barcode edits made before this version
+		'''UPDATE itemSearch SET barcodeTitle = (SELECT barcodes.title FROM items JOIN barcodes ON barcodes.code = items.barcode
+			WHERE items.id = itemSearch.rowid)
+			WHERE rowid IN (SELECT id FROM items WHERE barcode IS NOT NULL)''',
+
+		# e.g. importBarcodes(on_conflict='replace')
+		'''CREATE TRIGGER IF NOT EXISTS itemSearchBarcodeUpdate AFTER UPDATE OF code, title ON barcodes
+			WHEN NEW.title IS NOT OLD.title OR NEW.code IS NOT OLD.code BEGIN
+			UPDATE itemSearch SET barcodeTitle = NULL WHERE rowid IN (SELECT id FROM items WHERE barcode = OLD.code);
+			UPDATE itemSearch SET barcodeTitle = NEW.title WHERE rowid IN (SELECT id FROM items WHERE barcode = NEW.code);
+		END''',
+
+		'''CREATE TRIGGER IF NOT EXISTS itemSearchBarcodeInsert AFTER INSERT ON barcodes BEGIN
+			UPDATE itemSearch SET barcodeTitle = NEW.title WHERE rowid IN (SELECT id FROM items WHERE barcode = NEW.code);
+		END''',
+
+		'''CREATE TRIGGER IF NOT EXISTS itemSearchBarcodeDelete AFTER DELETE ON barcodes BEGIN
+			UPDATE itemSearch SET barcodeTitle = NULL WHERE rowid IN (SELECT id FROM items WHERE barcode = OLD.code);
+		END'''
+	],
+
+	# Version 11: count every change to barcodes, so processes caching barcode state can tell when another one wrote
+	[
+		'''CREATE TABLE IF NOT EXISTS barcodeVersion(
+			id INTEGER PRIMARY KEY CHECK (id = 1),
+			version INTEGER NOT NULL)''',
+		'''INSERT OR IGNORE INTO barcodeVersion(id, version) VALUES(1, 0)''',
+
+		'''CREATE TRIGGER IF NOT EXISTS barcodeVersionInsert AFTER INSERT ON barcodes BEGIN
+			UPDATE barcodeVersion SET version = version + 1 WHERE id = 1;
+		END''',
+
+		'''CREATE TRIGGER IF NOT EXISTS barcodeVersionUpdate AFTER UPDATE ON barcodes BEGIN
+			UPDATE barcodeVersion SET version = version + 1 WHERE id = 1;
+		END''',
+
+		'''CREATE TRIGGER IF NOT EXISTS barcodeVersionDelete AFTER DELETE ON barcodes BEGIN
+			UPDATE barcodeVersion SET version = version + 1 WHERE id = 1;
+		END'''
+	]
+]
+
+# Function helperQueries()
+# Purpose: list every helper query with sample parameters, for checkQueryPlans()
+# Syntax: helperQueries()
+# Returns: A list of (helper, sql, params)
+# Note: the SQL is the helpers' own module-level query constants, so the plan check sees exactly what runs.
+#	Lists of ? marks are filled for two values; every donation filter is checked.
+# Note: the helper modules import Schema, so they are imported here rather than at the top
+def helperQueries():
+
+	import UserHelpers, DonationHelpers, ClaimQueue, ScanSession
+	U, D = UserHelpers, DonationHelpers
+	queries = [
+		('validUser', U.loginQuery, ('x',)),
+		('writeUser', U.writeUserQuery, ('x', 'y', 'y', 'x', 'y')),
+		('writeUsersBulk', U.bulkUsersQuery.format('?,?'), ('x', 'y')),
+		('writeUsersBulk', U.bulkAncestorsQuery.format('?,?'), ('x', 'y')),
+		('isAncestor', U.isAncestorQuery, ('x', 'y')),
+		('listOrgUsers', U.orgUsersQuery, ('x',)),
+		('addItemByManual', D.itemByKeyQuery, (1, 'x', 'x')),
+		('listProviderDonations', D.providerDonationsQueries[0b11], ('x', 'x')),
+		('listProviderDonations', D.providerDonationsQueries[0b01], ('x', 0)),
+		('listProviderDonations', D.providerDonationsQueries[0b10], ('x', 0, 'x')),
+		('listProviderDonationsWithItems', D.archivedDonationsQuery, ('x',)),
+		('listProviderDonationsWithItems', D.archivedItemsQuery, ('x',)),
+		('listProviderDonationsPage', D.archivedPageQuery, ('x', '', 0, 10)),
+		('searchPendingDonations', D.pendingSearchQuery, ('x', 10, 0)),
+		('searchPendingDonations', D.matchingItemsQuery.format('?,?'), ('x', 1, 2)),
+		('archiveDonations', D.archiveBatchQuery, ('x', 10)),
+		('getInventoryRollup', D.providerRollupQuery, ('x',)),
+		('getDonationItems', D.donationItemsQuery, (1, 1)),
+		('claimDonation', D.claimQuery, ('x', 1)),
+		('existDonation', D.donationExistsQuery, (1,)),
+		('existItem', D.itemExistsQuery, (1,)),
+		('getBarcode', D.barcodeQuery, ('x',)),
+		('getBarcode', D.barcodeVersionQuery, ()),
+		('ClaimQueue', ClaimQueue.candidatesQuery, (10,)),
+		('ScanSession', ScanSession.barcodesInQuery.format('?,?'), ('x', 'y')),
+		('ScanSession', ScanSession.itemIdsInQuery.format('?,?'), (1, 'x', 'y'))
+	]
+	for where in D.donationFilters.values():
+		queries.append(('listProviderDonationsWithItems', D.filteredDonationsQuery.format(where), ('x',)))
+		queries.append(('listProviderDonationsWithItems', D.filteredItemsQuery.format(where), ('x',)))
+		queries.append(('listProviderDonationsPage', D.donationsPageQuery.format(where), ('x', '', 0, 10)))
+	return queries
+
+
+# Class Database
+# Purpose: sqlite3 connection returned by openDatabase()
+# Note: shared is a dict of in-process state (caches and the like) common to every connection opened on
+#	the same file, so helpers running on pooled connections see one copy. In-memory databases get their own.
+#	The state follows the file, not its name: a database recreated at the same path starts with empty state.
+#	Barcode state is checked against commits from other connections and processes; see DonationHelpers.barcodeCache().
+class Database(sqlite3.Connection):
+	path = None
+	shared = None
+	depth = 0		# open transaction() blocks on this connection
+	onCommit = None		# callbacks registered by afterCommit() inside a transaction()
+	stores = None		# helper stores (DonationStore, UserStore) bound to this connection, by name
+	dataVersion = None	# PRAGMA data_version when this connection last looked for other connections' barcode writes
+
+	def transaction(self):
+		return transaction(self)
+
+sharedState = {}	# (absolute database path, device, inode) -> shared dict
+sharedStateLock = threading.Lock()
+
+
+# The shared state for the file now at path; state left by an earlier file at that path is dropped
+def _sharedState(path, fresh=False):
+	path = os.path.abspath(path)
+	try:
+		st = os.stat(path)
+		key = (path, st.st_dev, st.st_ino)
+	except OSError:
+		key = (path, None, None)
+	with sharedStateLock:
+		for old in [k for k in sharedState if k[0] == path and k != key]:
+			del sharedState[old]
+		if fresh:
+			sharedState[key] = {}
+		return sharedState.setdefault(key, {})
+
+
+# Connection settings for file-backed databases
+busyTimeout = 5.0	# Seconds a connection waits on a locked database before raising
+cacheSize = -16384	# Negative values are KiB: 16 MiB page cache per connection
+statementCacheSize = 256	# Prepared statements kept per connection; covers every helper query with room to spare
+
 
 # Set up tables and return connection
-def createSchema():
+# Note: path defaults to an in-memory database; any other path is opened durably in WAL mode
+# Note: with a snapshot path (see Snapshot.py), an empty database is warm-started from that snapshot if it exists,
+#	then migrated as usual, so snapshots taken by older versions are upgraded on load
+def createSchema(path=':memory:', snapshot=None):
 	try:
-		db = sqlite3.connect(':memory:')
+		db = openDatabase(path)
 	except Error as e:
 		print(e)
 		sys.exit(1)
 
-	c = db.cursor()
+	# A new (or emptied) file reuses nothing cached for whatever was at this path before: inodes are recycled
+	if db.execute('''PRAGMA user_version''').fetchone()[0] == 0:
+		if path != ':memory:':
+			db.shared = _sharedState(path, fresh=True)
+		if snapshot is not None:
+			restoreSnapshot(db, snapshot)
+	migrateSchema(db)
+	return db
+
+
+# Function openDatabase()
+# Purpose: open a connection with the settings every helper expects
+# Syntax: openDatabase(<path>, <read_only>)
+# Returns: a sqlite3 connection usable from any thread
+# Note: WAL lets readers proceed while one writer commits. synchronous=NORMAL is durable in WAL mode
+#	except for the last transactions before a power loss, which never corrupts the database.
+# Note: read_only connections refuse writes; ConnectionPool hands these to reader threads
+def openDatabase(path=':memory:', readOnly=False):
 
-	# pid is uid of parent account (authenticating Org or Admin)
-	# Perms: bit string of length 4 such that 0=F/1=T in order <wxyz>
-		# w: Admin Access (full access)
-		# x: Orgizational Access (create/delete accounts)
-		# y: Provider Access (create donations, et al.)
-		# z: Receiver Access (claim donations, et al.)
-	c.execute('''CREATE TABLE users(
-		pid TEXT NOT NULL,
-		perms INTEGER,
-		uid TEXT NOT NULL UNIQUE, 
-		hash TEXT)''')
-
-	# barcodes contains title and unit type for barcoded items
-	c.execute('''CREATE TABLE barcodes(
-		code TEXT NOT NULL UNIQUE,
-		title TEXT NOT NULL,
-		units INTEGER NOT NULL)''')
-
-
-	# did is associated donation id
-	c.execute('''CREATE TABLE items(
-		id INTEGER PRIMARY KEY,
-		did INTEGER NOT NULL,
-		barcode TEXT, 
-		title TEXT NOT NULL, 
-		count INTEGER NOT NULL, 
-		units TEXT NOT NULL)''')
-
-	c.execute('''CREATE TABLE donations(
-		id INTEGER PRIMARY KEY, 
-		provider TEXT NOT NULL, 
-		receiver TEXT DEFAULT "pending",
-		created TIMESTAMP,
-		completed TIMESTAMP DEFAULT 0)''') 
-
-	db.commit()
+	db = sqlite3.connect(path, timeout=busyTimeout, check_same_thread=False, factory=Database, cached_statements=statementCacheSize)
+	db.path = path
+	db.stores = {}
+
+	c = db.cursor()
+	if path != ':memory:':
+		c.execute('''PRAGMA journal_mode = WAL''')
+		c.execute('''PRAGMA synchronous = NORMAL''')
+	c.execute('''PRAGMA cache_size = {0:d}'''.format(cacheSize))
+	c.execute('''PRAGMA temp_store = MEMORY''')
+	if readOnly:
+		c.execute('''PRAGMA query_only = ON''')
 	c.close()
+
+	# After the pragmas above, which create the file if it is new
+	db.shared = {} if path == ':memory:' else _sharedState(path)
 	return db
+
+
+# Function transaction()
+# Purpose: group several helper calls into one atomic unit of work
+# Syntax: with transaction(<connection>): addDonation(...); addItemByBarcode(...)
+# Returns: a context manager yielding the connection
+# Note: helpers commit through commit(), which does nothing inside a transaction, so the block costs one commit.
+#	An exception rolls the block back and propagates. Helpers report failure by return value, not exception:
+#	raise to abandon the work.
+# Note: nested blocks become savepoints; an exception in an inner block undoes only that block.
+# Note: the outermost block begins IMMEDIATE, taking the write lock up front instead of failing on upgrade.
+@contextmanager
+def transaction(db):
+
+	if not isinstance(db, Database):
+		raise TypeError('transaction() needs a connection from Schema.openDatabase()')
+
+	c = db.cursor()
+	if db.depth == 0:
+		if not db.in_transaction:
+			c.execute('''BEGIN IMMEDIATE''')
+		db.onCommit = []
+		db.depth = 1
+		try:
+			yield db
+		except BaseException:
+			db.depth = 0
+			db.onCommit = None
+			db.rollback()
+			c.close()
+			raise
+		db.depth = 0
+		callbacks, db.onCommit = db.onCommit, None
+		try:
+			db.commit()
+		except BaseException:
+			db.rollback()
+			c.close()
+			raise
+		c.close()
+		for callback in callbacks:
+			callback()
+	else:
+		savepoint = 'unitOfWork{0:d}'.format(db.depth)
+		c.execute('''SAVEPOINT ''' + savepoint)
+		db.depth += 1
+		try:
+			yield db
+		except BaseException:
+			db.depth -= 1
+			c.execute('''ROLLBACK TO ''' + savepoint)
+			c.execute('''RELEASE ''' + savepoint)
+			c.close()
+			raise
+		db.depth -= 1
+		c.execute('''RELEASE ''' + savepoint)
+		c.close()
+
+
+# Function commit()
+# Purpose: commit a helper's writes unless an enclosing transaction() will
+# Syntax: commit(<connection>)
+def commit(db):
+
+	if getattr(db, 'depth', 0) == 0:
+		db.commit()
+
+
+# Function afterCommit()
+# Purpose: run a callback once the current writes are durable, e.g. to invalidate caches
+# Syntax: afterCommit(<connection>, <callback>)
+# Note: runs immediately outside a transaction(); inside one it waits for the outermost commit and is dropped on rollback
+def afterCommit(db, callback):
+
+	if getattr(db, 'depth', 0) == 0:
+		callback()
+	else:
+		db.onCommit.append(callback)
+
+
+# Function migrateSchema()
+# Purpose: bring a database up to the latest schema version
+# Syntax: migrateSchema(<connection>)
+# Returns: the schema version of the database after migrating
+# Note: each version is applied in its own transaction, so a failed migration leaves the previous version intact
+def migrateSchema(db):
+
+	c = db.cursor()
+	c.execute('''PRAGMA user_version''')
+	version = c.fetchone()[0]
+
+	for target in range(version + 1, len(migrations) + 1):
+		try:
+			c.execute('''BEGIN''')
+			for statement in migrations[target - 1]:
+				c.execute(statement)
+			# PRAGMA does not accept bound parameters
+			c.execute('''PRAGMA user_version = {0:d}'''.format(target))
+			c.execute('''COMMIT''')
+		except Error:
+			c.execute('''ROLLBACK''')
+			c.close()
+			raise
+		version = target
+
+	c.close()
+	return version
+
+
+# Function checkQueryPlans()
+# Purpose: confirm every helper query in helperQueries() is served by an index
+# Syntax: checkQueryPlans(<connection>)
+# Returns: A list of (helper, sql, plan_detail) for each full table scan found, or an empty list if none
+def checkQueryPlans(db):
+
+	scans = []
+	c = db.cursor()
+	for helper, sql, params in helperQueries():
+		c.execute('''EXPLAIN QUERY PLAN ''' + sql, params)
+		for row in c.fetchall():
+			# Plan detail is the last column, e.g. "SCAN items" or "SEARCH items USING INDEX ..."
+			# A SELECT without FROM reports "SCAN CONSTANT ROW", which reads no table.
+			# Virtual tables always report SCAN; "INDEX 0:M2" means FTS is answering a MATCH, "INDEX 0:" reads it all.
+			detail = row[-1]
+			if not detail.startswith('SCAN') or detail == 'SCAN CONSTANT ROW':
+				continue
+			if 'VIRTUAL TABLE INDEX' in detail and not detail.endswith(':'):
+				continue
+			scans.append((helper, sql, detail))
+	c.close()
+	return scans
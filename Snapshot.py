@@ -0,0 +1,128 @@
+# Snapshot.py implements online snapshots of a live database and warm start from the latest one
+
+import os, time, sqlite3, threading, urllib.request
+
+# Functions:
+# saveSnapshot()
+# restoreSnapshot()
+# snapshotMetrics()
+
+# Defaults for saveSnapshot(): pages copied per step, and seconds to yield to other threads between steps
+snapshotPages = 256
+snapshotSleep = 0.001
+
+# Timings of the most recent snapshot and restore in this process, read with snapshotMetrics()
+metrics = {
+	'snapshots': 0,
+	'snapshotSeconds': 0.0,
+	'snapshotPages': 0,
+	'snapshotSteps': 0,
+	'pagesPerStep': 0.0,
+	'restores': 0,
+	'restoreSeconds': 0.0,
+	'restorePages': 0
+}
+metricsLock = threading.Lock()
+
+
+# Function saveSnapshot()
+# Purpose: copy a live database to a snapshot file a few pages at a time
+# Syntax: saveSnapshot(<connection>, <snapshot_path>, <pages_per_step>, <sleep_seconds>)
+# Returns: the metrics of this snapshot as a dict (seconds, pages, steps, pagesPerStep)
+# Note: between steps the source connection is released, so other threads keep writing to it; writes made through
+#	the same connection are carried into the copy as it goes. The copy is written beside the target and renamed
+#	over it only when complete, so the previous snapshot survives a crash mid-copy.
+def saveSnapshot(db, path, pages=None, sleep=None):
+
+	pages = snapshotPages if pages is None else pages
+	sleep = snapshotSleep if sleep is None else sleep
+	steps = [0, 0]	# [steps, total pages]
+
+	def progress(status, remaining, total):
+		steps[0] += 1
+		steps[1] = total
+
+	partial = path + '.partial'
+	if os.path.exists(partial):
+		os.remove(partial)
+
+	start = time.monotonic()
+	target = sqlite3.connect(partial)
+	try:
+		db.backup(target, pages=pages, progress=progress, sleep=sleep)
+	finally:
+		target.close()
+	os.replace(partial, path)
+	seconds = time.monotonic() - start
+
+	result = {
+		'seconds': seconds,
+		'pages': steps[1],
+		'steps': steps[0],
+		'pagesPerStep': steps[1] / steps[0] if steps[0] else 0.0
+	}
+	with metricsLock:
+		metrics['snapshots'] += 1
+		metrics['snapshotSeconds'] = seconds
+		metrics['snapshotPages'] = result['pages']
+		metrics['snapshotSteps'] = result['steps']
+		metrics['pagesPerStep'] = result['pagesPerStep']
+	return result
+
+
+# Function restoreSnapshot()
+# Purpose: load a snapshot file into a connection, replacing its contents
+# Syntax: restoreSnapshot(<connection>, <snapshot_path>)
+# Returns: True if the snapshot was loaded, False if there is no snapshot at path
+# Note: copies in one step; the connection should not be in use by other threads while it runs
+def restoreSnapshot(db, path):
+
+	if not os.path.exists(path):
+		return False
+
+	start = time.monotonic()
+	# Quote the path so ?, # and % in it are not read as URI syntax
+	source = sqlite3.connect('file:{0}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(path))), uri=True)
+	try:
+		source.backup(db)
+		pages = source.execute('''PRAGMA page_count''').fetchone()[0]
+	finally:
+		source.close()
+	seconds = time.monotonic() - start
+
+	with metricsLock:
+		metrics['restores'] += 1
+		metrics['restoreSeconds'] = seconds
+		metrics['restorePages'] = pages
+	return True
+
+
+# Function snapshotMetrics()
+# Purpose: report snapshot and restore timings
+# Returns: a copy of the metrics dict
+def snapshotMetrics():
+	with metricsLock:
+		return dict(metrics)
+
+
+# Class Snapshotter
+# Purpose: background thread that snapshots a live database every interval seconds, and once more on stop()
+# Syntax: snapshotter = Snapshotter(<connection>, <snapshot_path>, <interval_seconds>); snapshotter.start(); ... snapshotter.stop()
+# Note: shares the caller's connection, which is how an in-memory database is reached from another thread
+class Snapshotter(threading.Thread):
+
+	def __init__(self, db, path, interval=300.0):
+		threading.Thread.__init__(self, name='snapshotter', daemon=True)
+		self.db = db
+		self.path = path
+		self.interval = interval
+		self.stopping = threading.Event()
+
+	def run(self):
+		while not self.stopping.wait(self.interval):
+			saveSnapshot(self.db, self.path)
+		saveSnapshot(self.db, self.path)
+
+	def stop(self):
+		self.stopping.set()
+		self.join()
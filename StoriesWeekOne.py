@@ -1,15 +1,33 @@
-import datetime
-from Schema import createSchema
-from UserHelpers import validUser, writeUser
-from DonationHelpers import addBarcode, addDonation, addItemByManual, addItemByBarcode, listProviderDonations, getDonationItems, claimDonation 
+import os, tempfile
+from Schema import createSchema, checkQueryPlans
+from UserHelpers import validUser, writeUsersBulk
+from DonationHelpers import addBarcode, addDonation, addItemByManual, addItemByBarcode, listProviderDonations, listProviderDonationsWithItems, listProviderDonationsPage, searchPendingDonations, importBarcodes, claimDonation, completeDonations
+
+
+# Initialization values for users table
+parents = ['admin', 'admin', 'admin','P_Org', 'R_Org'] # Parent IDs
+users0 = ['admin', 'P_Org', 'R_Org', 'Pearl', 'Ruby'] # User IDs
+users1 = ['badmin', 'O_Org', 'Q_Org', 'Opal', 'Quartz'] # User IDs
+perms = [0b1111, 0b0110, 0b0101, 0b0010, 0b0001] # Permission bits
+pwd0 = ['admin', 'alice', 'bob', 'carol', 'david'] # Passwords
+pwd1 = ['nimda', 'olive', 'rob', 'hunter2', 'avery'] # More passwords
+
+# Intialization values item and barcodes
+items = [
+	['111111111111', 'organic kumqat', 'each', 32], 
+	['222222222222', 'hot peppers', 'lb', 16], 
+	['333333333333', 'PBR lager', 'case', 8], 
+	['444444444444', 'ground beef', 'lb', 4], 
+	['555555555555', 'ground cumin', 'oz', 2], 
+	['666666666666', 'B1 steak sauce', 'bottle', 1]
+]
 
 
 # populate users fills the users table
 def populateUsers(db, parents, users, perms, pwd):
 
-	# Build user table against params
-	for ppid, uid, perm, wd in zip(parents, users, perms, pwd):
-		writeUser(db, ppid, uid, perm, wd)
+	# Build user table against params in one batch
+	writeUsersBulk(db, zip(parents, users, perms, pwd))
 
 # prints user table
 def printUserTable(db):
@@ -95,30 +113,26 @@ def testBarItem(test, db, provider, items):
 # Syntax: (<test_dict>, <connection>, <provider_uid>)	
 def	showProviderPending(test, db, provider):
 
-	# Test listProviderDonations pending
-	test['listProviderDonations'][0] += 1
-	result = listProviderDonations(db, provider, 0b01)
+	# Test listProviderDonationsWithItems pending
+	test['listProviderDonationsWithItems'][0] += 1
+	result = listProviderDonationsWithItems(db, provider, 0b01)
 
 	# if no donations found
 	if result is []:
-		test['listProviderDonations'][1] += 1
+		test['listProviderDonationsWithItems'][1] += 1
 		print('No pending donations found for provider: {0}', format(provider))
 
 	# if donation found
 	else:
+		checkItemCounts(test, db, result)
 		# Show donations
 		print('\n\t\t\t\tPending Donations')
-		for r in result:
+		for r, items in result:
 			print('\nrow\tprovider\treceiver\tcreated\t\t\t\tcompleted')
 			print('{0}\t{1}\t\t{2}\t\t{3}\t{4}'.format(r[0], r[1], r[2], r[3], r[4]))
 	
-			# Get items for current donation
-			test['getDonationItems'][0] += 1
-			items = getDonationItems(db, r[0])
-
 			# If no items found
-			if items is []:
-				test['getDonationItems'][1] += 1
+			if items == []:
 				print('No items found for donation: r[0]')
 
 			# If items found
@@ -130,6 +144,24 @@ def	showProviderPending(test, db, provider):
 					print('')					
 
 
+# Items arrive grouped by donation; check every group's size against the tables with one aggregate query
+# Syntax: (<test_dict>, <connection>, <listProviderDonationsWithItems_result>)
+def checkItemCounts(test, db, result):
+
+	test['itemCounts'][0] += 1
+	dids = [r[0] for r, items in result]
+	if not dids:
+		return
+	marks = ','.join('?' * len(dids))
+	c.execute('''SELECT did, COUNT(*) FROM items WHERE did IN ({0}) GROUP BY did
+		UNION ALL SELECT did, COUNT(*) FROM itemsArchive WHERE did IN ({0}) GROUP BY did'''.format(marks), dids + dids)
+	counts = dict.fromkeys(dids, 0)
+	for did, count in c.fetchall():
+		counts[did] += count
+	if counts != {r[0]: len(items) for r, items in result}:
+		test['itemCounts'][1] += 1
+
+
 # Story 6: As a receiver I can claim a donation
 # Syntax: (<test_dict>, <connection>, <provider_uid>, <receiver_uid>)	
 def claimFirst(test, db, provider, receiver):
@@ -168,39 +200,32 @@ def completeFirst(db, provider):
 		return
 
 	# Set completed for first donation to now
-	c = db.cursor()
-	c.execute('''UPDATE donations SET completed = ? WHERE id = ?''', (datetime.datetime.now(), dList[0][0]))
-	db.commit
-	c.close()
+	completeDonations(db, [dList[0][0]])
 
 
 # Syntax: <test_dict>, (<connection>, <provider_uid>)	
 def	showProviderPast(test, db, provider):
 
-	# Test listProviderDonations past
-	test['listProviderDonations'][0] += 1
-	result = listProviderDonations(db, provider, 0b10)
+	# Test listProviderDonationsWithItems past
+	test['listProviderDonationsWithItems'][0] += 1
+	result = listProviderDonationsWithItems(db, provider, 0b10)
 
 	# if no donations found
 	if result is []:
-		test['listProviderDonations'][1] += 1
+		test['listProviderDonationsWithItems'][1] += 1
 		print('No past donations found for provider: {0}', format(provider))
 
 	# if donation found
 	else:
+		checkItemCounts(test, db, result)
 		# Show donations
 		print('\n\t\t\t\tPast Donations')
-		for r in result:
+		for r, items in result:
 			print('\nrow\tprovider\treceiver\tcreated\t\t\t\tcompleted')
 			print('{0}\t{1}\t\t{2}\t\t{3}\t{4}'.format(r[0], r[1], r[2], r[3], r[4]))
 	
-			# Get items for current donation
-			test['getDonationItems'][0] += 1
-			items = getDonationItems(db, r[0])
-
 			# If no items found
-			if items is []:
-				test['getDonationItems'][1] += 1
+			if items == []:
 				print('No items found for donation: r[0]')
 
 			# If items found
@@ -211,6 +236,57 @@ def	showProviderPast(test, db, provider):
 						print('{0}\t'.format(j), end='')
 					print('')					
 
+# Pages through a provider's donations one at a time and checks them against the full listing;
+# a page size below 1 must be refused with ValueError
+# Syntax: (<test_dict>, <connection>, <provider_uid>)
+def testPaging(test, db, provider):
+
+	test['listProviderDonationsPage'][0] += 1
+	rows, cursor = listProviderDonationsPage(db, provider, 0b11, 1)
+	while cursor is not None:
+		page, cursor = listProviderDonationsPage(db, provider, 0b11, 1, cursor)
+		rows += page
+	if sorted(rows) != sorted(listProviderDonations(db, provider, 0b11)):
+		test['listProviderDonationsPage'][1] += 1
+
+	for pageSize in (0, -1):
+		test['listProviderDonationsPage'][0] += 1
+		try:
+			listProviderDonationsPage(db, provider, 0b11, pageSize)
+			test['listProviderDonationsPage'][1] += 1
+		except ValueError:
+			pass
+
+
+# Replaces a barcode's title through importBarcodes() and searches pending donations for the new title
+# Syntax: (<test_dict>, <connection>, <provider_uid>, <item_bar_list>)
+def testRetitleSearch(test, db, provider, items):
+
+	code = items[0][0]
+	did = addDonation(db, provider, None)
+	addItemByBarcode(db, did, code, 1)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		catalog = os.path.join(tmp, 'catalog.csv')
+		with open(catalog, 'w') as f:
+			f.write('{0},Heirloom Calamansi,{1}\n'.format(code, items[0][2]))
+		importBarcodes(db, catalog, 'replace')
+
+	test['searchPendingDonations'][0] += 1
+	if did not in [r[0] for r, matches in searchPendingDonations(db, 'calamansi')]:
+		test['searchPendingDonations'][1] += 1
+
+
+# Confirms every helper query is index-backed; a full scan is a failure
+# Syntax: (<test_dict>, <connection>)
+def testQueryPlans(test, db):
+
+	print('')
+	for helper, sql, detail in checkQueryPlans(db):
+		test['checkQueryPlans'][1] += 1
+		print('FULL SCAN in {0}: {1}'.format(helper, detail))
+	test['checkQueryPlans'][0] += 1
+
 def printHeader(header):
 	eq = "=" * 80
 	print('\n{0}\n\t{1}\n{0}'.format(eq, header))
@@ -246,26 +322,12 @@ if __name__ == '__main__':
 	test['addItemByManual'] = [0, 0]
 	test['addItemByBarcode'] = [0, 0]
 	test['listProviderDonations'] = [0, 0]
-	test['getDonationItems'] = [0, 0]
+	test['listProviderDonationsWithItems'] = [0, 0]
+	test['itemCounts'] = [0, 0]
 	test['claimDonation'] = [0, 0]
-
-	# Initialization values for users table
-	parents = ['admin', 'admin', 'admin','P_Org', 'R_Org'] # Parent IDs
-	users0 = ['admin', 'P_Org', 'R_Org', 'Pearl', 'Ruby'] # User IDs
-	users1 = ['badmin', 'O_Org', 'Q_Org', 'Opal', 'Quartz'] # User IDs
-	perms = [0b1111, 0b0110, 0b0101, 0b0010, 0b0001] # Permission bits
-	pwd0 = ['admin', 'alice', 'bob', 'carol', 'david'] # Passwords
-	pwd1 = ['nimda', 'olive', 'rob', 'hunter2', 'avery'] # More passwords
-
-	# Intialization values item and barcodes
-	items = [
-		['111111111111', 'organic kumqat', 'each', 32], 
-		['222222222222', 'hot peppers', 'lb', 16], 
-		['333333333333', 'PBR lager', 'case', 8], 
-		['444444444444', 'ground beef', 'lb', 4], 
-		['555555555555', 'ground cumin', 'oz', 2], 
-		['666666666666', 'B1 steak sauce', 'bottle', 1]
-	]
+	test['listProviderDonationsPage'] = [0, 0]
+	test['searchPendingDonations'] = [0, 0]
+	test['checkQueryPlans'] = [0, 0]
 
 	# Generate tables
 	db = createSchema()
@@ -303,6 +365,9 @@ if __name__ == '__main__':
 	showProviderPast(test, db, users1[3])
 
 	# Show test results
+	testPaging(test, db, users1[3])
+	testRetitleSearch(test, db, users0[3], items)
+	testQueryPlans(test, db)
 	printHeader(stories[7])
 	printResults(test)
 
@@ -0,0 +1,128 @@
+# StressClaims.py races many receivers for the same donations and checks that none is claimed twice
+#
+# Run with "python3 StressClaims.py [--receivers N] [--donations N] [--queue]"
+# Exits non-zero if any donation was double-claimed or claimed by someone other than its recorded winner.
+
+import sys, os, time, random, argparse, tempfile, threading
+from Schema import createSchema, openDatabase, transaction
+from DonationHelpers import addDonation, claimDonation
+from ClaimQueue import ClaimQueue
+
+
+# Every receiver gets its own connection and tries to claim every donation, in its own random order
+def raceDirect(path, receivers, dids):
+
+	wins = {rid: [] for rid in receivers}
+
+	def receiver(rid):
+		db = openDatabase(path)
+		order = list(dids)
+		random.shuffle(order)
+		for did in order:
+			if claimDonation(db, did, rid):
+				wins[rid].append(did)
+		db.close()
+
+	threads = [threading.Thread(target=receiver, args=(rid,)) for rid in receivers]
+	start = time.monotonic()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return wins, time.monotonic() - start
+
+
+# Receivers register with a shared ClaimQueue while distributor threads hand out batches
+def raceQueue(path, receivers, dids, distributors=4, batchSize=50):
+
+	queue = ClaimQueue()
+	share = len(dids) // len(receivers) + 1
+	for rid in receivers:
+		queue.register(rid, share)
+
+	wins = {rid: [] for rid in receivers}
+	lock = threading.Lock()
+
+	def distributor():
+		db = openDatabase(path)
+		# An empty batch only means the candidates were raced away; stop when none are pending
+		while len(queue):
+			claimed, exhausted = queue.distribute(db, batchSize)
+			with lock:
+				for did, rid in claimed:
+					wins[rid].append(did)
+			if exhausted:
+				break
+		db.close()
+
+	threads = [threading.Thread(target=distributor) for _ in range(distributors)]
+	start = time.monotonic()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return wins, time.monotonic() - start
+
+
+# Returns: a list of problems, empty when every donation has exactly one winner matching the table
+def check(path, wins, dids):
+
+	problems = []
+	winner = {}
+	for rid, claimed in wins.items():
+		for did in claimed:
+			if did in winner:
+				problems.append('donation {0} claimed by both {1} and {2}'.format(did, winner[did], rid))
+			winner[did] = rid
+
+	db = openDatabase(path)
+	c = db.cursor()
+	c.execute('''SELECT id, receiver FROM donations''')
+	for did, receiver in c.fetchall():
+		if winner.get(did, 'pending') != receiver:
+			problems.append('donation {0} recorded for {1}, but {2} won it'.format(did, receiver, winner.get(did)))
+	c.close()
+	db.close()
+
+	if len(winner) != len(dids):
+		problems.append('{0} of {1} donations claimed'.format(len(winner), len(dids)))
+	return problems
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='StressClaims.py')
+	parser.add_argument('--receivers', type=int, default=16, help='concurrent receivers')
+	parser.add_argument('--donations', type=int, default=2000, help='pending donations to fight over')
+	parser.add_argument('--queue', action='store_true', help='distribute through ClaimQueue instead of racing claimDonation()')
+	args = parser.parse_args(argv)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'claims.db')
+		db = createSchema(path)
+		with transaction(db):
+			dids = [addDonation(db, 'provider', None) for _ in range(args.donations)]
+		db.close()
+
+		receivers = ['receiver{0}'.format(n) for n in range(args.receivers)]
+		if args.queue:
+			wins, elapsed = raceQueue(path, receivers, dids)
+			attempts = len(dids)
+		else:
+			wins, elapsed = raceDirect(path, receivers, dids)
+			attempts = len(dids) * len(receivers)
+
+		problems = check(path, wins, dids)
+
+	claims = sum(len(claimed) for claimed in wins.values())
+	print('{0} mode: {1} receivers, {2} donations'.format('queue' if args.queue else 'direct', args.receivers, args.donations))
+	print('{0} claims from {1} attempts in {2:.2f}s: {3:.0f} claims/s, {4:.0f} attempts/s'.format(
+		claims, attempts, elapsed, claims / elapsed, attempts / elapsed))
+	for problem in problems:
+		print('FAIL: ' + problem)
+	if not problems:
+		print('PASS: no double claims')
+	return 1 if problems else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
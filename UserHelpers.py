@@ -1,31 +1,78 @@
 # UserHelpers.py implements helper functions for manipulating the user table
 
-import hashlib # Hash passwords with SHA256
+# Functions:
+# validUser()
+# writeUser()
+# writeUsersBulk()
+# isAncestor()
+# listOrgUsers()
+# createSession()
+# sessionUser()
+# sessionHasPerms()
+# endSession()
+# userStore()
+
+import sqlite3, time, secrets, threading
+from collections import OrderedDict
+from Schema import commit, afterCommit, transaction, openDatabase
+from Passwords import submitHash, submitVerify, needsRehash # Salted KDF hashing on a bounded worker pool
+
+# Helper queries. Schema.checkQueryPlans() explains these same statements, so keep every read here.
+loginQuery = '''SELECT hash, perms FROM users WHERE uid=?'''
+writeUserQuery = '''SELECT
+	(SELECT MAX(rowid) FROM users) IS NOT NULL,
+	(SELECT perms FROM users WHERE uid = ?),
+	(SELECT pid FROM users WHERE uid = ?),
+	(SELECT perms FROM users WHERE uid = ?),
+	EXISTS(SELECT 1 FROM userTree WHERE ancestor = ? AND descendant = ? AND depth > 0)'''
+bulkUsersQuery = '''SELECT uid, pid, perms FROM users WHERE uid IN ({0})'''
+bulkAncestorsQuery = '''SELECT ancestor, descendant FROM userTree WHERE descendant IN ({0}) AND depth > 0'''
+isAncestorQuery = '''SELECT 1 FROM userTree WHERE ancestor = ? AND descendant = ? AND depth > 0'''
+orgUsersQuery = '''SELECT users.uid, users.pid, users.perms, userTree.depth FROM userTree JOIN users ON users.uid = userTree.descendant
+	WHERE userTree.ancestor = ? AND userTree.depth > 0 ORDER BY userTree.depth, users.uid'''
 
 
 # Function: validUser()
 # Purpose: Validate uid/pwd pair in users table
 # Syntax: validUser(<connection>, <user_id_to_check>, <password to check>)
 # Returns: True on valid pair / False on invalid pair
+# Note: a valid password stored as legacy SHA-256 or under old KDF parameters is rehashed with the current
+#	hasher. On a read-only connection the upgrade is written through a short-lived writer connection to the same file.
 def validUser(db, uid, pwd):
+	return userStore(db).validUser(uid, pwd)
+
 
-	# hash pwd argument
-	hash_object = hashlib.sha256(pwd.encode())
-	hex_dig = hash_object.hexdigest()
+# Replace a verified hash, unless another login upgraded it first
+# Note: read-only connections (PRAGMA query_only: ConnectionPool.reader(), the AsyncDatabase read lane) cannot store
+#	the new hash, so it is computed and written on a writer connection opened for the upgrade
+def _rehash(db, uid, old, pwd):
 
-	# get current hash
 	c = db.cursor()
-	c.execute('''SELECT hash FROM users WHERE uid=?''', (uid,))
-	result = c.fetchone()
+	c.execute('''PRAGMA query_only''')
+	readOnly = c.fetchone()[0]
 	c.close()
 
-	# If current hash exists and matches arg hash then uid/pwd is valid
-	if result is not None:
-		if result[0] == hex_dig:
-			return True
+	if readOnly:
+		path = getattr(db, 'path', None)
+		if path is None or path == ':memory:':
+			return
+		writer = openDatabase(path)
+		try:
+			_rehash(writer, uid, old, pwd)
+		finally:
+			writer.close()
+		return
 
-	# Default to uid/pwd is invalid
-	return False
+	newHash = submitHash(pwd).result()
+	c = db.cursor()
+	try:
+		c.execute('''UPDATE users SET hash = ? WHERE uid = ? AND hash = ?''', (newHash, uid, old))
+		commit(db)
+	except sqlite3.OperationalError:
+		# Busy connection: keep the old hash until a later login
+		if db.in_transaction and getattr(db, 'depth', 0) == 0:
+			db.rollback()
+	c.close()
 
 
 # Function: writeUser()
@@ -33,70 +80,369 @@ def validUser(db, uid, pwd):
 # Syntax: writeUser(<connection>, <parent_id>, <child_id>, <permissions>, <pwd>)
 # Returns True on success / False on failure
 # Note: First user into users gets admin permissions
-# Note: pwd only used for new users. changePassword will write to existing pwds
+# Note: an existing user can be updated by any user above it in the org tree, not only its direct parent
+# Note: pwd only used for new users, and only hashed then. changePassword will write to existing pwds
 def writeUser(db, pid, uid, perms, pwd):
 
-	# hash pwd argument
-	hash_object = hashlib.sha256(pwd.encode())
-	hex_dig = hash_object.hexdigest()
+	# Everything the permission rules need, in one statement:
+	# any user at all (MAX(rowid) reads one index entry, not the table), parent perms, child pid and perms,
+	# and whether the parent is above the child anywhere in its org subtree
+	c = db.cursor()
+	c.execute(writeUserQuery, (pid, uid, uid, pid, uid))
+	anyUser, pperms, cpid, cperms, owns = c.fetchone()
 
 	# First user into table gets administrative access!
-	c = db.cursor()
-	c.execute('''SELECT * FROM users''')
-	result = c.fetchone()
-	if result is None:
-		firstUser = True
-		c.execute('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''', (pid, 0b1111, uid, hex_dig))
+	if not anyUser:
+		c.execute('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''', (pid, 0b1111, uid, submitHash(pwd).result()))
+		commit(db)
+		c.close()
+		return True
 
 	# Otherwise table not empty:
+	# Parent must exist
+	if pperms is None:
+		c.close()
+		return False
+
+	# If creating admin, parent must be admin
+	if (0b1000 & perms == 0b1000) and (0b1000 & pperms != 0b1000):
+		c.close()
+		return False
+
+	# If creating org, parent must be admin
+	if (0b100 & perms == 0b100) and (0b1000 & pperms != 0b1000):
+		c.close()
+		return False
+
+	# Assigned child roles must be enabled in parent some role must be assigned
+	if (0b1 & perms != 0b1 & pperms) and (0b10 & perms != 0b10 & pperms) or (0b0011 & perms == 0):
+		c.close()
+		return False
+
+	# If user does not exist, create and add hash
+	if cpid is None:
+		c.execute('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''', (pid, perms, uid, submitHash(pwd).result()))
+		result = c.rowcount
+
+	# If user exists and pid owns user (directly or anywhere above it in the org tree), update all but hash
+	elif (cpid == pid) or owns:
+		# update user
+		c.execute('''UPDATE users SET perms = ? WHERE uid = ?''', (perms, uid))
+		result = c.rowcount
+
+		# Cached perms in the user's sessions are now stale
+		afterCommit(db, lambda: sessions.revokeUser(uid))
+
+	# User exists but is not ours: succeed only if it already has the requested access
 	else:
-		firstUser = False
-		# Get parent permissions
-		c.execute('''SELECT perms FROM users WHERE uid=?''', (pid,))
-		result = c.fetchone()
-		if result is None:
-			return False
-		pperms = result[0]
+		c.close()
+		return cperms == perms
 
-		# If creating admin, parent must be admin
-		if (0b1000 & perms == 0b1000) and (0b1000 & pperms != 0b1000):
-			return False
-	
-		# If creating org, parent must be admin
-		if (0b100 & perms == 0b100) and (0b1000 & pperms != 0b1000):
-			return False
+	commit(db)
+	c.close()
 
-		# Assigned child roles must be enabled in parent some role must be assigned
-		if (0b1 & perms != 0b1 & pperms) and (0b10 & perms != 0b10 & pperms) or (0b0011 & perms == 0):
-			return False
+	if result == 1:
+		return True
+	else:
+		return False
 
-		# Get pid and confirm ownership
-		c.execute('''SELECT pid FROM users WHERE uid=?''', (uid,))
-		result = c.fetchone()
-	
-		# If user does not exist, create and add hash
-		if result is None:
-			c.execute('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''', (pid, perms, uid, hex_dig))
 
-		# If user exists and pid owns user, update all but hash
-		elif (result is not None) and (result[0] == pid):
-			# update user
-			c.execute('''UPDATE users SET perms = ? WHERE uid = ?''', (perms, uid))		
+# Function: writeUsersBulk()
+# Purpose: Apply many writeUser() calls at once, e.g. to onboard a whole organization
+# Syntax: writeUsersBulk(<connection>, [(<parent_id>, <child_id>, <permissions>, <pwd>), ...])
+# Returns: A list with writeUser()'s True/False result for each row, in order
+# Note: rows are judged in order by writeUser()'s rules, so a row may name a parent created earlier in the batch.
+#	The rows are judged once without the write lock, and only rows that would insert a user have their passwords
+#	hashed, in parallel on the KDF pool. Then, inside one IMMEDIATE transaction, existing users and ancestry are
+#	read again with one pass of IN queries, every row is re-judged and all writes land, so a concurrent writer
+#	cannot change what was checked. A row that passes only on the second judgment is hashed under the lock.
+def writeUsersBulk(db, rows):
+
+	rows = list(rows)
 
-	# test for success
-	c.execute('''SELECT perms FROM users WHERE uid=?''', (uid,))
-	result = c.fetchone()
-	db.commit()
+	# Judge once without the write lock and hash only the rows that would insert a user
+	c = db.cursor()
+	results, inserts, updates = _judgeUsersBulk(c, rows)
 	c.close()
+	futures = {n: submitHash(rows[n][3]) for n, pid, perms, uid in inserts}
+	hashes = {n: future.result() for n, future in futures.items()}
+
+	# Judge again and write under one write lock, so the rows checked are the rows written;
+	#	a row that only passes now (the table changed meanwhile) is hashed here
+	with transaction(db):
+		c = db.cursor()
+		results, inserts, updates = _judgeUsersBulk(c, rows)
+		c.executemany('''INSERT INTO users(pid, perms, uid, hash) VALUES(?,?,?,?)''',
+			[(pid, perms, uid, hashes[n] if n in hashes else submitHash(rows[n][3]).result()) for n, pid, perms, uid in inserts])
+		c.executemany('''UPDATE users SET perms = ? WHERE uid = ?''', updates)
+		c.close()
+
+		# Cached perms in updated users' sessions are now stale
+		updated = {uid for perms, uid in updates}
+		afterCommit(db, lambda: [sessions.revokeUser(uid) for uid in updated])
+
+	return results
+
+
+# Judge bulk rows by writeUser()'s rules against the current table
+# Returns: (results, inserts as (row_index, pid, perms, uid), updates as (perms, uid))
+def _judgeUsersBulk(c, rows):
+
+	names = list({row[0] for row in rows} | {row[1] for row in rows})
+
+	# Resolve every referenced user and everyone above it
+	known = {}	# uid -> [pid, perms]
+	above = {}	# uid -> set of ancestors (depth > 0)
+	c.execute('''SELECT MAX(rowid) IS NOT NULL FROM users''')
+	anyUser = c.fetchone()[0]
+	for i in range(0, len(names), 500):
+		part = names[i:i + 500]
+		c.execute(bulkUsersQuery.format(','.join('?' * len(part))), part)
+		for uid, pid, perms in c.fetchall():
+			known[uid] = [pid, perms]
+		c.execute(bulkAncestorsQuery.format(','.join('?' * len(part))), part)
+		for ancestor, descendant in c.fetchall():
+			above.setdefault(descendant, set()).add(ancestor)
+
+	# Judge each row against the state left by the rows before it
+	results = []
+	inserts = []	# (row index, pid, perms, uid)
+	updates = []	# (perms, uid)
+	for n, (pid, uid, perms, pwd) in enumerate(rows):
+
+		# First user into table gets administrative access!
+		if not anyUser:
+			anyUser = True
+			known[uid] = [pid, 0b1111]
+			if pid != uid:
+				above[uid] = {pid}
+			inserts.append((n, pid, 0b1111, uid))
+			results.append(True)
+			continue
+
+		parent = known.get(pid)
+		child = known.get(uid)
+
+		if parent is None or parent[1] is None:
+			results.append(False)
+		elif (0b1000 & perms == 0b1000) and (0b1000 & parent[1] != 0b1000):
+			results.append(False)
+		elif (0b100 & perms == 0b100) and (0b1000 & parent[1] != 0b1000):
+			results.append(False)
+		elif (0b1 & perms != 0b1 & parent[1]) and (0b10 & perms != 0b10 & parent[1]) or (0b0011 & perms == 0):
+			results.append(False)
+		elif child is None:
+			known[uid] = [pid, perms]
+			above[uid] = above.get(pid, set()) | {pid}
+			inserts.append((n, pid, perms, uid))
+			results.append(True)
+		elif (child[0] == pid) or (pid in above.get(uid, ())):
+			child[1] = perms
+			updates.append((perms, uid))
+			results.append(True)
+		else:
+			results.append(child[1] == perms)
+
+	return results, inserts, updates
+
+
+# Function: isAncestor()
+# Purpose: Check whether one user is above another in the org tree
+# Syntax: isAncestor(<connection>, <ancestor_uid>, <user_id>)
+# Returns: True if ancestor_uid is a parent, grandparent, ... of user_id / False otherwise (including ancestor_uid == user_id)
+def isAncestor(db, aid, uid):
+	return userStore(db).isAncestor(aid, uid)
+
+
+# Function: listOrgUsers()
+# Purpose: List every user in an org's subtree
+# Syntax: listOrgUsers(<connection>, <org_uid>)
+# Returns: A list of (uid, pid, perms, depth) below org_uid, nearest first, or an empty list if none
+def listOrgUsers(db, oid):
+	return userStore(db).listOrgUsers(oid)
 
-	# If user exists...
+
+# Class SessionStore
+# Purpose: in-memory map of opaque session tokens to (uid, perms), expiring ttl seconds after last use
+# Note: every session has the same ttl and use moves a session to the back, so the OrderedDict stays in
+#	expiry order. Each call pops only expired sessions from the front, at most sweepBatch of them,
+#	so expiry never scans the whole store.
+# Note: holds at most maxSessions; beyond that the session closest to expiry is dropped.
+class SessionStore:
+
+	def __init__(self, ttl=1800, maxSessions=100000, sweepBatch=32):
+		self.ttl = ttl
+		self.maxSessions = maxSessions
+		self.sweepBatch = sweepBatch
+		self.entries = OrderedDict()	# token -> [uid, perms, expires]
+		self.byUser = {}		# uid -> set of tokens
+		self.lock = threading.Lock()
+
+	def issue(self, uid, perms):
+		token = secrets.token_urlsafe(32)
+		with self.lock:
+			self._sweep(time.monotonic())
+			self.entries[token] = [uid, perms, time.monotonic() + self.ttl]
+			self.byUser.setdefault(uid, set()).add(token)
+			while len(self.entries) > self.maxSessions:
+				self._drop(next(iter(self.entries)))
+		return token
+
+	# Returns: (uid, perms) for a live token, else None. Use extends the session.
+	def lookup(self, token):
+		now = time.monotonic()
+		with self.lock:
+			self._sweep(now)
+			entry = self.entries.get(token)
+			if entry is None:
+				return None
+			if entry[2] <= now:
+				self._drop(token)
+				return None
+			entry[2] = now + self.ttl
+			self.entries.move_to_end(token)
+			return entry[0], entry[1]
+
+	def revoke(self, token):
+		with self.lock:
+			if token in self.entries:
+				self._drop(token)
+
+	def revokeUser(self, uid):
+		with self.lock:
+			for token in list(self.byUser.get(uid, ())):
+				self._drop(token)
+
+	def _drop(self, token):
+		uid = self.entries.pop(token)[0]
+		tokens = self.byUser[uid]
+		tokens.discard(token)
+		if not tokens:
+			del self.byUser[uid]
+
+	def _sweep(self, now):
+		for _ in range(self.sweepBatch):
+			if not self.entries:
+				return
+			token = next(iter(self.entries))
+			if self.entries[token][2] > now:
+				return
+			self._drop(token)
+
+	def __len__(self):
+		return len(self.entries)
+
+
+# Sessions for this process; writeUser() revokes a user's sessions when it changes them
+sessions = SessionStore()
+
+
+# Function: createSession()
+# Purpose: Log a user in and issue a session token
+# Syntax: createSession(<connection>, <user_id>, <password>)
+# Returns: an opaque token string on valid uid/pwd pair / None on invalid pair
+def createSession(db, uid, pwd):
+	return userStore(db).createSession(uid, pwd)
+
+
+# Function: sessionUser()
+# Purpose: Resolve a session token without touching the database
+# Syntax: sessionUser(<token>)
+# Returns: (uid, perms) for a live session / None for an unknown, expired or revoked token
+def sessionUser(token):
+	return sessions.lookup(token)
+
+
+# Function: sessionHasPerms()
+# Purpose: Check a session's cached perms bitmask
+# Syntax: sessionHasPerms(<token>, <required_perm_bits>)
+# Returns: True if the session is live and holds every required bit / False otherwise
+def sessionHasPerms(token, perms):
+
+	result = sessions.lookup(token)
 	if result is not None:
-		# First user with full access: True
-		if (firstUser is True) and (result[0] == 0b1111):
-			return True
-		# Subsequent user with matching access: True
-		elif result[0] == perms:
+		if result[1] & perms == perms:
 			return True
-	
-	# Neither case above pertains: False
 	return False
+
+
+# Function: endSession()
+# Purpose: Log out: revoke a session token
+# Syntax: endSession(<token>)
+def endSession(token):
+	sessions.revoke(token)
+
+
+# Function: userStore()
+# Purpose: Get the UserStore bound to a connection, creating it on first use
+# Syntax: userStore(<connection>)
+# Returns: the connection's UserStore; connections not opened by Schema.openDatabase() get a new, unshared one
+def userStore(db):
+
+	stores = getattr(db, 'stores', None)
+	if stores is None:
+		return UserStore(db)
+	store = stores.get('users')
+	if store is None:
+		store = stores['users'] = UserStore(db)
+	return store
+
+
+# Class UserStore
+# Purpose: the per-request user helpers, bound to one connection
+# Syntax: store = userStore(<connection>)
+#	store.validUser(<user_id>, <password>)	# and the other methods below, minus the connection argument
+# Note: validUser(), isAncestor(), listOrgUsers() and createSession() are thin wrappers over the connection's store,
+#	which reuses one cursor and fixed SQL served from the connection's statement cache. writeUser() and
+#	writeUsersBulk() run rarely and stay free functions.
+# Note: like its connection, a store serves one thread at a time
+class UserStore:
+
+	def __init__(self, db):
+		self.db = db
+		self.cursor = db.cursor()
+
+	# The stored (hash, perms) for a valid uid/pwd pair, else None
+	def _login(self, uid, pwd):
+
+		c = self.cursor
+		c.execute(loginQuery, (uid,))
+		result = c.fetchone()
+
+		# If current hash exists and matches pwd then uid/pwd is valid
+		if result is not None:
+			if submitVerify(pwd, result[0]).result():
+				if needsRehash(result[0]):
+					_rehash(self.db, uid, result[0], pwd)
+				return result
+		return None
+
+	def validUser(self, uid, pwd):
+
+		if self._login(uid, pwd) is not None:
+			return True
+		else:
+			return False
+
+	# One query both checks the password and reads the perms the session caches
+	def createSession(self, uid, pwd):
+
+		result = self._login(uid, pwd)
+		if result is None:
+			return None
+		return sessions.issue(uid, result[1])
+
+	def isAncestor(self, aid, uid):
+
+		c = self.cursor
+		c.execute(isAncestorQuery, (aid, uid))
+		if c.fetchone() is not None:
+			return True
+		else:
+			return False
+
+	def listOrgUsers(self, oid):
+
+		c = self.cursor
+		c.execute(orgUsersQuery, (oid,))
+		return c.fetchall()